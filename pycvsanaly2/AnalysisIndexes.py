@@ -0,0 +1,119 @@
+# Copyright (C) 2014 LibreSoft
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Management of the indexes used to analyze a stored log.
+
+The indexes (Database.analysis_indexes) can be created, verified or
+dropped. The queries run by extensions and the ones documented in
+db/Queries.md are timed before and after creating or dropping them.
+"""
+
+import time
+
+from Database import statement
+from extensions.FileRevs import FileRevs
+from utils import printout
+
+ACTIONS = ['create', 'verify', 'drop']
+
+# Number of files whose path is looked up like FileRevs does
+PATH_LOOKUPS = 100
+
+# Portable versions of db/Queries.md, without grouping by month
+QUERIES = [("Revisions of the files (FileRevs)", FileRevs.__query__),
+           ("Paths of the files (FileRevs)", FileRevs.__path_query__),
+           ("Commits per file (Queries.md 28)",
+            "SELECT f.id, COUNT(s.id) FROM scmlog s, actions a, files f " +
+            "WHERE s.id = a.commit_id AND a.file_id = f.id GROUP BY f.id"),
+           ("Active files (Queries.md 19)",
+            "SELECT COUNT(DISTINCT a.file_id) FROM scmlog s, actions a " +
+            "WHERE s.id = a.commit_id AND a.file_id NOT IN " +
+            "(SELECT DISTINCT file_id FROM actions WHERE type = 'D')"),
+           ("Actions of the newest commits",
+            "SELECT a.type, COUNT(a.id) FROM scmlog s, actions a " +
+            "WHERE s.id = a.commit_id AND s.date >= ? GROUP BY a.type")]
+
+
+def _get_args(db, cursor, uri):
+    """Return the list of arguments every query is run with"""
+    cursor.execute(statement("SELECT id from repositories where uri = ?", db.place_holder), (uri,))
+    repoid = cursor.fetchone()[0]
+
+    cursor.execute(statement("SELECT file_id, MAX(commit_id) from file_links " +
+                             "GROUP BY file_id ORDER BY file_id LIMIT ?", db.place_holder),
+                   (PATH_LOOKUPS,))
+    paths = cursor.fetchall()
+
+    # Date of the newest 10% of the commits
+    cursor.execute("SELECT count(id) from scmlog")
+    n_commits = cursor.fetchone()[0]
+    cursor.execute(statement("SELECT date from scmlog ORDER BY date DESC LIMIT 1 OFFSET ?",
+                             db.place_holder), (n_commits / 10,))
+    rs = cursor.fetchone()
+    newest = rs and [rs] or []
+
+    return [[(repoid,)], paths, [()], [()], newest]
+
+
+def time_queries(db, cursor, args):
+    times = []
+    for (description, query), query_args in zip(QUERIES, args):
+        query = statement(query, db.place_holder)
+        start = time.time()
+        for a in query_args:
+            cursor.execute(query, a)
+            cursor.fetchall()
+        times.append(time.time() - start)
+
+    return times
+
+
+def manage_analysis_indexes(db, uri, action):
+    """Create, verify or drop the analysis indexes, printing
+       how long the queries take before and after doing it.
+       Return whether all the indexes are created when verifying"""
+    cnn = db.connect()
+    cursor = cnn.cursor()
+
+    missing = [name for name, table, columns in db.missing_analysis_indexes(cursor)]
+    for name, table, columns in db.analysis_indexes:
+        printout("Index %s on %s(%s): %s",
+                 (name, table, columns, name in missing and "missing" or "ok"))
+
+    if action == 'verify':
+        cursor.close()
+        cnn.close()
+        return not missing
+
+    args = _get_args(db, cursor, uri)
+    before = time_queries(db, cursor, args)
+
+    if action == 'create':
+        names = db.create_analysis_indexes(cursor)
+        printout("Created indexes: %s", (", ".join(names) or "none",))
+    else:
+        names = db.drop_analysis_indexes(cursor)
+        printout("Dropped indexes: %s", (", ".join(names) or "none",))
+    cnn.commit()
+
+    after = time_queries(db, cursor, args)
+    for (description, query), t1, t2 in zip(QUERIES, before, after):
+        printout("%s: %.3f s before, %.3f s after", (description, t1, t2))
+
+    cursor.close()
+    cnn.close()
+
+    return True
@@ -55,6 +55,17 @@ class AsyncQueue:
         finally:
             self.finish.release()
 
+    def set_maxsize(self, maxsize):
+        self.full_cond.acquire()
+        try:
+            self.maxsize = maxsize
+            self.full_cond.notifyAll()
+        finally:
+            self.full_cond.release()
+
+    def qsize(self):
+        return len(self.queue)
+
     def empty(self):
         self.mutex.acquire()
         retval = self._empty()
@@ -124,7 +135,7 @@ class AsyncQueue:
         return not self.queue
 
     def _full(self):
-        return self.maxsize > 0 and len(self.queue) == self.maxsize
+        return self.maxsize > 0 and len(self.queue) >= self.maxsize
 
     def _put(self, item):
         self.queue.append(item)
@@ -0,0 +1,167 @@
+# Copyright (C) 2014 LibreSoft
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Contents of files stored in a local directory, keyed by their
+blob id, so that every version of a file is retrieved only once."""
+
+import os
+import threading
+import time
+from hashlib import sha1
+from tempfile import mkstemp
+
+from utils import printdbg, create_directory
+
+# Once the cache is full, the least recently used
+# blobs are removed until it's below this fraction
+LOW_WATER = 0.9
+
+
+class BlobCache:
+    """Directory of file contents, at most maxsize bytes.
+
+    Keys are strings, like git blob ids, or any string identifying
+    a file revision for other repositories. Every blob is a file named
+    after the hash of its key. Its modification time is updated when
+    it's read, and the least recently used blobs are removed when
+    the cache grows beyond maxsize. Several processes can share
+    the same directory.
+
+    The blobs in the directory are listed once, the first time
+    one is stored, and the list is kept up to date as blobs are
+    stored and removed. Blobs stored by other processes after that
+    are not counted.
+    """
+
+    def __init__(self, path, maxsize):
+        self.path = path
+        self.maxsize = maxsize
+        self.size = None
+        self.blobs = None
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+        create_directory(path)
+
+    def __get_filename(self, key):
+        digest = sha1(key).hexdigest()
+        return os.path.join(self.path, digest[:2], digest[2:])
+
+    def __load_blobs(self):
+        """Find the filename, mtime and size of every blob.
+           Temporary files of the blobs being written, by this
+           or other processes, start with a dot"""
+        self.blobs = {}
+        self.size = 0
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for filename in filenames:
+                if filename.startswith('.'):
+                    continue
+
+                filename = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    # Removed by another process
+                    continue
+                self.blobs[filename] = (st.st_mtime, st.st_size)
+                self.size += st.st_size
+
+    def __evict(self):
+        blobs = [(mtime, size, filename)
+                 for filename, (mtime, size) in self.blobs.iteritems()]
+        blobs.sort()
+
+        target = self.maxsize * LOW_WATER
+        n_removed = 0
+        for mtime, size, filename in blobs:
+            if self.size <= target:
+                break
+
+            try:
+                os.remove(filename)
+                n_removed += 1
+            except OSError:
+                pass
+            del self.blobs[filename]
+            self.size -= size
+
+        printdbg("BlobCache: removed %d blobs, %d bytes left", (n_removed, self.size))
+
+    def get(self, key):
+        """Return the contents stored for key, None if they
+           aren't in the cache"""
+        filename = self.__get_filename(key)
+        try:
+            fd = open(filename, 'rb')
+            try:
+                contents = fd.read()
+            finally:
+                fd.close()
+            os.utime(filename, None)
+        except (IOError, OSError):
+            self.lock.acquire()
+            self.misses += 1
+            self.lock.release()
+            return None
+
+        self.lock.acquire()
+        try:
+            self.hits += 1
+            if self.blobs is not None and filename in self.blobs:
+                self.blobs[filename] = (time.time(), self.blobs[filename][1])
+        finally:
+            self.lock.release()
+
+        return contents
+
+    def put(self, key, contents):
+        """Store contents for key. IOError or OSError are
+           raised if the blob can't be written"""
+        if len(contents) > self.maxsize:
+            return
+
+        filename = self.__get_filename(key)
+        dirname = os.path.dirname(filename)
+        create_directory(dirname)
+
+        # Write to a temporary file so that other
+        # readers never see half of the blob
+        fd, tmp = mkstemp(prefix='.', dir=dirname)
+        try:
+            try:
+                os.write(fd, contents)
+            finally:
+                os.close(fd)
+            os.rename(tmp, filename)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        self.lock.acquire()
+        try:
+            if self.blobs is None:
+                self.__load_blobs()
+            else:
+                mtime, size = self.blobs.get(filename, (None, 0))
+                self.size += len(contents) - size
+                self.blobs[filename] = (time.time(), len(contents))
+
+            if self.size > self.maxsize:
+                self.__evict()
+        finally:
+            self.lock.release()
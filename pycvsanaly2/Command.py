@@ -20,7 +20,9 @@ import os
 import select
 import subprocess
 import errno
-from signal import SIGINT, SIGTERM
+import time
+from collections import deque
+from signal import SIGINT, SIGTERM, SIGKILL
 
 
 class CommandError(Exception):
@@ -46,8 +48,86 @@ class CommandTimeOut(Exception):
     '''Timeout running command'''
 
 
+def _split_lines(buf, chunk, flush=False):
+    """Add chunk to the bytearray buf and return the complete
+       lines in it. The rest is kept until the next chunk,
+       unless flush is True"""
+    buf.extend(chunk)
+    pos = buf.rfind('\n') + 1
+    if flush:
+        pos = len(buf)
+    if pos == 0:
+        return []
+
+    lines = str(buf[:pos]).split('\n')
+    del buf[:pos]
+    last = lines.pop()
+    lines = [line + '\n' for line in lines]
+    if last:
+        lines.append(last)
+
+    return lines
+
+
+class _Poller:
+    """Waits for the pipes of a process using poll, or
+       select where poll is not available"""
+
+    def __init__(self):
+        self.read_set = []
+        self.write_set = []
+        if hasattr(select, 'poll'):
+            self.poll = select.poll()
+        else:
+            self.poll = None
+
+    def register(self, f, write=False):
+        if write:
+            self.write_set.append(f)
+            events = select.POLLOUT
+        else:
+            self.read_set.append(f)
+            events = select.POLLIN | select.POLLPRI
+
+        if self.poll is not None:
+            self.poll.register(f.fileno(), events)
+
+    def unregister(self, f):
+        if f in self.read_set:
+            self.read_set.remove(f)
+        else:
+            self.write_set.remove(f)
+
+        if self.poll is not None:
+            self.poll.unregister(f.fileno())
+
+    def __len__(self):
+        return len(self.read_set) + len(self.write_set)
+
+    def wait(self, timeout):
+        """Return the lists of files ready to be read and written.
+           A closed pipe is ready, reading from it returns ''"""
+        if self.poll is None:
+            rlist, wlist, xlist = select.select(self.read_set, self.write_set, [], timeout)
+            return rlist, wlist
+
+        files = dict([(f.fileno(), f) for f in self.read_set + self.write_set])
+        rlist = []
+        wlist = []
+        for fd, event in self.poll.poll(timeout * 1000):
+            f = files[fd]
+            if f in self.read_set:
+                rlist.append(f)
+            else:
+                wlist.append(f)
+
+        return rlist, wlist
+
+
 class Command:
     SELECT_TIMEOUT = 2
+    # Bytes read from the pipes at once
+    READ_SIZE = 65536
 
     def __init__(self, command, cwd=None, env=None, error_handler_func=None):
         self.cmd = command
@@ -60,7 +140,7 @@ class Command:
     def set_error_handler(self, error_handler_func):
         self.error_handler_func = error_handler_func
 
-    def _read(self, fd, buffsize):
+    def _read(fd, buffsize):
         while True:
             try:
                 return os.read(fd, buffsize)
@@ -69,8 +149,9 @@ class Command:
                     continue
                 else:
                     raise
+    _read = staticmethod(_read)
 
-    def _write(self, fd, s):
+    def _write(fd, s):
         while True:
             try:
                 return os.write(fd, s)
@@ -79,35 +160,34 @@ class Command:
                     continue
                 else:
                     raise
+    _write = staticmethod(_write)
 
     def _read_from_pipes(self, stdin=None, out_data_cb=None, err_data_cb=None, timeout=None):
         p = self.process
 
-        read_set = [p.stdout, p.stderr]
-        write_set = []
+        poller = _Poller()
+        poller.register(p.stdout)
+        poller.register(p.stderr)
 
         p.stdin.flush()
         if stdin is not None:
-            write_set.append(p.stdin)
+            poller.register(p.stdin, True)
 
+        # Chunks are joined once the command finishes
         if out_data_cb is None:
-            out_data = ""
-        else:
-            out_data = None
-
+            out_chunks = []
         if err_data_cb is None:
-            err_data = ""
-        else:
-            err_data = None
+            err_chunks = []
+        err_data = None
 
         if timeout is not None:
             elapsed = 0.0
 
         input_offset = 0
         try:
-            while read_set or write_set:
+            while poller:
                 try:
-                    rlist, wlist, xlist = select.select(read_set, write_set, [], self.SELECT_TIMEOUT)
+                    rlist, wlist = poller.wait(self.SELECT_TIMEOUT)
                 except select.error, e:
                     # Ignore interrupted system call, reraise anything else
                     if e.args[0] == errno.EINTR:
@@ -115,6 +195,8 @@ class Command:
                     raise
 
                 if rlist == wlist == []:
+                    if err_data_cb is None:
+                        err_data = "".join(err_chunks)
                     if err_data:
                         handled = False
                         if self.error_handler_func is not None:
@@ -133,32 +215,34 @@ class Command:
                     elapsed = 0.0
 
                 if p.stdin in wlist:
-                    bytes_written = self._write(p.stdin.fileno(), buffer(stdin, input_offset, 512))
+                    # Writes up to PIPE_BUF bytes don't block
+                    bytes_written = self._write(p.stdin.fileno(),
+                                                buffer(stdin, input_offset, select.PIPE_BUF))
                     input_offset += bytes_written
                     if input_offset >= len(stdin):
+                        poller.unregister(p.stdin)
                         p.stdin.close()
-                        write_set.remove(p.stdin)
 
                 if p.stdout in rlist:
-                    out_chunk = self._read(p.stdout.fileno(), 1024)
+                    out_chunk = self._read(p.stdout.fileno(), self.READ_SIZE)
                     if out_chunk == "":
+                        poller.unregister(p.stdout)
                         p.stdout.close()
-                        read_set.remove(p.stdout)
 
                     if out_data_cb is None:
-                        out_data += out_chunk
+                        out_chunks.append(out_chunk)
                     else:
                         out_data_cb[0](out_chunk, out_data_cb[1])
 
                 if p.stderr in rlist:
-                    err_chunk = self._read(p.stderr.fileno(), 1024)
+                    err_chunk = self._read(p.stderr.fileno(), self.READ_SIZE)
 
                     if err_chunk == "":
+                        poller.unregister(p.stderr)
                         p.stderr.close()
-                        read_set.remove(p.stderr)
 
                     if err_data_cb is None:
-                        err_data += err_chunk
+                        err_chunks.append(err_chunk)
                     else:
                         err_data_cb[0](err_chunk, err_data_cb[1])
 
@@ -177,46 +261,37 @@ class Command:
         ret = p.wait()
         self.process = None
 
+        out_data = err_data = None
+        if out_data_cb is None:
+            out_data = "".join(out_chunks)
+        if err_data_cb is None:
+            err_data = "".join(err_chunks)
+
         return out_data, err_data, ret
 
-    def _run_with_callbacks(self, stdin=None, parser_out_func=None, parser_error_func=None, timeout=None):
+    def _run_with_callbacks(self, stdin=None, parser_out_func=None, parser_error_func=None, timeout=None,
+                            batch=False):
         out_func = err_func = None
 
-        def out_cb(out_chunk, out_data_l, flush=False):
-            out_data = out_data_l[0]
-            out_data += out_chunk
-            while '\n' in out_data:
-                pos = out_data.find('\n')
-                parser_out_func(out_data[:pos + 1])
-                out_data = out_data[pos + 1:]
-
-            if flush and out_data != "":
-                parser_out_func(out_data)
-                out_data_l[0] = ""
-            else:
-                out_data_l[0] = out_data
-
-        def err_cb(err_chunk, err_data_l, flush=False):
-            err_data = err_data_l[0]
-            err_data += err_chunk
-            while '\n' in err_data:
-                pos = err_data.find('\n')
-                parser_error_func(err_data[:pos + 1])
-                err_data = err_data[pos + 1:]
-
-            if flush and err_data != "":
-                parser_out_func(err_data)
-                err_data_l[0] = ""
-            else:
-                err_data_l[0] = err_data
+        def make_cb(parser_func, batch):
+            def cb(chunk, buf, flush=False):
+                lines = _split_lines(buf, chunk, flush)
+                if not lines:
+                    return
+
+                if batch:
+                    parser_func(lines)
+                else:
+                    for line in lines:
+                        parser_func(line)
+
+            return cb
 
         if parser_out_func is not None:
-            out_data = [""]
-            out_func = (out_cb, out_data)
+            out_func = (make_cb(parser_out_func, batch), bytearray())
 
         if parser_error_func is not None:
-            err_data = [""]
-            err_func = (err_cb, err_data)
+            err_func = (make_cb(parser_error_func, False), bytearray())
 
         return self._read_from_pipes(stdin, out_func, err_func, timeout)
 
@@ -247,13 +322,16 @@ class Command:
     def run_sync(self, stdin=None, timeout=None):
         return self.run(stdin, None, None, timeout)
 
-    def run(self, stdin=None, parser_out_func=None, parser_error_func=None, timeout=None):
+    def run(self, stdin=None, parser_out_func=None, parser_error_func=None, timeout=None, batch=False):
+        """Run the command, returning its output unless parser_out_func
+           is given. It's called for every line of the output or, if
+           batch is True, with the list of lines read at once"""
         self._get_process()
 
         if parser_out_func is None and parser_error_func is None:
             out, err, ret = self._read_from_pipes(stdin, timeout=timeout)
         else:
-            out, err, ret = self._run_with_callbacks(stdin, parser_out_func, parser_error_func, timeout)
+            out, err, ret = self._run_with_callbacks(stdin, parser_out_func, parser_error_func, timeout, batch)
 
         if ret != 0:
             raise CommandError(self.cmd, ret, err)
@@ -272,7 +350,240 @@ class Command:
             return None
 
 
+class _RunningCommand:
+    def __init__(self, cmd, done_func, user_data, cwd, env, stdin, out_func, timeout):
+        self.cmd = cmd
+        self.done_func = done_func
+        self.user_data = user_data
+        self.cwd = cwd
+        self.env = env
+        self.stdin = stdin
+        self.out_func = out_func
+        self.timeout = timeout
+
+        self.process = None
+        self.deadline = None
+        self.input_offset = 0
+        self.out_chunks = []
+        self.err_chunks = []
+        self.out_buf = bytearray()
+        # Pipes still open
+        self.n_open = 0
+
+
+class CommandRunner:
+    """Runs many commands at the same time from a single thread.
+
+    Commands are added with add() and started in order, at most
+    max_running of them at once, so hundreds of commands waiting for
+    the network or the disk don't need a thread each. add() runs the
+    commands already added while there are more than max_running
+    waiting to start, and run() waits for all of them.
+
+    When a command finishes, done_func is called with its output, its
+    error output, its return code and user_data. The return code is
+    None if the command was killed after timeout seconds without
+    finishing. If out_func is given, it's called with every line of
+    the output and user_data instead, and the output passed to
+    done_func is None. done_func can add more commands.
+    """
+
+    MAX_RUNNING = 16
+    # Seconds a command gets to exit after the timeout
+    KILL_TIMEOUT = 1
+
+    def __init__(self, max_running=MAX_RUNNING, timeout=None):
+        self.max_running = max(max_running, 1)
+        self.timeout = timeout
+
+        self.pending = deque()
+        # Running commands by their pipes
+        self.pipes = {}
+        self.n_running = 0
+        self.poller = _Poller()
+        self.dispatching = False
+
+    def add(self, cmd, done_func, user_data=None, cwd=None, env=None, stdin=None, out_func=None,
+            timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        self.pending.append(_RunningCommand(cmd, done_func, user_data, cwd, env, stdin, out_func, timeout))
+
+        # Commands added while dispatching the
+        # results of others are started later
+        if not self.dispatching:
+            while len(self.pending) > self.max_running:
+                self.__start_pending()
+                self.__step()
+            self.__start_pending()
+
+    def run(self):
+        """Run the commands until all of them finished"""
+        self.__start_pending()
+        while self.n_running:
+            self.__step()
+            self.__start_pending()
+
+    def __start_pending(self):
+        while self.pending and self.n_running < self.max_running:
+            c = self.pending.popleft()
+
+            # Children must not inherit the pipes of the other
+            # commands, or they would never get to their end
+            kws = {'close_fds': True,
+                   'stdout': subprocess.PIPE,
+                   'stderr': subprocess.PIPE,
+                   'stdin': subprocess.PIPE,
+                   'env': os.environ.copy()
+                   }
+            if c.cwd is not None:
+                kws['cwd'] = c.cwd
+            if c.env is not None:
+                kws['env'].update(c.env)
+
+            c.process = subprocess.Popen(c.cmd, **kws)
+            if c.timeout is not None:
+                c.deadline = time.time() + c.timeout
+
+            for f in (c.process.stdout, c.process.stderr):
+                self.poller.register(f)
+                self.pipes[f] = c
+            c.n_open = 2
+
+            if c.stdin:
+                self.poller.register(c.process.stdin, True)
+                self.pipes[c.process.stdin] = c
+            else:
+                c.process.stdin.close()
+
+            self.n_running += 1
+
+    def __close(self, c, f):
+        self.poller.unregister(f)
+        del self.pipes[f]
+        f.close()
+        if f is not c.process.stdin:
+            c.n_open -= 1
+
+    def __kill(self, c):
+        """Terminate the command, killing it if
+           it's still running after KILL_TIMEOUT"""
+        try:
+            os.kill(c.process.pid, SIGTERM)
+            deadline = time.time() + self.KILL_TIMEOUT
+            while c.process.poll() is None and time.time() < deadline:
+                time.sleep(0.05)
+            if c.process.poll() is None:
+                os.kill(c.process.pid, SIGKILL)
+        except OSError:
+            pass
+        c.process.wait()
+
+    def __finish(self, c, killed=False):
+        for f in [f for f, command in self.pipes.items() if command is c]:
+            self.__close(c, f)
+
+        if killed:
+            self.__kill(c)
+            ret = None
+        else:
+            ret = c.process.wait()
+        self.n_running -= 1
+
+        out = None
+        if c.out_func is not None:
+            for line in _split_lines(c.out_buf, "", True):
+                c.out_func(line, c.user_data)
+        else:
+            out = "".join(c.out_chunks)
+
+        c.done_func(out, "".join(c.err_chunks), ret, c.user_data)
+
+    def __step(self):
+        # Wait until the next deadline at most
+        now = time.time()
+        wait = Command.SELECT_TIMEOUT
+        deadlines = [c.deadline for c in self.pipes.values() if c.deadline is not None]
+        if deadlines:
+            wait = max(min(wait, min(deadlines) - now), 0)
+
+        try:
+            rlist, wlist = self.poller.wait(wait)
+        except select.error, e:
+            # Ignore interrupted system call, reraise anything else
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+
+        self.dispatching = True
+        try:
+            for f in wlist:
+                c = self.pipes[f]
+                # Writes up to PIPE_BUF bytes don't block
+                try:
+                    c.input_offset += Command._write(f.fileno(),
+                                                     buffer(c.stdin, c.input_offset, select.PIPE_BUF))
+                except OSError, e:
+                    # The command exited without reading all its input
+                    if e.errno != errno.EPIPE:
+                        raise
+                    c.input_offset = len(c.stdin)
+                if c.input_offset >= len(c.stdin):
+                    self.__close(c, f)
+
+            for f in rlist:
+                c = self.pipes[f]
+                chunk = Command._read(f.fileno(), Command.READ_SIZE)
+                if f is c.process.stdout:
+                    if c.out_func is not None:
+                        for line in _split_lines(c.out_buf, chunk):
+                            c.out_func(line, c.user_data)
+                    else:
+                        c.out_chunks.append(chunk)
+                else:
+                    c.err_chunks.append(chunk)
+
+                if chunk == "":
+                    self.__close(c, f)
+                    if c.n_open == 0:
+                        self.__finish(c)
+
+            now = time.time()
+            for c in set(self.pipes.values()):
+                if c.deadline is not None and c.deadline <= now:
+                    self.__finish(c, True)
+        finally:
+            self.dispatching = False
+
+
+def benchmark(path):
+    """Print the throughput of cat path, reading its
+       output at once, line by line and in batches"""
+    size = os.path.getsize(path) / float(1024 * 1024)
+
+    def count_line(line):
+        n_lines[0] += 1
+
+    def count_lines(lines):
+        n_lines[0] += len(lines)
+
+    for name, kwargs in [('output', {}),
+                         ('lines', {'parser_out_func': count_line}),
+                         ('batches', {'parser_out_func': count_lines, 'batch': True})]:
+        n_lines = [0]
+        start = time.time()
+        Command(['cat', path]).run(**kwargs)
+        elapsed = time.time() - start
+        print "%s: %.1f MB/s, %d lines" % (name, size / elapsed, n_lines[0])
+
+
 if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) > 1:
+        benchmark(sys.argv[1])
+        sys.exit(0)
+
     # Valid command without cwd
     cmd = Command(['ls', '-l'])
     cmd.run()
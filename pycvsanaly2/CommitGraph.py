@@ -0,0 +1,482 @@
+# Copyright (C) 2014 LibreSoft
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Commits of a repository and their parents, loaded from the scmlog
+and commit_graph tables, so that ancestry, topological order and
+merge bases are known without running the repository commands.
+
+The graph is kept in NumPy arrays. NumPy is an optional dependency,
+imported when the first graph is built: ImportError is raised then
+if it isn't installed. AncestryIndex only answers whether a commit is
+an ancestor of another one, and it doesn't need NumPy.
+"""
+
+from Database import SqliteDatabase, statement
+from utils import printdbg
+
+np = None
+
+
+def _import_numpy():
+    global np
+
+    if np is None:
+        import numpy
+        np = numpy
+
+    return np
+
+
+class AncestryIndex:
+    """Reachability index of the commits of a repository.
+
+    Commits are visited once depth-first, from the roots to their
+    children, numbering them in pre-order and post-order. A commit is an
+    ancestor of the commits inside its interval of the spanning tree.
+    Every descendant of a commit has a post-order number between the
+    lowest one among its descendants (low) and its own, so commits
+    outside that range are not descendants. Generation numbers (the
+    length of the longest path from a root) discard the rest of
+    impossible cases, and the remaining ones are answered walking the
+    children that can still reach the commit.
+    """
+
+    def __init__(self, edges):
+        """Build the index from (commit_id, parent_id) pairs"""
+        self.index = {}
+        parents = []
+        children = []
+
+        def get_index(commit_id):
+            try:
+                return self.index[commit_id]
+            except KeyError:
+                i = self.index[commit_id] = len(parents)
+                parents.append([])
+                children.append([])
+                return i
+
+        self.n_edges = 0
+        for commit_id, parent_id in edges:
+            c = get_index(commit_id)
+            p = get_index(parent_id)
+            parents[c].append(p)
+            children[p].append(c)
+            self.n_edges += 1
+
+        self.children = children
+
+        n = len(parents)
+        self.pre = [0] * n
+        self.post = [0] * n
+        self.low = [0] * n
+        self.gen = [0] * n
+
+        counter = 0
+        pre_counter = 0
+        visited = [False] * n
+        for root in xrange(n):
+            if parents[root] or visited[root]:
+                continue
+
+            visited[root] = True
+            self.pre[root] = pre_counter
+            pre_counter += 1
+            stack = [(root, iter(children[root]))]
+            while stack:
+                node, it = stack[-1]
+                for child in it:
+                    # Generations of the children grow as
+                    # the paths to them are found
+                    self.gen[child] = max(self.gen[child], self.gen[node] + 1)
+                    if not visited[child]:
+                        visited[child] = True
+                        self.pre[child] = pre_counter
+                        pre_counter += 1
+                        stack.append((child, iter(children[child])))
+                        break
+                else:
+                    stack.pop()
+                    self.post[node] = counter
+                    counter += 1
+                    self.low[node] = min([self.low[c] for c in children[node]] + [self.post[node]])
+
+        # The generations found while visiting can be lower than the
+        # longest path, go through the commits in topological order
+        for node in sorted(xrange(n), key=lambda i: -self.post[i]):
+            for child in children[node]:
+                if self.gen[child] <= self.gen[node]:
+                    self.gen[child] = self.gen[node] + 1
+
+        printdbg("AncestryIndex: %d commits, %d edges", (n, self.n_edges))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __may_reach(self, a, b):
+        return self.low[a] <= self.post[b] <= self.post[a] and self.gen[a] < self.gen[b]
+
+    def __tree_contains(self, a, b):
+        return self.pre[a] <= self.pre[b] and self.post[b] <= self.post[a]
+
+    def is_ancestor(self, ancestor_id, commit_id):
+        """Whether ancestor_id is commit_id or one of its ancestors.
+           Commits not in the graph are only their own ancestors"""
+        if ancestor_id == commit_id:
+            return True
+
+        try:
+            a = self.index[ancestor_id]
+            b = self.index[commit_id]
+        except KeyError:
+            return False
+
+        if self.__tree_contains(a, b):
+            return True
+        if not self.__may_reach(a, b):
+            return False
+
+        # Walk the descendants of a that can still reach b
+        seen = set([a])
+        stack = [a]
+        while stack:
+            node = stack.pop()
+            for child in self.children[node]:
+                if child == b or self.__tree_contains(child, b):
+                    return True
+                if child not in seen and self.__may_reach(child, b):
+                    seen.add(child)
+                    stack.append(child)
+
+        return False
+
+
+class CommitGraph:
+    """Commits of a repository in compact arrays.
+
+    Commits are numbered by their position in ids, the scmlog ids in
+    ascending order, and every array is indexed by those positions:
+
+    - parent_ptr, parent_idx: parents of every commit (CSR), the
+      parents of the commit i are parent_idx[parent_ptr[i]:parent_ptr[i + 1]],
+      the first parent first when parents_ordered is True, and in
+      ascending order of their ids otherwise.
+    - child_ptr, child_idx: children of every commit, in the same way.
+    - gen: generation numbers, the length of the longest path from a
+      root commit. Ancestors always have a lower generation.
+    - dates: commit dates (datetime64), NaT when unknown.
+    - head, offset: most of the history are chains of commits with a
+      single parent that has no other children. Every commit belongs
+      to a chain, head is the first commit of its chain and offset its
+      distance to it. Graph walks go a whole chain at a time.
+
+    Methods taking commit ids accept a single id or a sequence of them.
+    """
+
+    __commits_query__ = "SELECT id, date FROM scmlog WHERE repository_id = ?"
+    __edges_query__ = "SELECT cg.commit_id, cg.parent_id FROM commit_graph cg, scmlog s " + \
+                      "WHERE cg.commit_id = s.id AND s.repository_id = ? ORDER BY cg.commit_id"
+
+    def __init__(self, ids, edges, dates=None, parents_ordered=True):
+        """ids are the commit ids, dates their commit dates and
+           edges (commit_id, parent_id) pairs. parents_ordered tells
+           whether the parents of every commit are in order, the
+           first parent first"""
+        _import_numpy()
+
+        self.parents_ordered = parents_ordered
+
+        ids = np.asarray(ids, dtype=np.int64)
+        edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+
+        # Commits only known by their edges are added too
+        self.ids = np.union1d(ids, edges.ravel())
+        self.dates = np.empty(len(self.ids), dtype='datetime64[s]')
+        self.dates[:] = np.datetime64('NaT')
+        if dates is not None:
+            self.dates[np.searchsorted(self.ids, ids)] = np.asarray(dates, dtype='datetime64[s]')
+
+        n = len(self.ids)
+        child = np.searchsorted(self.ids, edges[:, 0]).astype(np.int32)
+        parent = np.searchsorted(self.ids, edges[:, 1]).astype(np.int32)
+        self.n_edges = len(edges)
+
+        # A stable sort keeps the order of the parents
+        if not parents_ordered:
+            edges = edges[np.lexsort((parent, child))]
+            child = np.searchsorted(self.ids, edges[:, 0]).astype(np.int32)
+            parent = np.searchsorted(self.ids, edges[:, 1]).astype(np.int32)
+        order = np.argsort(child, kind='mergesort')
+        self.parent_ptr = self.__pointers(child, n)
+        self.parent_idx = parent[order]
+
+        order = np.argsort(parent, kind='mergesort')
+        self.child_ptr = self.__pointers(parent, n)
+        self.child_idx = child[order]
+
+        self.__build_chains()
+        self.gen = self.__generations()
+
+        # Built the first time is_ancestor() is called
+        self.ancestry = None
+
+        printdbg("CommitGraph: %d commits, %d edges, %d generations",
+                 (n, self.n_edges, self.gen.max() + 1 if n else 0))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __pointers(self, nodes, n):
+        ptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(nodes, minlength=n), out=ptr[1:])
+        return ptr
+
+    def __gather(self, ptr, idx, nodes):
+        """Return the neighbours of every node in nodes"""
+        starts = ptr[nodes]
+        counts = ptr[nodes + 1] - starts
+        total = counts.sum()
+        if total == 0:
+            return np.empty(0, dtype=idx.dtype)
+
+        # Positions of the neighbours in idx, the ranges
+        # [start, start + count) of every node one after another
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        return idx[offsets + np.arange(total)]
+
+    def __build_chains(self):
+        """Find the head of the chain of every commit and its offset,
+           jumping to the head of the head until it's reached"""
+        n = len(self.ids)
+        n_parents = np.diff(self.parent_ptr)
+        n_children = np.diff(self.child_ptr)
+
+        self.first_parent = np.full(n, -1, dtype=np.int64)
+        has_parents = np.flatnonzero(n_parents)
+        self.first_parent[has_parents] = self.parent_idx[self.parent_ptr[has_parents]]
+
+        # Commits following their parent in its chain
+        linked = n_parents == 1
+        linked[linked] = n_children[self.first_parent[linked]] == 1
+
+        head = np.where(linked, self.first_parent, np.arange(n))
+        offset = linked.astype(np.int64)
+        for i in xrange(int(n).bit_length() + 1):
+            if not linked[head].any():
+                break
+            offset += offset[head]
+            head = head[head]
+        else:
+            raise ValueError("commit_graph has cycles")
+
+        self.head = head
+        self.offset = offset
+
+        # The last commit of every chain, indexed by its head
+        not_last = np.zeros(n, dtype=bool)
+        not_last[self.first_parent[linked]] = True
+        last = np.flatnonzero(~not_last)
+        self.tail = np.full(n, -1, dtype=np.int64)
+        self.tail[head[last]] = last
+
+        # Commits of every chain together, from the head
+        self.chains = np.lexsort((offset, head))
+        self.chain_start = np.zeros(n, dtype=np.int64)
+        self.chain_start[self.chains[offset[self.chains] == 0]] = np.flatnonzero(offset[self.chains] == 0)
+
+    def __generations(self):
+        """Visit the chains from the roots, all the chains whose
+           parents are already visited at a time"""
+        n = len(self.ids)
+        heads = np.flatnonzero(self.offset == 0)
+        pending = np.diff(self.parent_ptr)
+        gen = np.zeros(n, dtype=np.int64)
+
+        visited = 0
+        frontier = heads[pending[heads] == 0]
+        while len(frontier):
+            visited += len(frontier)
+
+            # One more than the newest generation of the parents,
+            # the commits of their chains have gen[head] + offset
+            starts = self.parent_ptr[frontier]
+            counts = self.parent_ptr[frontier + 1] - starts
+            merges = counts > 0
+            if merges.any():
+                parents = self.__gather(self.parent_ptr, self.parent_idx, frontier[merges])
+                parent_gen = gen[self.head[parents]] + self.offset[parents] + 1
+                positions = np.cumsum(counts[merges]) - counts[merges]
+                gen[frontier[merges]] = np.maximum.reduceat(parent_gen, positions)
+
+            # Only the last commit of a chain has children in others
+            children = self.__gather(self.child_ptr, self.child_idx, self.tail[frontier])
+            children, counts = np.unique(children, return_counts=True)
+            pending[children] -= counts
+            frontier = children[pending[children] == 0]
+
+        if visited != len(heads):
+            raise ValueError("commit_graph has cycles")
+
+        return gen[self.head] + self.offset
+
+    def __to_index(self, commit_ids):
+        commit_ids = np.atleast_1d(np.asarray(commit_ids, dtype=np.int64))
+        index = np.searchsorted(self.ids, commit_ids)
+        found = index < len(self.ids)
+        found[found] = self.ids[index[found]] == commit_ids[found]
+        if not found.all():
+            raise KeyError("Commits not in the graph: %s" % (commit_ids[~found].tolist()))
+
+        return index
+
+    def __ancestors_mask(self, nodes):
+        """Mark the commits reachable from nodes. The ancestors of a
+           commit in its chain are the ones with lower offsets, so only
+           the highest offset reached in every chain is kept"""
+        n = len(self.ids)
+        top = np.full(n, -1, dtype=np.int64)
+
+        frontier = nodes
+        while len(frontier):
+            heads = self.head[frontier]
+            new = np.unique(heads[top[heads] < 0])
+            np.maximum.at(top, heads, self.offset[frontier])
+            frontier = self.__gather(self.parent_ptr, self.parent_idx, new)
+
+        return self.offset <= top[self.head]
+
+    def __descendants_mask(self, nodes):
+        """Mark the commits nodes are reachable from, keeping the
+           lowest offset reached in every chain"""
+        n = len(self.ids)
+        bottom = np.full(n, n, dtype=np.int64)
+
+        frontier = nodes
+        while len(frontier):
+            heads = self.head[frontier]
+            new = np.unique(heads[bottom[heads] == n])
+            np.minimum.at(bottom, heads, self.offset[frontier])
+            frontier = self.__gather(self.child_ptr, self.child_idx, self.tail[new])
+
+        return self.offset >= bottom[self.head]
+
+    def topo_order(self):
+        """Return the ids of the commits, parents before their
+           children. Commits of the same generation are sorted by date"""
+        return self.ids[np.lexsort((self.ids, self.dates, self.gen))]
+
+    def parents(self, commit_id):
+        i = self.__to_index(commit_id)[0]
+        return self.ids[self.parent_idx[self.parent_ptr[i]:self.parent_ptr[i + 1]]]
+
+    def children(self, commit_id):
+        i = self.__to_index(commit_id)[0]
+        return self.ids[self.child_idx[self.child_ptr[i]:self.child_ptr[i + 1]]]
+
+    def ancestors(self, commit_ids):
+        """Return the ids of the commits reachable from
+           commit_ids, them included"""
+        return self.ids[self.__ancestors_mask(self.__to_index(commit_ids))]
+
+    def descendants(self, commit_ids):
+        """Return the ids of the commits commit_ids are reachable
+           from, them included"""
+        return self.ids[self.__descendants_mask(self.__to_index(commit_ids))]
+
+    def merge_bases(self, a, b):
+        """Return the best common ancestors of the commits a and b,
+           the ones that aren't ancestors of other common ancestors,
+           like git merge-base --all. The newest generation first"""
+        common = np.flatnonzero(self.__ancestors_mask(self.__to_index(a)) &
+                                self.__ancestors_mask(self.__to_index(b)))
+
+        # Ancestors of common ancestors are common ancestors
+        # too, so only those are marked here
+        parents = self.__gather(self.parent_ptr, self.parent_idx, common)
+        worse = self.__ancestors_mask(parents)
+
+        bases = common[~worse[common]]
+        return self.ids[bases[np.argsort(-self.gen[bases], kind='mergesort')]]
+
+    def first_parents(self, commit_id, limit=None):
+        """Return the ids of commit_id and its first parents, up to
+           limit commits, like git log --first-parent. Without
+           parents_ordered the parent with the lowest id is followed,
+           which is not the first parent of merges"""
+        i = self.__to_index(commit_id)[0]
+        path = []
+        size = 0
+        while i >= 0 and (limit is None or size < limit):
+            # The rest of the chain, from i back to the head
+            start = self.chain_start[self.head[i]]
+            chain = self.chains[start:start + self.offset[i] + 1][::-1]
+            path.append(chain)
+            size += len(chain)
+            i = self.first_parent[self.head[i]]
+
+        if not path:
+            return self.ids[:0]
+
+        return self.ids[np.concatenate(path)[:limit]]
+
+    def is_ancestor(self, ancestor_id, commit_id):
+        """Whether ancestor_id is commit_id or one of its ancestors.
+           Commits not in the graph are only their own ancestors.
+           Answered by an AncestryIndex of the graph, built the
+           first time it's needed"""
+        if ancestor_id == commit_id:
+            return True
+
+        if self.ancestry is None:
+            child = np.repeat(np.arange(len(self.ids)), np.diff(self.parent_ptr))
+            self.ancestry = AncestryIndex(zip(self.ids[child].tolist(),
+                                              self.ids[self.parent_idx].tolist()))
+
+        return self.ancestry.is_ancestor(ancestor_id, commit_id)
+
+
+def load_commit_graph(db, cursor, repoid):
+    """Return the CommitGraph of the repository repoid.
+       commit_graph has no column with the order of the parents,
+       but SQLite keeps the order the rows were inserted in, the
+       order of the parents, in their rowid"""
+    _import_numpy()
+
+    cursor.execute(statement(CommitGraph.__commits_query__, db.place_holder), (repoid,))
+    commits = cursor.fetchall()
+
+    query = CommitGraph.__edges_query__
+    parents_ordered = isinstance(db, SqliteDatabase)
+    if parents_ordered:
+        query += ", cg.rowid"
+    cursor.execute(statement(query, db.place_holder), (repoid,))
+    edges = cursor.fetchall()
+
+    return CommitGraph([commit[0] for commit in commits], edges,
+                       [commit[1] for commit in commits], parents_ordered)
+
+
+def load_ancestry_index(db, cursor, repoid):
+    """Return the CommitGraph of the repository repoid, or an
+       AncestryIndex of it when NumPy is not installed"""
+    try:
+        return load_commit_graph(db, cursor, repoid)
+    except ImportError:
+        printdbg("NumPy is not installed, using an AncestryIndex for repository %d",
+                 (repoid,))
+
+    cursor.execute(statement(CommitGraph.__edges_query__, db.place_holder), (repoid,))
+    return AncestryIndex(cursor.fetchall())
@@ -34,12 +34,22 @@ class Config:
                       'no_parse': False,
                       'files' : [],
                       'gitref' : None,
+                      'cache_size': None,
+                      'rebuild_caches': False,
                       'db_driver': 'mysql',
                       'db_user': 'operator',
                       'db_password': None,
                       'db_database': 'cvsanaly',
                       'db_hostname': 'localhost',
+                      'bulk_load': False,
+                      'db_flush_rows': 1000,
+                      'db_flush_bytes': 1048576,
+                      'db_commit_interval': 10,
+                      'analysis_indexes': None,
                       'extensions': [],
+                      'extensions_jobs': 1,
+                      'process_jobs': [],
+                      'blob_cache_size': 0,
                       # Metrics extension options
                       'metrics_all': False,
                       'metrics_noerr': False}
@@ -100,6 +110,14 @@ class Config:
             self.gitref = config.gitref
         except:
             pass
+        try:
+            self.cache_size = config.cache_size
+        except:
+            pass
+        try:
+            self.rebuild_caches = config.rebuild_caches
+        except:
+            pass
         try:
             self.db_driver = config.db_driver
         except:
@@ -120,10 +138,42 @@ class Config:
             self.db_hostname = config.db_hostname
         except:
             pass
+        try:
+            self.bulk_load = config.bulk_load
+        except:
+            pass
+        try:
+            self.db_flush_rows = config.db_flush_rows
+        except:
+            pass
+        try:
+            self.db_flush_bytes = config.db_flush_bytes
+        except:
+            pass
+        try:
+            self.db_commit_interval = config.db_commit_interval
+        except:
+            pass
+        try:
+            self.analysis_indexes = config.analysis_indexes
+        except:
+            pass
         try:
             self.extensions.extend([item for item in config.extensions if item not in self.extensions])
         except:
             pass
+        try:
+            self.extensions_jobs = config.extensions_jobs
+        except:
+            pass
+        try:
+            self.process_jobs = config.process_jobs
+        except:
+            pass
+        try:
+            self.blob_cache_size = config.blob_cache_size
+        except:
+            pass
         try:
             self.metrics_all = config.metrics_all
         except:
@@ -18,11 +18,16 @@
 #       Carlos Garcia Campos <carlosgc@gsyc.escet.urjc.es>
 
 import os
+import time
+from binascii import a2b_hex, b2a_hex
+from UserDict import DictMixin
 
 from ContentHandler import ContentHandler
+from Config import Config
 from Database import (DBRepository, DBLog, DBFile, DBFileLink, DBAction,
                       DBFileCopy, DBBranch, DBPerson, DBTag, DBTagRev,
                       DBGraph, statement)
+from DiskCache import DiskCacheStore
 from profile import profiler_start, profiler_stop
 from utils import printdbg, printout, to_utf8, cvsanaly_cache_dir
 from cPickle import dump, load
@@ -36,8 +41,52 @@ class CacheFileMismatch(Exception):
     '''File cache doesn't match with the Database'''
 
 
+class RevisionCache(DictMixin):
+    """Map of revisions to commit ids.
+       Git revisions are kept as 20 bytes digests instead of
+       40 hexadecimal digits, both in memory and in the store.
+    """
+
+    def __init__(self, cache, binary):
+        self.cache = cache
+        self.binary = binary
+
+    def __key(self, rev):
+        if self.binary and rev is not None and len(rev) == 40:
+            return a2b_hex(rev)
+        return rev
+
+    def __getitem__(self, rev):
+        return self.cache[self.__key(rev)]
+
+    def __setitem__(self, rev, commit_id):
+        self.cache[self.__key(rev)] = commit_id
+
+    def __delitem__(self, rev):
+        del self.cache[self.__key(rev)]
+
+    def __contains__(self, rev):
+        return self.__key(rev) in self.cache
+
+    has_key = __contains__
+
+    def __iter__(self):
+        for key in self.cache:
+            if self.binary and len(key) == 20:
+                yield b2a_hex(key)
+            else:
+                yield key
+
+    iterkeys = __iter__
+
+    def __len__(self):
+        return len(self.cache)
+
+    def keys(self):
+        return list(self)
+
+
 class DBContentHandler(ContentHandler):
-    MAX_ACTIONS = 100
 
     def __init__(self, db):
         ContentHandler.__init__(self)
@@ -45,6 +94,8 @@ class DBContentHandler(ContentHandler):
         self.db = db
         self.cnn = None
         self.cursor = None
+        self.config = Config()
+        self.store = None
 
         self.__init_caches()
 
@@ -56,23 +107,121 @@ class DBContentHandler(ContentHandler):
         self.branch_cache = {}
         self.tags_cache = {}
         self.people_cache = {}
+        self.__init_file_cache_index()
+
+    def __init_file_cache_index(self):
+        # Maps every directory path (with its branch prefix) to the
+        # paths directly under it, so that the descendants of a
+        # directory can be found without scanning the whole file_cache.
+        # It's not saved to disk, it's rebuilt from file_cache instead
+        self.file_cache_children = {}
+        for path in self.file_cache:
+            self.__index_path(path)
+
+    def __open_caches(self):
+        """Set up empty caches for the repository. They are kept in
+           memory and saved at the end unless config.cache_size is set.
+           Then they are kept in a store on disk instead: items are read
+           from it when they are needed, only the items changed by this
+           run are written to it, and at most config.cache_size items
+           of every cache are kept in memory.
+        """
+        binary = self.repo_type == 'git'
+        if not self.config.cache_size:
+            self.__init_caches()
+            self.revision_cache = RevisionCache({}, binary)
+            return
+
+        printdbg("DBContentHandler: Opening caches (%s)", (self.store_file,))
+        self.store = DiskCacheStore(self.store_file)
+
+        size = self.config.cache_size
+        self.file_cache = self.store.get_cache('file_cache', size)
+        self.moves_cache = self.store.get_cache('moves_cache', size)
+        self.deletes_cache = self.store.get_cache('deletes_cache', size)
+        self.revision_cache = RevisionCache(self.store.get_cache('revision_cache', size),
+                                            binary)
+        self.branch_cache = self.store.get_object('branch_cache', {})
+        self.tags_cache = self.store.get_object('tags_cache', {})
+        self.people_cache = self.store.get_object('people_cache', {})
+
+        # Subtrees are looked up in the store, which keeps
+        # the paths sorted, so the index is not needed
+        self.file_cache_children = None
+
+    def __caches_on_disk(self):
+        return os.path.isfile(self.cache_file) or os.path.isfile(self.store_file)
+
+    def __remove_caches_from_disk(self):
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+        for path in (self.cache_file, self.store_file):
+            if os.path.isfile(path):
+                os.remove(path)
 
     def __save_caches_to_disk(self):
-        printdbg("DBContentHandler: Saving caches to disk (%s)", (self.cache_file,))
-        cache = [self.file_cache, self.moves_cache, self.deletes_cache,
-                 self.revision_cache, self.branch_cache, self.tags_cache,
-                 self.people_cache]
-        f = open(self.cache_file, 'w')
-        dump(cache, f, -1)
-        f.close()
+        if self.store is not None:
+            printdbg("DBContentHandler: Saving caches to disk (%s)", (self.store_file,))
+            self.store.set_object('branch_cache', self.branch_cache)
+            self.store.set_object('tags_cache', self.tags_cache)
+            self.store.set_object('people_cache', self.people_cache)
+            self.store.commit()
+            self.store.close()
+            self.store = None
+
+            # The caches saved by a previous run are in the store now
+            old_file = self.cache_file
+        else:
+            printdbg("DBContentHandler: Saving caches to disk (%s)", (self.cache_file,))
+            cache = [self.file_cache, self.moves_cache, self.deletes_cache,
+                     self.revision_cache.cache, self.branch_cache, self.tags_cache,
+                     self.people_cache]
+            f = open(self.cache_file, 'w')
+            dump(cache, f, -1)
+            f.close()
+
+            old_file = self.store_file
+
+        if os.path.isfile(old_file):
+            os.remove(old_file)
 
     def __load_caches_from_disk(self):
-        printdbg("DBContentHandler: Loading caches from disk (%s)", (self.cache_file,))
-        f = open(self.cache_file, 'r')
-        (self.file_cache, self.moves_cache, self.deletes_cache,
-         self.revision_cache, self.branch_cache, self.tags_cache,
-         self.people_cache) = load(f)
-        f.close()
+        if self.config.cache_size and os.path.isfile(self.store_file):
+            # Items are loaded from the store on demand
+            self.__open_caches()
+            return
+
+        if os.path.isfile(self.cache_file):
+            printdbg("DBContentHandler: Loading caches from disk (%s)", (self.cache_file,))
+            f = open(self.cache_file, 'r')
+            caches = load(f)
+            f.close()
+        else:
+            # Saved by a run keeping the caches on disk
+            printdbg("DBContentHandler: Loading caches from disk (%s)", (self.store_file,))
+            store = DiskCacheStore(self.store_file)
+            caches = [dict(store.get_cache(name, None).iteritems())
+                      for name in ('file_cache', 'moves_cache', 'deletes_cache',
+                                   'revision_cache')]
+            caches.extend([store.get_object(name, {})
+                           for name in ('branch_cache', 'tags_cache', 'people_cache')])
+            store.close()
+
+        self.__open_caches()
+        if self.store is None:
+            (self.file_cache, self.moves_cache, self.deletes_cache) = caches[:3]
+            self.__init_file_cache_index()
+        else:
+            # Caches were saved by a run keeping
+            # them in memory, move them to the store
+            for cache, saved in zip([self.file_cache, self.moves_cache,
+                                     self.deletes_cache], caches):
+                cache.update(saved)
+        # Revisions saved by older versions are not binary
+        self.revision_cache.update(caches[3])
+        self.branch_cache, self.tags_cache, self.people_cache = caches[4:]
 
     def __del__(self):
         if self.cnn is not None:
@@ -85,11 +234,50 @@ class DBContentHandler(ContentHandler):
 
         self.commits = []
         self.actions = []
+        self.people = []
+        self.branches = []
+        self.tags = []
+        self.files = []
+        self.links = []
+        self.copies = []
+        self.tag_revs = []
+        self.edges = []
+        self.pending_bytes = 0
+
+        self.n_commits = self.n_actions = 0
+        self.start_time = self.commit_time = time.time()
+
+    def __load_dimension_caches(self):
+        """Fill people, branch and tags caches with the contents of
+           their tables, so that we don't need to query the database
+           for every person, branch or tag missing in the caches
+        """
+        cursor = self.cursor
+
+        profiler_start("Loading people, branches and tags for repository %d",
+                       (self.repo_id,))
+        cursor.execute(statement("SELECT id, name, email from people",
+                                 self.db.place_holder))
+        for person_id, name, email in cursor.fetchall():
+            self.people_cache.setdefault((self.__key(name), self.__key(email)),
+                                         person_id)
+
+        cursor.execute(statement("SELECT id, name from branches",
+                                 self.db.place_holder))
+        for branch_id, name in cursor.fetchall():
+            self.branch_cache.setdefault(self.__key(name), branch_id)
+
+        cursor.execute(statement("SELECT id, name from tags",
+                                 self.db.place_holder))
+        for tag_id, name in cursor.fetchall():
+            self.tags_cache.setdefault(self.__key(name), tag_id)
+        profiler_stop("Loading people, branches and tags for repository %d",
+                      (self.repo_id,), True)
 
     def repository(self, uri):
         cursor = self.cursor
-        cursor.execute(statement("SELECT id from repositories where uri = ?", self.db.place_holder), (uri,))
-        self.repo_id = cursor.fetchone()[0]
+        cursor.execute(statement("SELECT id, type from repositories where uri = ?", self.db.place_holder), (uri,))
+        self.repo_id, self.repo_type = cursor.fetchone()
 
         last_rev = last_commit = None
         query = "SELECT rev, id from scmlog " + \
@@ -101,54 +289,230 @@ class DBContentHandler(ContentHandler):
 
         filename = uri.replace('/', '_')
         self.cache_file = os.path.join(cvsanaly_cache_dir(), filename)
+        self.store_file = self.cache_file + '.db'
+        if self.config.cache_size:
+            cache_file = self.store_file
+        else:
+            cache_file = self.cache_file
 
         # if there's a previous cache file, just use it
-        if os.path.isfile(self.cache_file):
+        msg = None
+        loaded = False
+        if self.__caches_on_disk():
             self.__load_caches_from_disk()
+            loaded = True
 
             if last_rev is not None:
-                try:
-                    commit_id = self.revision_cache[last_rev]
-                except KeyError:
-                    msg = "Cache file %s is not up to date or it's corrupt: " % (self.cache_file) + \
-                          "Revision %s was not found in the cache file" % (last_rev) + \
-                          "It's not possible to continue, the cache " + \
-                          "file should be removed and the database cleaned up"
-                    raise CacheFileMismatch(msg)
-                if commit_id != last_commit:
+                commit_id = self.revision_cache.get(last_rev)
+                if commit_id is None:
+                    msg = "Cache file %s is not up to date or it's corrupt: " % (cache_file) + \
+                          "Revision %s was not found in the cache file." % (last_rev)
+                elif commit_id != last_commit:
                     # Cache and db don't match, removing cache
-                    msg = "Cache file %s is not up to date or it's corrupt: " % (self.cache_file) + \
-                          "Commit id mismatch for revision %s (File Cache:%d, Database: %d). " % (
-                              last_rev, commit_id, last_commit) + \
-                          "It's not possible to continue, the cache " + \
-                          "file should be removed and the database cleaned up"
-                    raise CacheFileMismatch(msg)
+                    msg = "Cache file %s is not up to date or it's corrupt: " % (cache_file) + \
+                          "Commit id mismatch for revision %s (File Cache:%d, Database: %d)." % (
+                              last_rev, commit_id, last_commit)
             else:
                 # Database looks empty (or corrupt) and we have
                 # a cache file. We can just remove it and continue
                 # normally
-                self.__init_caches()
-                os.remove(self.cache_file)
-                printout("Database looks empty, removing cache file %s", (self.cache_file,))
+                self.__remove_caches_from_disk()
+                loaded = False
+                printout("Database looks empty, removing cache file %s", (cache_file,))
         elif last_rev is not None:
             # There are data in the database,
             # but we don't have a cache file!!!
-            msg = "Cache file %s is not up to date or it's corrupt: " % (self.cache_file) + \
-                  "Cache file cannot be found" + \
-                  "It's not possible to continue, the database " + \
-                  "should be cleaned up"
-            raise CacheFileMismatch(msg)
+            msg = "Cache file %s is not up to date or it's corrupt: " % (cache_file) + \
+                  "Cache file cannot be found."
+
+        if msg is not None:
+            if not self.config.rebuild_caches:
+                msg += " It's not possible to continue, the cache file should " + \
+                       "be removed and the database cleaned up, or the cache " + \
+                       "rebuilt from the database with --rebuild-caches"
+                raise CacheFileMismatch(msg)
+
+            printout(msg)
+            self.__remove_caches_from_disk()
+            loaded = False
+
+        if not loaded:
+            self.__open_caches()
+
+        if msg is not None:
+            self.__rebuild_caches()
+
+        self.__load_dimension_caches()
+
+    def __rebuild_caches(self):
+        """Rebuild the caches from the contents of the database.
+           Links are created in the same order actions are processed,
+           so actions are replayed in order, consuming the links
+           created while processing every one of them. Nothing is
+           written to the database, so it's much faster than parsing
+           the log again. Paths only found through the moves cache
+           are not stored in the database, they are guessed from the
+           last path of every file, so the rebuilt caches may differ
+           from the ones the parser would have built. That's why
+           caches are only rebuilt when config.rebuild_caches is set.
+        """
+        printout("Rebuilding caches for %s from the database", (self.cache_file,))
+        profiler_start("Rebuilding caches for repository %d", (self.repo_id,))
+        cursor = self.cursor
+
+        cursor.execute(statement("SELECT rev, id from scmlog where repository_id = ?",
+                                 self.db.place_holder), (self.repo_id,))
+        for rev, commit_id in cursor.fetchall():
+            self.revision_cache[to_utf8(rev)] = commit_id
+
+        query = "SELECT fl.file_id, fl.parent_id, fl.file_path " + \
+                "from file_links fl, files f " + \
+                "where fl.file_id = f.id and f.repository_id = ? order by fl.id"
+        cursor.execute(statement(query, self.db.place_holder), (self.repo_id,))
+        links = [(file_id, parent_id, to_utf8(file_path))
+                 for file_id, parent_id, file_path in cursor.fetchall()]
+
+        query = "SELECT a.id, a.type, a.file_id, a.branch_id " + \
+                "from actions a, scmlog s " + \
+                "where a.commit_id = s.id and s.repository_id = ? order by a.id"
+        cursor.execute(statement(query, self.db.place_holder), (self.repo_id,))
+        actions = cursor.fetchall()
+
+        query = "SELECT fc.action_id, fc.to_id " + \
+                "from file_copies fc, actions a, scmlog s " + \
+                "where fc.action_id = a.id and a.commit_id = s.id and s.repository_id = ?"
+        cursor.execute(statement(query, self.db.place_holder), (self.repo_id,))
+        copies = dict(cursor.fetchall())
+
+        # Position of the link that created every file
+        # and whether repository paths start with /
+        created = {}
+        root = ''
+        for i, (file_id, parent_id, file_path) in enumerate(links):
+            created.setdefault(file_id, i)
+            if file_path.startswith('/'):
+                root = '/'
+
+        def link_path(prefix, file_path):
+            # Links of the paths added by ensure_path are
+            # stored without the leading /
+            if file_path.startswith('/'):
+                return prefix + file_path
+            return prefix + root + file_path
+
+        file_paths = {}
+        pos = 0
+        prefix = None
+        for action_id, action_type, file_id, branch_id in actions:
+            prefix = "%d://" % (branch_id)
+
+            # Link created by the action, if any
+            if action_type in ('A', 'M', 'D'):
+                last = created.get(file_id, -1)
+            elif action_type in ('C', 'R'):
+                last = created.get(copies.get(action_id), -1)
+            else:
+                # The file may be linked first if it was not found
+                last = pos
+                while last < len(links) and \
+                      (links[last][0] != file_id or created[file_id] == last):
+                    last += 1
+            if last < pos or last >= len(links):
+                last = pos - 1
+
+            # Paths added while looking for the path of
+            # the file, its parent or the file copied
+            for file_id_, parent_id, file_path in links[pos:last]:
+                path = link_path(prefix, file_path)
+                self.__add_path_to_file_cache(path, (file_id_, parent_id))
+                file_paths[file_id_] = path
+
+            if last >= pos:
+                new_file_id, parent_id, file_path = links[last]
+                path = link_path(prefix, file_path)
+                if action_type in ('M', 'D'):
+                    # The file itself was not found
+                    self.__add_path_to_file_cache(path, (new_file_id, parent_id))
+                    file_paths[new_file_id] = path
+            else:
+                new_file_id = None
+                path = file_paths.get(file_id)
+                if path is not None:
+                    path = prefix + self.__remove_branch_from_file_path(path)
+                    if path not in self.file_cache:
+                        try:
+                            self.__add_path_to_file_cache(path, self.__get_file_from_moves_cache(path))
+                        except FileNotInCache:
+                            pass
+            pos = last + 1
+
+            if action_type == 'D':
+                if path is not None:
+                    self.__move_tree_to_deletes_cache(path)
+                continue
+            elif action_type == 'M' or new_file_id is None:
+                continue
+
+            if action_type == 'V' and file_id in file_paths:
+                old_path = file_paths[file_id]
+                self.moves_cache[path] = old_path
+
+                # Files under the old path are looked for
+                # under the new one from now on
+                for cpath in self.__get_subtree(old_path):
+                    child_id = self.file_cache[cpath][0]
+                    if file_paths.get(child_id) == cpath:
+                        file_paths[child_id] = path + cpath[len(old_path):]
+            elif action_type == 'R':
+                self.__move_tree_to_deletes_cache(path)
+
+            self.__add_path_to_file_cache(path, (new_file_id, parent_id))
+            file_paths[new_file_id] = path
+
+        # Links created after the last action stored, in
+        # the branch of that action. Without actions there's
+        # no way to know the branch they belong to
+        if prefix is None and pos < len(links):
+            printdbg("DBContentHandler: %d links without actions, not cached",
+                     (len(links) - pos,))
+        elif prefix is not None:
+            for file_id, parent_id, file_path in links[pos:]:
+                self.__add_path_to_file_cache(link_path(prefix, file_path), (file_id, parent_id))
+
+        profiler_stop("Rebuilding caches for repository %d", (self.repo_id,), True)
 
     def __insert_many(self):
-        if not self.actions and not self.commits:
+        if not self.actions and not self.commits and \
+           not self.people and not self.branches and not self.tags and \
+           not self.files and not self.links and not self.copies and \
+           not self.tag_revs and not self.edges:
             return
 
         cursor = self.cursor
 
+        if self.people:
+            self.db.insert_many(cursor, DBPerson.__insert__, self.people)
+            self.people = []
+        if self.branches:
+            self.db.insert_many(cursor, DBBranch.__insert__, self.branches)
+            self.branches = []
+        if self.tags:
+            self.db.insert_many(cursor, DBTag.__insert__, self.tags)
+            self.tags = []
+        if self.files:
+            self.db.insert_many(cursor, DBFile.__insert__, self.files)
+            self.files = []
+        if self.links:
+            self.db.insert_many(cursor, DBFileLink.__insert__, self.links)
+            self.links = []
+        if self.copies:
+            self.db.insert_many(cursor, DBFileCopy.__insert__, self.copies)
+            self.copies = []
         if self.actions:
             actions = [(a.id, a.type, a.file_id, a.commit_id, a.branch_id) for a in self.actions]
             profiler_start("Inserting actions for repository %d", (self.repo_id,))
-            cursor.executemany(statement(DBAction.__insert__, self.db.place_holder), actions)
+            self.db.insert_many(cursor, DBAction.__insert__, actions)
+            self.n_actions += len(actions)
             self.actions = []
             profiler_stop("Inserting actions for repository %d", (self.repo_id,))
         if self.commits:
@@ -156,24 +520,37 @@ class DBContentHandler(ContentHandler):
                 (c.id, c.rev, c.committer, c.author, c.date, c.date_tz, c.author_date, c.author_date_tz, c.message, c.composed_rev, c.repository_id)
                 for c in self.commits]
             profiler_start("Inserting commits for repository %d", (self.repo_id,))
-            cursor.executemany(statement(DBLog.__insert__, self.db.place_holder), commits)
+            self.db.insert_many(cursor, DBLog.__insert__, commits)
+            self.n_commits += len(commits)
             self.commits = []
             profiler_stop("Inserting commits for repository %d", (self.repo_id,))
-
+        if self.tag_revs:
+            self.db.insert_many(cursor, DBTagRev.__insert__, self.tag_revs)
+            self.tag_revs = []
+        if self.edges:
+            self.db.insert_many(cursor, DBGraph.__insert__, self.edges)
+            self.edges = []
+        self.pending_bytes = 0
+
+        # Committing is much more expensive than inserting,
+        # so inserts are committed only from time to time
+        if time.time() - self.commit_time >= self.config.db_commit_interval:
+            self.__commit()
+
+    def __commit(self):
         profiler_start("Committing inserts for repository %d", (self.repo_id,))
         self.cnn.commit()
+        self.commit_time = time.time()
         profiler_stop("Committing inserts for repository %d", (self.repo_id,))
 
     def __add_new_file_and_link(self, file_name, parent_id, commit_id, file_path):
         dbfile = DBFile(None, file_name)
         dbfile.repository_id = self.repo_id
-        self.cursor.execute(statement(DBFile.__insert__, self.db.place_holder),
-                            (dbfile.id, dbfile.file_name, dbfile.repository_id))
+        self.files.append((dbfile.id, dbfile.file_name, dbfile.repository_id))
 
         dblink = DBFileLink(None, parent_id, dbfile.id, file_path)
         dblink.commit_id = commit_id
-        self.cursor.execute(statement(DBFileLink.__insert__, self.db.place_holder),
-                            (dblink.id, dblink.parent, dblink.child, dblink.commit_id, dblink.file_path))
+        self.links.append((dblink.id, dblink.parent, dblink.child, dblink.commit_id, dblink.file_path))
 
         return dbfile.id
 
@@ -181,130 +558,152 @@ class DBContentHandler(ContentHandler):
         return path.split("://", 1)[1]
 
     def __add_new_copy(self, dbfilecopy):
-        self.cursor.execute(statement(DBFileCopy.__insert__, self.db.place_holder),
-                            (dbfilecopy.id, dbfilecopy.to_id, dbfilecopy.from_id,
-                             dbfilecopy.from_commit, dbfilecopy.new_file_name, dbfilecopy.action_id))
+        self.copies.append((dbfilecopy.id, dbfilecopy.to_id, dbfilecopy.from_id,
+                            dbfilecopy.from_commit, dbfilecopy.new_file_name, dbfilecopy.action_id))
+
+    def __key(self, value):
+        """Key of a name or an email in the people, branch and tags
+           caches, equal for the values the database finds equal"""
+        value = to_utf8(value)
+        if value is not None and self.db.case_insensitive:
+            value = unicode(value, 'utf-8').lower().encode('utf-8')
+
+        return value
 
     def __get_person(self, person):
         """Get the person_id given a person struct
-           First, it tries to get it from cache and then from the database.
-           When a new person_id is gotten from the database, the cache must be
-           updated
+           People are preloaded into the cache, so when the person is
+           not in the cache it's a new one. The new person_id is added
+           to the cache and the person is inserted with the next batch
         """
+        key = (self.__key(person.name), self.__key(person.email))
 
-        def ensure_person(person):
-            profiler_start("Ensuring person %s for repository %d",
-                           (person.name, self.repo_id))
-            printdbg("DBContentHandler: ensure_person %s <%s>",
-                     (person.name, person.email))
-            cursor = self.cursor
-
-            name = to_utf8(person.name)
-            email = person.email
-            cursor.execute(statement("SELECT id from people where name = ? and email = ?",
-                                     self.db.place_holder), (name, email))
-            rs = cursor.fetchone()
-            if not rs:
-                p = DBPerson(None, person)
-                cursor.execute(statement(DBPerson.__insert__,
-                                         self.db.place_holder), (p.id, p.name, email))
-                person_id = p.id
-            else:
-                person_id = rs[0]
-
-            profiler_stop("Ensuring person %s for repository %d",
-                          (person.name, self.repo_id), True)
-
-            return person_id
-
-        name, email = to_utf8(person.name), person.email
-
-        if (name, email) in self.people_cache:
-            person_id = self.people_cache[name, email]
+        if key in self.people_cache:
+            person_id = self.people_cache[key]
         else:
-            person_id = ensure_person(person)
-            self.people_cache[name, email] = person_id
+            printdbg("DBContentHandler: new person %s <%s>",
+                     (person.name, person.email))
+            p = DBPerson(None, person)
+            self.people.append((p.id, p.name, person.email))
+            person_id = p.id
+            self.people_cache[key] = person_id
 
         return person_id
 
     def __get_branch(self, branch):
         """Get the branch_id given a branch name.
-           First, it tries to get it from cache and then from the database.
-           When a new branch_id is gotten from the database, the cache must be
-           updated
+           Branches are preloaded into the cache, so when the branch is
+           not in the cache it's a new one. The new branch_id is added
+           to the cache and the branch is inserted with the next batch
         """
-
-        def ensure_branch(branch):
-            profiler_start("Ensuring branch %s for repository %d",
-                           (branch, self.repo_id))
-            printdbg("DBContentHandler: ensure_branch %s", (branch,))
-            cursor = self.cursor
-
-            cursor.execute(statement("SELECT id from branches where name = ?",
-                                     self.db.place_holder), (branch,))
-            rs = cursor.fetchone()
-            if not rs:
-                b = DBBranch(None, branch)
-                cursor.execute(statement(DBBranch.__insert__,
-                                         self.db.place_holder), (b.id, b.name))
-                branch_id = b.id
-            else:
-                branch_id = rs[0]
-
-            profiler_stop("Ensuring branch %s for repository %d",
-                          (branch, self.repo_id), True)
-
-            return branch_id
-
-        if branch in self.branch_cache:
-            branch_id = self.branch_cache[branch]
+        key = self.__key(branch)
+        if key in self.branch_cache:
+            branch_id = self.branch_cache[key]
         else:
-            branch_id = ensure_branch(branch)
-            self.branch_cache[branch] = branch_id
+            printdbg("DBContentHandler: new branch %s", (branch,))
+            b = DBBranch(None, branch)
+            self.branches.append((b.id, b.name))
+            branch_id = b.id
+            self.branch_cache[key] = branch_id
 
         return branch_id
 
     def __get_tag(self, tag):
         """Get the tag_id given a tag name.
-           First, it tries to get it from cache and then from the database.
-           When a new tag_id is gotten from the database, the cache must be
-           updated
+           Tags are preloaded into the cache, so when the tag is
+           not in the cache it's a new one. The new tag_id is added
+           to the cache and the tag is inserted with the next batch
         """
+        key = self.__key(tag)
+        if key in self.tags_cache:
+            tag_id = self.tags_cache[key]
+        else:
+            printdbg("DBContentHandler: new tag %s", (tag,))
+            t = DBTag(None, tag)
+            self.tags.append((t.id, t.name))
+            tag_id = t.id
+            self.tags_cache[key] = tag_id
 
-        def ensure_tag(tag):
-            profiler_start("Ensuring tag %s for repository %d",
-                           (tag, self.repo_id))
-            printdbg("DBContentHandler: ensure_tag %s", (tag,))
-            cursor = self.cursor
-
-            cursor.execute(statement("SELECT id from tags where name = ?",
-                                     self.db.place_holder), (tag,))
-            rs = cursor.fetchone()
-            if not rs:
-                t = DBTag(None, tag)
-                cursor.execute(statement(DBTag.__insert__,
-                                         self.db.place_holder), (t.id, t.name))
-                tag_id = t.id
-            else:
-                tag_id = rs[0]
+        return tag_id
 
-            profiler_stop("Ensuring tag %s for repository %d", (tag, self.repo_id), True)
+    def __get_parent_path(self, path):
+        root = path[:path.find("://") + 3]
+        pos = path.rfind('/')
+        if pos < len(root):
+            return root
 
-            return tag_id
+        return path[:pos]
 
-        if tag in self.tags_cache:
-            tag_id = self.tags_cache[tag]
-        else:
-            tag_id = ensure_tag(tag)
-            self.tags_cache[tag] = tag_id
+    def __index_path(self, path):
+        if self.file_cache_children is None:
+            return
 
-        return tag_id
+        child = path
+        parent = self.__get_parent_path(child)
+        while child != parent:
+            children = self.file_cache_children.get(parent)
+            if children is not None:
+                children.add(child)
+                break
+
+            self.file_cache_children[parent] = set([child])
+            child = parent
+            parent = self.__get_parent_path(child)
+
+    def __add_path_to_file_cache(self, path, ids):
+        self.file_cache[path] = ids
+        self.__index_path(path)
+
+    def __get_subtree(self, path):
+        """Return the paths under path in file_cache, found
+           through the file_cache_children index or through the
+           sorted keys of the store when caches are on disk.
+        """
+        dirpath = path.rstrip("/")
+        if self.file_cache_children is None:
+            return self.file_cache.keys_with_prefix(dirpath + "/")
+
+        paths = []
+        pending = [dirpath]
+        while pending:
+            children = self.file_cache_children.get(pending.pop(), ())
+            paths.extend([child for child in children if child in self.file_cache])
+            pending.extend(children)
+
+        return paths
 
     def __move_path_to_deletes_cache(self, path):
         if path in self.file_cache:
             self.deletes_cache[path] = self.file_cache[path]
             del (self.file_cache[path])
 
+    def __move_tree_to_deletes_cache(self, path):
+        """Move path and all the paths under it from file_cache
+           to deletes_cache. Only the subtree of path is visited,
+           thanks to the file_cache_children index or to the
+           sorted keys of the store when caches are on disk.
+        """
+        self.__move_path_to_deletes_cache(path)
+
+        dirpath = path.rstrip("/")
+        if self.file_cache_children is None:
+            # Caches on disk, get the subtree from the store
+            for cpath in self.file_cache.keys_with_prefix(dirpath + "/"):
+                self.__move_path_to_deletes_cache(cpath)
+            return
+
+        pending = [dirpath]
+        while pending:
+            children = self.file_cache_children.pop(pending.pop(), ())
+            for child in children:
+                self.__move_path_to_deletes_cache(child)
+            pending.extend(children)
+
+        if dirpath not in self.file_cache:
+            children = self.file_cache_children.get(self.__get_parent_path(dirpath))
+            if children is not None:
+                children.discard(dirpath)
+
     def __get_file_from_moves_cache(self, path):
         # Path is not in the cache, but it should
         # Look if any of its parents was moved
@@ -346,11 +745,12 @@ class DBContentHandler(ContentHandler):
             node_id = None
             for i, token in enumerate(tokens):
                 file_path = '/'.join(tokens[:i + 1])
-                rpath = prefix + '/' + file_path
-                if not ":///" in path:
+                if ":///" in path:
+                    rpath = prefix + '/' + file_path
+                else:
                     # If the repo paths don't start with /
-                    # remove it here
-                    rpath = rpath.replace(':///', '://')
+                    # don't add it here
+                    rpath = prefix + file_path
                 printdbg("DBContentHandler: rpath: %s", (rpath,))
                 try:
                     node_id, parent_id = self.file_cache[rpath]
@@ -364,7 +764,7 @@ class DBContentHandler(ContentHandler):
                 parent_id = parent
                 parent = node_id
 
-                self.file_cache[rpath] = (node_id, parent_id)
+                self.__add_path_to_file_cache(rpath, (node_id, parent_id))
 
             assert node_id is not None
 
@@ -384,7 +784,7 @@ class DBContentHandler(ContentHandler):
         try:
             retval = self.__get_file_from_moves_cache(path)
             printdbg("DBContentHandler: Found %s in moves cache", (path,))
-            self.file_cache[path] = retval
+            self.__add_path_to_file_cache(path, retval)
             return retval
         except FileNotInCache:
             pass
@@ -411,7 +811,7 @@ class DBContentHandler(ContentHandler):
             parent_id = self.__get_file_for_path(parent_path, log.id, False)[0]
 
         file_id = self.__add_new_file_and_link(file_name, parent_id, log.id, self.__remove_branch_from_file_path(path))
-        self.file_cache[path] = (file_id, parent_id)
+        self.__add_path_to_file_cache(path, (file_id, parent_id))
 
         return file_id
 
@@ -420,11 +820,7 @@ class DBContentHandler(ContentHandler):
         file_id = self.__get_file_for_path(path, log.id)[0]
 
         # Remove the old references
-        dirpath = path.rstrip("/") + "/"
-        for cpath in self.file_cache.keys():
-            if cpath.startswith(dirpath):
-                self.__move_path_to_deletes_cache(cpath)
-        self.__move_path_to_deletes_cache(path)
+        self.__move_tree_to_deletes_cache(path)
 
         return file_id
 
@@ -455,12 +851,11 @@ class DBContentHandler(ContentHandler):
         parent_id = new_parent_id
         dblink = DBFileLink(None, parent_id, file_id, self.__remove_branch_from_file_path(path))
         dblink.commit_id = log.id
-        self.cursor.execute(statement(DBFileLink.__insert__, self.db.place_holder),
-                            (dblink.id, dblink.parent, dblink.child,
-                             dblink.commit_id, dblink.file_path))
+        self.links.append((dblink.id, dblink.parent, dblink.child,
+                           dblink.commit_id, dblink.file_path))
         self.moves_cache[path] = old_path
 
-        self.file_cache[path] = (file_id, parent_id)
+        self.__add_path_to_file_cache(path, (file_id, parent_id))
 
         # Move/rename is a special case of copy.  # There's not a
         # new file_id
@@ -503,7 +898,7 @@ class DBContentHandler(ContentHandler):
             parent_id = self.__get_file_for_path(parent_path, log.id)[0]
 
         file_id = self.__add_new_file_and_link(file_name, parent_id, log.id, self.__remove_branch_from_file_path(path))
-        self.file_cache[path] = (file_id, parent_id)
+        self.__add_path_to_file_cache(path, (file_id, parent_id))
 
         dbfilecopy = DBFileCopy(None, file_id)
         dbfilecopy.from_id = from_file_id
@@ -549,17 +944,13 @@ class DBContentHandler(ContentHandler):
             from_commit_id = None
             from_file_id = file_id
 
-        self.__move_path_to_deletes_cache(path)
         # Remove the old references
-        dirpath = path.rstrip("/") + "/"
-        for cpath in self.file_cache.keys():
-            if cpath.startswith(dirpath):
-                self.__move_path_to_deletes_cache(cpath)
+        self.__move_tree_to_deletes_cache(path)
 
         # Add the new path
         new_file_id = self.__add_new_file_and_link(file_name, parent_id, log.id,
                                                    self.__remove_branch_from_file_path(path))
-        self.file_cache[path] = (new_file_id, parent_id)
+        self.__add_path_to_file_cache(path, (new_file_id, parent_id))
 
         # Register the action in the copies table in order to
         # be able to know which file replaced this file
@@ -589,6 +980,7 @@ class DBContentHandler(ContentHandler):
             log.author = self.__get_person(commit.author)
 
         self.commits.append(log)
+        self.pending_bytes += len(log.message or '')
 
         printdbg("DBContentHandler: commit: %d rev: %s", (log.id, log.rev))
 
@@ -630,27 +1022,23 @@ class DBContentHandler(ContentHandler):
 
             dbaction.file_id = file_id
             self.actions.append(dbaction)
+            self.pending_bytes += len(action.f1)
 
         # Tags
         if commit.tags is not None:
-            tag_revs = []
             for tag in commit.tags:
                 tag_id = self.__get_tag(tag)
                 db_tagrev = DBTagRev(None)
-                tag_revs.append((db_tagrev.id, tag_id, log.id))
+                self.tag_revs.append((db_tagrev.id, tag_id, log.id))
 
-            self.cursor.executemany(statement(DBTagRev.__insert__, self.db.place_holder), tag_revs)
-            
         # Commit Graph
-        if len(commit.parents) > 0:
-            edges = []
-            for p in commit.parents:
-                edges.append((log.id, self.revision_cache[p]))
-                
-            self.cursor.executemany(statement(DBGraph.__insert__, self.db.place_holder), edges)
-
-        if len(self.actions) >= self.MAX_ACTIONS:
-            printdbg("DBContentHandler: %d actions inserting", (len(self.actions),))
+        for p in commit.parents:
+            self.edges.append((log.id, self.revision_cache[p]))
+
+        if len(self.actions) + len(self.commits) >= self.config.db_flush_rows or \
+           self.pending_bytes >= self.config.db_flush_bytes:
+            printdbg("DBContentHandler: %d actions and %d commits inserting",
+                     (len(self.actions), len(self.commits)))
             self.__insert_many()
 
         profiler_stop("New commit %s for repository %d", (commit.revision, self.repo_id), True)
@@ -659,6 +1047,12 @@ class DBContentHandler(ContentHandler):
         # flush pending inserts
         printdbg("DBContentHandler: flushing pending inserts")
         self.__insert_many()
+        self.__commit()
+
+        elapsed = time.time() - self.start_time
+        if self.n_commits and elapsed > 0:
+            printout("Inserted %d commits and %d actions in %.2f seconds (%.1f commits/s)",
+                     (self.n_commits, self.n_actions, elapsed, self.n_commits / elapsed))
 
         # Save the caches to disk
         profiler_start("Saving caches to disk")
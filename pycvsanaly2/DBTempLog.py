@@ -128,9 +128,8 @@ class DBTempLog:
             del commit
 
             if n_commits == 50:
-                cursor.executemany(
-                    statement("INSERT into _temp_log (rev, date, object) values (?, ?, ?)", self.db.place_holder),
-                    commits)
+                self.db.insert_many(cursor, "INSERT into _temp_log (rev, date, object) values (?, ?, ?)",
+                                    commits)
                 cnn.commit()
                 del commits
                 commits = []
@@ -139,8 +138,8 @@ class DBTempLog:
             queue.done()
 
         if commits:
-            cursor.executemany(
-                statement("INSERT into _temp_log (rev, date, object) values (?, ?, ?)", self.db.place_holder), commits)
+            self.db.insert_many(cursor, "INSERT into _temp_log (rev, date, object) values (?, ?, ?)",
+                                commits)
             cnn.commit()
             del commits
 
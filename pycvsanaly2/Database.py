@@ -17,7 +17,12 @@
 # Authors :
 #       Carlos Garcia Campos <carlosgc@gsyc.escet.urjc.es>
 
-from utils import to_unicode, printdbg
+import re
+import time
+import thread
+import threading
+
+from utils import to_unicode, printdbg, printout, printerr
 
 
 class DBRepository:
@@ -281,21 +286,114 @@ class TableAlreadyExists(DatabaseException):
     '''Table alredy exists in database'''
 
 
+class StatementRegistry:
+    """Queries converted for the place holder of every driver.
+       Every query is converted only once, and the same string is
+       returned for it, so drivers can reuse prepared statements.
+       When it's enabled, it also counts how many times every
+       statement is run by the cursors of the pooled connections
+       and the time spent running it.
+    """
+
+    # Queries built with values should not be registered,
+    # but don't let the registry grow forever anyway
+    MAX_STATEMENTS = 10000
+
+    def __init__(self):
+        self.statements = {}
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.times = {}
+
+    def __convert(self, query, ph_mark):
+        if "?" == ph_mark or "?" not in query:
+            return query
+
+        tokens = query.split("'")
+        for i in range(0, len(tokens), 2):
+            tokens[i] = tokens[i].replace("?", ph_mark)
+
+        return "'".join(tokens)
+
+    def get(self, query, ph_mark):
+        try:
+            return self.statements[query, ph_mark]
+        except KeyError:
+            retval = self.__convert(query, ph_mark)
+            if len(self.statements) < self.MAX_STATEMENTS:
+                self.statements[query, ph_mark] = retval
+
+            return retval
+
+    def record(self, query, elapsed):
+        """Count a run of query, which took elapsed seconds"""
+        self.lock.acquire()
+        try:
+            if query in self.counts:
+                self.counts[query] += 1
+                self.times[query] += elapsed
+            elif len(self.counts) < self.MAX_STATEMENTS:
+                self.counts[query] = 1
+                self.times[query] = elapsed
+        finally:
+            self.lock.release()
+
+    def print_stats(self, n=20):
+        """Print the statements run more times,
+           with the time spent running them"""
+        self.lock.acquire()
+        counts = self.counts.items()
+        self.lock.release()
+
+        for count, query in sorted([(count, query) for query, count in counts],
+                                   reverse=True)[:n]:
+            printout("[ %d times, %f s ] %s", (count, self.times[query], ' '.join(query.split())[:200]))
+
+
+statements = StatementRegistry()
+
+
 def statement(str, ph_mark):
-    if "?" == ph_mark or "?" not in str:
-        printdbg(str)
-        return str
+    return statements.get(str, ph_mark)
 
-    tokens = str.split("'")
-    for i in range(0, len(tokens), 2):
-        tokens[i] = tokens[i].replace("?", ph_mark)
 
-    retval = "'".join(tokens)
-    printdbg(retval)
+_insert_re = re.compile(r"^(.*\svalues)\s*(\(.*\))\s*$", re.I | re.S)
+_inserts = {}
+
+
+def _split_insert(query):
+    """Split a single row INSERT statement into the part before
+       the row and the row, returning also the number of params"""
+    try:
+        return _inserts[query]
+    except KeyError:
+        pass
+
+    m = _insert_re.match(query)
+    if m is None:
+        raise ValueError("Not a single row INSERT statement: %s" % (query))
+    head, row = m.groups()
+    retval = _inserts[query] = (head, row, row.count("?") + row.count("%s"))
 
     return retval
 
 
+def _row_size(row):
+    size = 0
+    for value in row:
+        if isinstance(value, unicode):
+            # Sent encoded to the server
+            value = value.encode('utf-8')
+        if isinstance(value, (str, buffer)):
+            # Strings might be escaped
+            size += 2 * len(value) + 2
+        else:
+            size += 8
+
+    return size
+
+
 class ICursor:
     def __init__(self, cursor, size=100):
         self.cursor = cursor
@@ -337,17 +435,316 @@ class ICursor:
         self.cursor.close()
 
 
+class StatementCursor:
+    """Cursor recording the statements it runs in the registry"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __run(self, method, query, args):
+        start = time.time()
+        retval = method(query, *args)
+        statements.record(query, time.time() - start)
+
+        # SQLite cursors return themselves
+        if retval is self._cursor:
+            return self
+
+        return retval
+
+    def execute(self, query, *args):
+        return self.__run(self._cursor.execute, query, args)
+
+    def executemany(self, query, *args):
+        return self.__run(self._cursor.executemany, query, args)
+
+
+class PooledConnection:
+    """Connection checked out from a ConnectionPool.
+       Closing it gives it back to the pool."""
+
+    def __init__(self, pool, cnn, owner, generation):
+        self._pool = pool
+        self._cnn = cnn
+        self._owner = owner
+        self._generation = generation
+
+    def __getattr__(self, name):
+        return getattr(self._cnn, name)
+
+    def cursor(self, *args):
+        cursor = self._cnn.cursor(*args)
+        if statements.enabled:
+            return StatementCursor(cursor)
+
+        return cursor
+
+    def close(self):
+        if self._cnn is not None:
+            self._pool.put(self._cnn, self._owner, self._generation)
+            self._cnn = None
+
+
+class ConnectionPool:
+    """Pool of connections to a database.
+
+    Connections are checked out with get() and given back to the pool
+    by closing them. With thread_affinity, connections are only given
+    to the thread that created them, as SQLite requires. Connections
+    idle for more than check_interval seconds are checked with check
+    before giving them again, and replaced when they are broken.
+
+    Idle connections are closed by clear() and once the thread that
+    created them has finished, from any thread, so connections must
+    allow it.
+    """
+
+    max_idle = 4
+    check_interval = 30
+
+    def __init__(self, connect, check=None, thread_affinity=False):
+        self.connect = connect
+        self.check = check
+        self.thread_affinity = thread_affinity
+
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.generation = 0
+
+    def __key(self):
+        if self.thread_affinity:
+            return thread.get_ident()
+
+        return None
+
+    def __remove_finished_threads(self):
+        """Remove the idle connections of the threads that
+           are not running anymore and return them"""
+        if not self.thread_affinity:
+            return []
+
+        running = set([t.ident for t in threading.enumerate()])
+        retval = []
+        for key in self.idle.keys():
+            if key not in running:
+                retval.extend([cnn for cnn, since in self.idle.pop(key)])
+
+        return retval
+
+    def __close(self, connections):
+        for cnn in connections:
+            try:
+                cnn.close()
+            except Exception, e:
+                printdbg("ConnectionPool: error closing connection: %s", (str(e),))
+
+    def get(self):
+        key = self.__key()
+        cnn = None
+        self.lock.acquire()
+        try:
+            idle = self.idle.get(key)
+            if idle:
+                cnn, since = idle.pop()
+        finally:
+            self.lock.release()
+
+        if cnn is not None and self.check is not None and \
+           time.time() - since > self.check_interval and not self.check(cnn):
+            printdbg("ConnectionPool: replacing broken connection")
+            cnn = None
+
+        if cnn is None:
+            cnn = self.connect()
+
+        return PooledConnection(self, cnn, key, self.generation)
+
+    def put(self, cnn, owner, generation):
+        """Give back cnn, created by the thread owner"""
+        try:
+            # Uncommitted changes are discarded,
+            # like when the connection is closed
+            cnn.rollback()
+        except Exception:
+            self.__close([cnn])
+            return
+
+        unused = [cnn]
+        self.lock.acquire()
+        try:
+            if generation == self.generation:
+                if owner not in self.idle:
+                    unused.extend(self.__remove_finished_threads())
+
+                idle = self.idle.setdefault(owner, [])
+                if len(idle) < self.max_idle:
+                    idle.append((cnn, time.time()))
+                    unused.remove(cnn)
+        finally:
+            self.lock.release()
+
+        self.__close(unused)
+
+    def clear(self):
+        """Close the idle connections and don't give
+           again any of the connections created so far"""
+        self.lock.acquire()
+        try:
+            idle = self.idle
+            self.idle = {}
+            self.generation += 1
+        finally:
+            self.lock.release()
+
+        self.__close([cnn for connections in idle.values() for cnn, since in connections])
+
+
 class Database:
     '''CVSAnaly Database'''
 
     place_holder = "?"
 
+    # Whether the database is being filled from scratch,
+    # trading durability for speed when supported
+    bulk_load = False
+
+    # Limits of the statements built by insert_many. Bigger
+    # statements are not faster and take more memory
+    max_params = 999
+    max_rows = 100
+    max_packet = 1048576
+
+    # Whether connections can only be used by the thread creating them
+    thread_affinity = False
+
+    # Whether text columns are compared ignoring case
+    case_insensitive = False
+
+    # Secondary indexes for the queries run on the stored log
+    # (extensions, views, db/Queries.md), as (name, table, columns).
+    # They are not part of the schema, since they only slow down
+    # the import
+    analysis_indexes = [("actions_commit_id", "actions", "commit_id"),
+                        ("actions_file_id", "actions", "file_id"),
+                        ("file_copies_action_id", "file_copies", "action_id"),
+                        ("file_links_file_commit", "file_links", "file_id, commit_id"),
+                        ("scmlog_repository_id", "scmlog", "repository_id"),
+                        ("scmlog_date", "scmlog", "date")]
+
     def __init__(self, database):
         self.database = database
+        self.pool = ConnectionPool(self._connect, self._check_connection,
+                                   self.thread_affinity)
 
     def connect(self):
+        """Get a connection from the pool of connections.
+           Closing it gives it back to the pool."""
+        return self.pool.get()
+
+    def _connect(self):
         raise NotImplementedError
 
+    def _check_connection(self, cnn):
+        return True
+
+    def execute(self, cursor, query, args=None):
+        """Run query, written with ? place holders, in cursor"""
+        query = statement(query, self.place_holder)
+        if args is None:
+            cursor.execute(query)
+        else:
+            cursor.execute(query, args)
+
+    def insert_many(self, cursor, query, rows):
+        """Insert the given rows using statements with several rows
+           in their VALUES clause. query is a single row INSERT
+           statement, like the __insert__ ones, and every statement
+           is kept under the parameters and size limits of the driver.
+        """
+        if not rows:
+            return
+
+        head, row, n_params = _split_insert(query)
+        rows_per_statement = max(1, min(self.max_rows, self.max_params // max(1, n_params)))
+
+        i = 0
+        while i < len(rows):
+            if self.max_packet is None:
+                chunk = rows[i:i + rows_per_statement]
+            else:
+                chunk = []
+                size = 0
+                for r in rows[i:i + rows_per_statement]:
+                    size += _row_size(r)
+                    if chunk and size > self.max_packet:
+                        break
+                    chunk.append(r)
+            i += len(chunk)
+
+            args = [value for r in chunk for value in r]
+            self.execute(cursor, head + " " + ", ".join([row] * len(chunk)), args)
+
+    def drop_indexes(self, cursor):
+        pass
+
+    def begin_bulk_load(self, cursor):
+        """Start filling a new database"""
+        # Connections are configured when they are created
+        self.bulk_load = True
+        self.pool.clear()
+        self.drop_indexes(cursor)
+
+    def end_bulk_load(self, cursor):
+        self.bulk_load = False
+        self.pool.clear()
+
+    def get_indexes(self, cursor, table):
+        """Return the names of the indexes of table"""
+        raise NotImplementedError
+
+    def _drop_index(self, cursor, name, table):
+        raise NotImplementedError
+
+    def missing_analysis_indexes(self, cursor):
+        missing = []
+        indexes = {}
+        for name, table, columns in self.analysis_indexes:
+            if table not in indexes:
+                indexes[table] = self.get_indexes(cursor, table)
+            if name not in indexes[table]:
+                missing.append((name, table, columns))
+
+        return missing
+
+    def create_analysis_indexes(self, cursor):
+        """Create the analysis indexes that don't exist yet,
+           returning the names of the ones created"""
+        created = []
+        for name, table, columns in self.missing_analysis_indexes(cursor):
+            printdbg("Creating index %s on %s(%s)", (name, table, columns))
+            cursor.execute("CREATE index %s on %s(%s)" % (name, table, columns))
+            created.append(name)
+
+        return created
+
+    def drop_analysis_indexes(self, cursor):
+        """Drop the existing analysis indexes,
+           returning the names of the ones dropped"""
+        missing = [name for name, table, columns in self.missing_analysis_indexes(cursor)]
+        dropped = []
+        for name, table, columns in self.analysis_indexes:
+            if name not in missing:
+                self._drop_index(cursor, name, table)
+                dropped.append(name)
+
+        return dropped
+
     def _create_views(self, cursor):
         view = """CREATE VIEW action_files AS
                   SELECT a.file_id as file_id, a.id as action_id,
@@ -367,16 +764,85 @@ class Database:
 
 
 class SqliteDatabase(Database):
+    thread_affinity = True
+
+    # Seconds waiting for the database to be unlocked
+    busy_timeout = 600
+
+    indexes = [("files_file_name", "CREATE index files_file_name on files(file_name)"),
+               ("commit_id", "CREATE index commit_id on commit_graph(commit_id)"),
+               ("parent_id", "CREATE index parent_id on commit_graph(parent_id)")]
+
     def __init__(self, database):
         Database.__init__(self, database)
 
-    def connect(self):
+        import sqlite3
+
+        # Params are not part of the statement, so there's no
+        # size limit, and many more are allowed since SQLite 3.32
+        self.max_packet = None
+        if sqlite3.sqlite_version_info >= (3, 32, 0):
+            self.max_params = 32766
+        elif sqlite3.sqlite_version_info < (3, 7, 11):
+            # Multi-row VALUES clauses are not supported
+            self.max_rows = 1
+
+    def _connect(self):
         import sqlite3 as db
 
-        connection = db.connect(self.database)
+        # Keep prepared the multi-row inserts of every size.
+        # Extensions running at the same time wait for
+        # each other to write. Connections are only used by the
+        # thread creating them, but the pool can close them from
+        # any other thread
+        connection = db.connect(self.database, timeout=self.busy_timeout,
+                                cached_statements=256, check_same_thread=False)
         connection.text_factory = str
+        if self.bulk_load:
+            # A failed import has to be started again
+            # anyway, so don't wait for the disk
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = OFF")
+            connection.execute("PRAGMA cache_size = -262144")
+            connection.execute("PRAGMA mmap_size = 1073741824")
         return connection
 
+    def drop_indexes(self, cursor):
+        for name, query in self.indexes:
+            cursor.execute("DROP index IF EXISTS %s" % (name))
+
+    def get_indexes(self, cursor, table):
+        cursor.execute("SELECT name from sqlite_master where type = 'index' and tbl_name = ?", (table,))
+        return [name for name, in cursor.fetchall()]
+
+    def _drop_index(self, cursor, name, table):
+        cursor.execute("DROP index %s" % (name))
+
+    def __create_indexes(self, cursor):
+        cursor.execute("SELECT name from sqlite_master where type = 'index'")
+        existing = [name for name, in cursor.fetchall()]
+        for name, query in self.indexes:
+            if name not in existing:
+                cursor.execute(query)
+
+    def end_bulk_load(self, cursor):
+        """Create the indexes dropped while importing and go
+           back to the default journal. The journal can't be
+           changed while other connections are open, so the
+           idle ones are closed first"""
+        import sqlite3
+
+        Database.end_bulk_load(self, cursor)
+        self.__create_indexes(cursor)
+        try:
+            cursor.execute("PRAGMA journal_mode = DELETE")
+            mode = cursor.fetchone()[0]
+        except sqlite3.OperationalError:
+            mode = "wal"
+        if mode.lower() != "delete":
+            printerr("Database %s is still using the %s journal, " +
+                     "other connections to it are open", (self.database, mode))
+
     def _create_views(self, cursor):
         Database._create_views(self, cursor)
         view = "create view actions_file_names as " + \
@@ -458,9 +924,7 @@ class SqliteDatabase(Database):
                            "commit_id integer," +
                            "parent_id integer" +
                            ")")
-            cursor.execute("CREATE index files_file_name on files(file_name)")
-            cursor.execute("CREATE index commit_id on commit_graph(commit_id)")
-            cursor.execute("CREATE index parent_id on commit_graph(parent_id)")
+            self.__create_indexes(cursor)
             self._create_views(cursor)
         except sqlite3.OperationalError:
             raise TableAlreadyExists
@@ -476,6 +940,12 @@ class SqliteDatabase(Database):
 class MysqlDatabase(Database):
     place_holder = "%s"
 
+    # Tables use the default utf8_general_ci collation
+    case_insensitive = True
+
+    # max_allowed_packet is 1MB by default in old servers
+    max_params = 65535
+
     def __init__(self, database, username, password, hostname):
         Database.__init__(self, database)
 
@@ -485,7 +955,7 @@ class MysqlDatabase(Database):
 
         self.db = None
 
-    def connect(self):
+    def _connect(self):
         import MySQLdb
         import _mysql_exceptions
 
@@ -504,6 +974,27 @@ class MysqlDatabase(Database):
         except:
             raise
 
+    def _check_connection(self, cnn):
+        try:
+            cnn.ping()
+        except Exception:
+            return False
+
+        return True
+
+    def get_indexes(self, cursor, table):
+        cursor.execute("SHOW index FROM %s" % (table))
+        # Indexes on several columns have a row per column
+        names = []
+        for row in cursor.fetchall():
+            if row[2] not in names:
+                names.append(row[2])
+
+        return names
+
+    def _drop_index(self, cursor, name, table):
+        cursor.execute("DROP index %s on %s" % (name, table))
+
     def _create_views(self, cursor):
         Database._create_views(self, cursor)
         view = "create view actions_file_names as " + \
@@ -0,0 +1,229 @@
+# Copyright (C) 2014 LibreSoft
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Dictionaries stored in a local SQLite file with an in-memory LRU
+front, used for caches that are too big to be loaded and saved at once."""
+
+import sqlite3
+from UserDict import DictMixin
+from collections import deque
+from cPickle import dumps, loads
+
+from utils import printdbg
+
+# Keys are stored only once, in the primary key,
+# when the table doesn't have a rowid
+if sqlite3.sqlite_version_info >= (3, 8, 2):
+    WITHOUT_ROWID = " WITHOUT ROWID"
+else:
+    WITHOUT_ROWID = ""
+
+
+class DiskCache(DictMixin):
+    """Dictionary whose items are stored in a table of a DiskCacheStore.
+
+    At most maxsize items are kept in memory (all of them if maxsize
+    is None), the least recently used ones are dropped from memory when
+    the limit is reached. Keys must be strings, values can be any
+    picklable object. Every change is written to the store, but it's
+    not saved until the store is committed.
+    """
+
+    def __init__(self, cnn, name, maxsize, preload=False):
+        self.cnn = cnn
+        self.name = name
+        self.maxsize = maxsize
+        # Items in memory, and when every key in it was last
+        # used. The keys are queued every time they are used,
+        # the ones used again later are skipped when evicting
+        self.lru = {}
+        self.used = {}
+        self.queue = deque()
+        self.clock = 0
+        # When all the items are in memory, the table
+        # only needs to be read for subtree lookups
+        self.complete = False
+
+        self.cursor = cnn.cursor()
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS %s (" % (name) +
+                            "key text primary key," +
+                            "value blob" +
+                            ")" + WITHOUT_ROWID)
+
+        self.__select = "SELECT value from %s where key = ?" % (name)
+        self.__insert = "INSERT OR REPLACE INTO %s (key, value) values (?, ?)" % (name)
+        self.__delete = "DELETE FROM %s where key = ?" % (name)
+
+        if preload and maxsize is None:
+            for key, value in self.iteritems():
+                self.lru[key] = value
+            self.complete = True
+
+    def __touch(self, key):
+        if self.maxsize is None:
+            return
+
+        self.clock += 1
+        self.used[key] = self.clock
+        self.queue.append((self.clock, key))
+        if len(self.queue) > 2 * len(self.used) + 16:
+            self.queue = deque([(clock, key) for clock, key in self.queue
+                                if self.used.get(key) == clock])
+
+    def __forget(self, key):
+        self.lru.pop(key, None)
+        self.used.pop(key, None)
+
+    def __remember(self, key, value):
+        self.lru[key] = value
+        self.__touch(key)
+        if self.maxsize is not None and len(self.lru) > self.maxsize:
+            while True:
+                clock, key = self.queue.popleft()
+                if self.used.get(key) == clock:
+                    self.__forget(key)
+                    break
+
+    def __getitem__(self, key):
+        try:
+            value = self.lru[key]
+            self.__touch(key)
+            return value
+        except KeyError:
+            if self.complete:
+                raise
+
+        self.cursor.execute(self.__select, (key,))
+        rs = self.cursor.fetchone()
+        if rs is None:
+            raise KeyError(key)
+
+        value = loads(str(rs[0]))
+        self.__remember(key, value)
+
+        return value
+
+    def __setitem__(self, key, value):
+        self.__remember(key, value)
+        self.cursor.execute(self.__insert,
+                            (key, sqlite3.Binary(dumps(value, -1))))
+
+    def __delitem__(self, key):
+        self.__forget(key)
+        self.cursor.execute(self.__delete, (key,))
+        if self.cursor.rowcount == 0:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+
+        return True
+
+    has_key = __contains__
+
+    def __iter__(self):
+        if self.complete:
+            for key in self.lru.keys():
+                yield key
+            return
+
+        cursor = self.cnn.cursor()
+        cursor.execute("SELECT key from %s" % (self.name))
+        for key, in cursor:
+            yield key
+        cursor.close()
+
+    iterkeys = __iter__
+
+    def __len__(self):
+        if self.complete:
+            return len(self.lru)
+
+        self.cursor.execute("SELECT count(*) from %s" % (self.name))
+        return self.cursor.fetchone()[0]
+
+    def keys(self):
+        return list(self)
+
+    def iteritems(self):
+        cursor = self.cnn.cursor()
+        cursor.execute("SELECT key, value from %s" % (self.name))
+        for key, value in cursor:
+            yield key, loads(str(value))
+        cursor.close()
+
+    def keys_with_prefix(self, prefix):
+        """Return the keys starting with prefix, using the index
+           of the table instead of visiting every key
+        """
+        if not prefix:
+            return self.keys()
+
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        self.cursor.execute("SELECT key from %s " % (self.name) +
+                            "where key >= ? and key < ?", (prefix, upper))
+        return [key for key, in self.cursor.fetchall()]
+
+    def update(self, other):
+        for key, value in other.iteritems():
+            self[key] = value
+
+
+class DiskCacheStore:
+    """SQLite file holding a set of DiskCache tables and
+       pickled objects"""
+
+    def __init__(self, path):
+        printdbg("DiskCacheStore: opening %s", (path,))
+        self.path = path
+        self.cnn = sqlite3.connect(path)
+        self.cnn.text_factory = str
+
+        cursor = self.cnn.cursor()
+        cursor.execute("CREATE TABLE IF NOT EXISTS objects (" +
+                       "name text primary key," +
+                       "value blob" +
+                       ")")
+        cursor.close()
+
+    def get_cache(self, name, maxsize, preload=False):
+        return DiskCache(self.cnn, name, maxsize, preload)
+
+    def get_object(self, name, default=None):
+        cursor = self.cnn.cursor()
+        cursor.execute("SELECT value from objects where name = ?", (name,))
+        rs = cursor.fetchone()
+        cursor.close()
+        if rs is None:
+            return default
+
+        return loads(str(rs[0]))
+
+    def set_object(self, name, obj):
+        cursor = self.cnn.cursor()
+        cursor.execute("INSERT OR REPLACE INTO objects (name, value) values (?, ?)",
+                       (name, sqlite3.Binary(dumps(obj, -1))))
+        cursor.close()
+
+    def commit(self):
+        self.cnn.commit()
+
+    def close(self):
+        self.cnn.close()
+        self.cnn = None
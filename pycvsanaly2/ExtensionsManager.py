@@ -17,9 +17,12 @@
 # Authors :
 #       Carlos Garcia Campos <carlosgc@gsyc.escet.urjc.es>
 
-from extensions import get_extension, ExtensionRunError, ExtensionUnknownError
+from extensions import get_extension, list_extensions, ExtensionRunError, ExtensionUnknownError
 from utils import printerr, printout
-import os
+import sys
+import time
+import Queue
+import threading
 
 
 class ExtensionException(Exception):
@@ -39,8 +42,9 @@ class InvalidDependency(ExtensionException):
 
 
 class ExtensionsManager:
-    def __init__(self, exts):
+    def __init__(self, exts, jobs=1):
         self.exts = {}
+        self.jobs = max(jobs, 1)
         for ext in exts:
             try:
                 self.exts[ext] = get_extension(ext)
@@ -50,6 +54,14 @@ class ExtensionsManager:
             # Add dependencies
             self.determine_deps(ext)
 
+        # Extensions walking the file revisions run together,
+        # so that every revision is retrieved once for all of them
+        self.stages = {}
+        members = sorted([name for name, ext in self.exts.items() if getattr(ext, 'file_revs', False)])
+        members = [name for name in members if not [dep for dep in self.exts[name].deps if dep in members]]
+        if len(members) > 1:
+            self.stages["+".join(members)] = members
+
     def determine_deps(self, ext):
         for dep in self.exts[ext].deps:
             if dep not in self.exts.keys():
@@ -60,6 +72,17 @@ class ExtensionsManager:
                 except:
                     raise InvalidDependency(ext, dep)
 
+    def __get_deps(self, name):
+        if name not in self.stages:
+            return self.exts[name].deps
+
+        members = self.stages[name]
+        deps = []
+        for member in members:
+            deps.extend([dep for dep in self.exts[member].deps if dep not in members and dep not in deps])
+
+        return deps
+
     def run_extension(self, name, extension, repo, uri, db):
         printout("Executing extension %s", (name,))
         try:
@@ -70,50 +93,95 @@ class ExtensionsManager:
 
         return True
 
-    def run_extension_deps(self, deps, repo, uri, db, done):
-        result = True
-        for dep in deps:
-
-            if dep in done:
-                continue
+    def __run_job(self, name, repo, uri, db, done):
+        if self.jobs > 1:
+            import repositoryhandler.backends as rh
 
-            if self.exts[dep].deps:
-                result = self.run_extension_deps(self.exts[dep].deps, repo, uri, db, done)
+            # Extensions watch the output of the repository
+            # commands, so every thread needs its own repository
+            repo = rh.create_repository(repo.get_type(), repo.get_uri())
 
-            if not result:
-                break
+        start = time.time()
+        try:
+            if name in self.stages:
+                from extensions.FileRevsStage import FileRevsStage
 
-            result = self.run_extension(dep, self.exts[dep](), repo, uri, db)
-            done.append(dep)
+                extension = FileRevsStage([self.exts[member]() for member in self.stages[name]])
+            else:
+                extension = self.exts[name]()
+            result = self.run_extension(name, extension, repo, uri, db)
+        except:
+            done.put((name, None, 0, sys.exc_info()))
+            return
 
-        return result
+        done.put((name, result, time.time() - start, None))
 
     def run_extensions(self, repo, uri, db):
-        done = []
-        for name, extension in [(ext, self.exts[ext]()) for ext in self.exts]:
-            if name in done:
-                continue
-            done.append(name)
-
-            result = True
-            result = self.run_extension_deps(extension.deps, repo, uri, db, done)
-
-            if not result:
-                printout("Skipping extension %s since one or more of its dependencies failed", (name,))
+        """Run the extensions once their dependencies finished,
+           up to self.jobs of them at the same time. Extensions
+           depending on a failed one are skipped"""
+        start = time.time()
+        # The extensions of a stage are run as the stage
+        members = sum(self.stages.values(), [])
+        pending = sorted([name for name in self.exts.keys() if name not in members] + self.stages.keys())
+        results = {}
+        # Time since the extensions started until every
+        # extension finished, following the dependencies
+        finish_times = {}
+        paths = {}
+        running = 0
+        done = Queue.Queue()
+
+        while pending or running:
+            scheduled = False
+            for name in pending[:]:
+                deps = self.__get_deps(name)
+                if [dep for dep in deps if results.get(dep) is False]:
+                    printout("Skipping extension %s since one or more of its dependencies failed", (name,))
+                    for member in self.stages.get(name, [name]):
+                        results[member] = False
+                    pending.remove(name)
+                    scheduled = True
+                elif running < self.jobs and not [dep for dep in deps if dep not in results]:
+                    pending.remove(name)
+                    running += 1
+                    scheduled = True
+                    if self.jobs > 1:
+                        thread = threading.Thread(target=self.__run_job,
+                                                  args=(name, repo, uri, db, done))
+                        thread.setDaemon(True)
+                        thread.start()
+                    else:
+                        self.__run_job(name, repo, uri, db, done)
+
+            if not running:
+                if not scheduled:
+                    printerr("Circular dependencies among extensions %s", (", ".join(pending),))
+                    break
                 continue
 
-            self.run_extension(name, extension, repo, uri, db)
+            name, result, elapsed, exc_info = done.get()
+            running -= 1
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+            path = [name]
+            finish_times[name] = elapsed
+            deps = self.__get_deps(name)
+            if deps:
+                slowest = max(deps, key=lambda dep: finish_times[dep])
+                finish_times[name] += finish_times[slowest]
+                path = paths[slowest] + path
+
+            for member in self.stages.get(name, [name]):
+                results[member] = result
+                finish_times[member] = finish_times[name]
+                paths[member] = path
+
+        if finish_times:
+            last = max(finish_times, key=lambda name: finish_times[name])
+            printout("Extensions run in %.2f seconds, critical path %s (%.2f seconds)",
+                     (time.time() - start, " -> ".join(paths[last]), finish_times[last]))
 
     def load_all_extensions(self):
-        extensions = {}
-        dir = os.path.dirname(os.path.realpath(__file__))
-        for files in os.listdir(dir + "/extensions"):
-            if files.endswith(".py"):
-                ext = files[:-3]
-                try:
-                    extensions[ext] = get_extension(ext)
-                except ExtensionUnknownError:
-                    # Do nothing here, because we ignore errors during showing "help" ;)
-                    pass
-
-        return extensions.keys()
+        return list_extensions()
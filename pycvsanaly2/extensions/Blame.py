@@ -18,11 +18,11 @@
 #       Carlos Garcia Campos  <carlosgc@gsyc.escet.urjc.es>
 
 from pycvsanaly2.Database import (SqliteDatabase, MysqlDatabase, TableAlreadyExists, statement)
-from pycvsanaly2.extensions import Extension, register_extension, ExtensionRunError
-from pycvsanaly2.profile import profiler_start, profiler_stop
-from pycvsanaly2.utils import printdbg, printerr, uri_to_filename
-from FileRevs import FileRevs
-from Jobs import JobPool, Job
+from pycvsanaly2.extensions import register_extension, ExtensionRunError
+from pycvsanaly2.utils import printdbg, printerr
+from FileContents import get_repo_path
+from FileRevsStage import FileRevsExtension
+from Jobs import Job
 from repositoryhandler.backends import RepositoryCommandError
 from repositoryhandler.backends.watchers import BLAME
 from Guilty.Parser import create_parser
@@ -59,18 +59,7 @@ class BlameJob(Job):
         def blame_line(line, p):
             p.feed(line)
 
-        repo_type = repo.get_type()
-        if repo_type == 'cvs':
-            # CVS paths contain the module stuff
-            uri = repo.get_uri_for_path(repo_uri)
-            module = uri[len(repo.get_uri()):].strip('/')
-
-            if module != '.':
-                path = self.path[len(module):].strip('/')
-            else:
-                path = self.path.strip('/')
-        else:
-            path = self.path.strip('/')
+        path = get_repo_path(repo, repo_uri, self.path)
 
         filename = os.path.basename(self.path)
         p = create_parser(repo.get_type(), self.path)
@@ -95,17 +84,20 @@ class BlameJob(Job):
         return self.commit_id
 
 
-class Blame(Extension):
+class Blame(FileRevsExtension):
     deps = ['FileTypes']
+    name = "Blame"
 
     # Insert query
     __insert__ = 'INSERT INTO blame (id, file_id, commit_id, author_id, n_lines) ' + \
                  'VALUES (?,?,?,?,?)'
     MAX_BLAMES = 10
+    batch = MAX_BLAMES
 
     def __init__(self):
         self.db = None
-        self.blames = []
+        self.blames = set()
+        self.args = []
         self.authors = None
         self.id_counter = 1
 
@@ -157,65 +149,16 @@ class Blame(Extension):
         query = "select b.file_id, b.commit_id from blame b, files f " + \
                 "where b.file_id = f.id and repository_id = ?"
         cursor.execute(statement(query, self.db.place_holder), (repoid,))
-        return [(res[0], res[1]) for res in cursor.fetchall()]
+        return set([(res[0], res[1]) for res in cursor.fetchall()])
 
     def __get_authors(self, cursor):
         query = "select id, name from people"
         cursor.execute(statement(query, self.db.place_holder))
         self.authors = dict([(name, id) for id, name in cursor.fetchall()])
 
-    def __process_finished_jobs(self, job_pool, write_cursor, unlocked=False):
-        if unlocked:
-            job = job_pool.get_next_done_unlocked()
-        else:
-            job = job_pool.get_next_done()
-
-        args = []
-
-        while job is not None:
-            authors = job.get_authors()
-            file_id = job.get_file_id()
-            commit_id = job.get_commit_id()
-
-            a = [(self.id_counter + i, file_id, commit_id, self.authors[key], authors[key])
-                 for i, key in enumerate(authors.keys())]
-            args.extend(a)
-            self.id_counter += len(a)
-
-            if unlocked:
-                job = job_pool.get_next_done_unlocked()
-            else:
-                job = job_pool.get_next_done(0.5)
-
-        if args:
-            write_cursor.executemany(statement(self.__insert__, self.db.place_holder), args)
-            del args
-
-    def run(self, repo, uri, db):
-        profiler_start("Running Blame extension")
-
+    def prepare(self, repo, db, cnn, repoid):
         self.db = db
 
-        cnn = self.db.connect()
-        read_cursor = cnn.cursor()
-        write_cursor = cnn.cursor()
-
-        blames = []
-
-        try:
-            path = uri_to_filename(uri)
-            if path is not None:
-                repo_uri = repo.get_uri_for_path(path)
-            else:
-                repo_uri = uri
-
-            read_cursor.execute(statement("SELECT id from repositories where uri = ?", db.place_holder), (repo_uri,))
-            repoid = read_cursor.fetchone()[0]
-        except NotImplementedError:
-            raise ExtensionRunError("Blame extension is not supported for %s repositories" % (repo.get_type()))
-        except Exception, e:
-            raise ExtensionRunError("Error creating repository %s. Exception: %s" % (repo.get_uri(), str(e)))
-
         try:
             self.__create_table(cnn)
         except TableAlreadyExists:
@@ -229,12 +172,11 @@ class Blame(Extension):
         except Exception, e:
             raise ExtensionRunError(str(e))
 
+        read_cursor = cnn.cursor()
         self.__get_authors(read_cursor)
 
         if self.id_counter > 1:
-            blames = self.__get_blames(read_cursor, repoid)
-
-        job_pool = JobPool(repo, path or repo.get_uri(), queuesize=100)
+            self.blames = self.__get_blames(read_cursor, repoid)
 
         # Get code files
         query = "select f.id from file_types ft, files f " + \
@@ -242,46 +184,42 @@ class Blame(Extension):
                 "ft.type in ('code', 'unknown') and " + \
                 "f.repository_id = ?"
         read_cursor.execute(statement(query, db.place_holder), (repoid,))
-        code_files = [item[0] for item in read_cursor.fetchall()]
+        self.code_files = set([item[0] for item in read_cursor.fetchall()])
+        read_cursor.close()
 
-        n_blames = 0
-        fr = FileRevs(db, cnn, read_cursor, repoid)
-        for revision, commit_id, file_id, action_type, composed in fr:
-            if file_id not in code_files:
-                continue
+        return None
 
-            if (file_id, commit_id) in blames:
-                printdbg("%d@%d is already in the database, skip it", (file_id, commit_id))
-                continue
+    def wants(self, commit_id, file_id, action_type):
+        if file_id not in self.code_files:
+            return False
 
-            if composed:
-                rev = revision.split("|")[0]
-            else:
-                rev = revision
+        if (file_id, commit_id) in self.blames:
+            printdbg("%d@%d is already in the database, skip it", (file_id, commit_id))
+            return False
 
-            relative_path = fr.get_path(repo, path or repo.get_uri())
-            printdbg("Path for %d at %s -> %s", (file_id, rev, relative_path))
+        return True
 
-            if repo.get_type() == 'svn' and relative_path == 'tags':
-                printdbg("Skipping file %s", (relative_path,))
-                continue
+    def create_job(self, commit_id, file_id, path, rev):
+        return BlameJob(file_id, commit_id, path, rev)
 
-            job = BlameJob(file_id, commit_id, relative_path, rev)
-            job_pool.push(job)
-            n_blames += 1
+    def job_done(self, job):
+        authors = job.get_authors()
+        file_id = job.get_file_id()
+        commit_id = job.get_commit_id()
 
-            if n_blames >= self.MAX_BLAMES:
-                self.__process_finished_jobs(job_pool, write_cursor)
-                n_blames = 0
+        a = [(self.id_counter + i, file_id, commit_id, self.authors[key], authors[key])
+             for i, key in enumerate(authors.keys())]
+        self.args.extend(a)
+        self.id_counter += len(a)
 
-        job_pool.join()
-        self.__process_finished_jobs(job_pool, write_cursor, True)
+    def flush(self, cnn):
+        if not self.args:
+            return
 
-        read_cursor.close()
+        write_cursor = cnn.cursor()
+        self.db.insert_many(write_cursor, self.__insert__, self.args)
+        self.args = []
         write_cursor.close()
-        cnn.close()
-
-        profiler_stop("Running Blame extension", delete=True)
 
 
 register_extension("Blame", Blame)
@@ -19,6 +19,7 @@
 
 import os
 import re
+from cStringIO import StringIO
 from subprocess import Popen, PIPE
 from repositoryhandler.backends.watchers import DIFF
 
@@ -27,7 +28,8 @@ from pycvsanaly2.Log import LogReader
 from pycvsanaly2.extensions import Extension, register_extension, ExtensionRunError
 from pycvsanaly2.utils import printerr, uri_to_filename
 from pycvsanaly2.FindProgram import find_program
-from pycvsanaly2.Command import Command, CommandError
+from pycvsanaly2.Command import Command, CommandError, CommandRunner
+from Jobs import JobPool, Job
 
 
 class DBCommitLines:
@@ -52,9 +54,17 @@ class LineCounter:
         self.repo = repo
         self.uri = uri
 
+    def prefetch(self, revisions):
+        """Count the lines of the given revisions at once,
+           before they are asked for"""
+        pass
+
     def get_lines_for_revision(self, revision):
         raise NotImplementedError
 
+    def close(self):
+        pass
+
 
 class CVSLineCounter(LineCounter):
     def __init__(self, repo, uri):
@@ -83,7 +93,38 @@ class CVSLineCounter(LineCounter):
         return self.lines.get(revision, (0, 0))
 
 
+def get_svn_diff(repo, uri, revision):
+    """Return the diff of revision, or None if the
+       diff command failed"""
+    def diff_line(data, io):
+        io.write(data)
+
+    io = StringIO()
+    wid = repo.add_watch(DIFF, diff_line, io)
+    try:
+        repo.diff(uri, revs=["%d" % (revision - 1), "%d" % (revision)])
+        return io.getvalue()
+    except Exception, e:
+        printerr("Error running svn diff command for revision %d: %s", (revision, str(e)))
+        return None
+    finally:
+        repo.remove_watch(DIFF, wid)
+        io.close()
+
+
+class SVNDiffJob(Job):
+    def __init__(self, revision):
+        self.revision = revision
+        self.diff = None
+
+    def run(self, repo, repo_uri):
+        self.diff = get_svn_diff(repo, repo_uri, self.revision)
+
+
 class SVNLineCounter(LineCounter):
+    # Diffs run at the same time
+    MAX_DIFFS = 16
+
     diffstat_pattern = re.compile("^ \d+ file[s]? changed(, (\d+) insertion[s]?\(\+\))?(, (\d+) deletion[s]?\(\-\))?$")
 
     def __init__(self, repo, uri):
@@ -93,32 +134,46 @@ class SVNLineCounter(LineCounter):
             raise ExtensionRunError("Error running CommitsLOC extension: " +
                                     "required diffstat command cannot be found in path")
 
-    def get_lines_for_revision(self, revision):
-
-        revision = int(revision)
-
-        def diff_line(data, diff_data_l):
-            diff_data = diff_data_l[0]
-            diff_data += data
-            diff_data_l[0] = diff_data
-
-        revs = []
-        revs.append("%d" % (revision - 1))
-        revs.append("%d" % (revision))
-        env = os.environ.copy().update({'LC_ALL': 'C'})
-        pipe = Popen(self.diffstat, shell=False, stdin=PIPE, stdout=PIPE, close_fds=True, env=env)
-        diff_data = [""]
-        wid = self.repo.add_watch(DIFF, diff_line, diff_data)
-        try:
-            self.repo.diff(self.repo.get_uri(), revs=revs)
-        except Exception, e:
-            printerr("Error running svn diff command: %s", (str(e)))
-            self.repo.remove_watch(DIFF, wid)
-            return (0, 0)
-
-        out = pipe.communicate(diff_data[0])[0]
-        self.repo.remove_watch(DIFF, wid)
-
+        # Lines of the revisions prefetched
+        self.lines = {}
+        self.runner = CommandRunner(self.MAX_DIFFS)
+        # Diffs are run by the repository, every
+        # worker of the pool has its own one
+        self.job_pool = None
+
+    def __diffstat_done(self, out, err, ret, revision):
+        if ret != 0:
+            printerr("Error running diffstat for revision %d: %s", (revision, err))
+            return
+
+        self.lines[revision] = self.__parse_diffstat(out)
+
+    def __diff_done(self, job):
+        if job is None or job.diff is None:
+            # It'll be run again when the revision is asked for
+            return
+
+        self.runner.add([self.diffstat], self.__diffstat_done, job.revision,
+                        env={'LC_ALL': 'C'}, stdin=job.diff)
+
+    def prefetch(self, revisions):
+        """Run the diffs of the revisions at the same time"""
+        if self.job_pool is None:
+            self.job_pool = JobPool(self.repo, self.repo.get_uri(), max_poolsize=self.MAX_DIFFS)
+
+        for revision in revisions:
+            self.job_pool.push(SVNDiffJob(int(revision)))
+            while self.job_pool.results_ready():
+                self.__diff_done(self.job_pool.get_next_done())
+
+        self.job_pool.join()
+        job = self.job_pool.get_next_done_unlocked()
+        while job is not None:
+            self.__diff_done(job)
+            job = self.job_pool.get_next_done_unlocked()
+        self.runner.run()
+
+    def __parse_diffstat(self, out):
         lines = out.split('\n')
         lines.reverse()
 
@@ -138,6 +193,27 @@ class SVNLineCounter(LineCounter):
 
         return (0, 0)
 
+    def get_lines_for_revision(self, revision):
+
+        revision = int(revision)
+        if revision in self.lines:
+            return self.lines.pop(revision)
+
+        diff = get_svn_diff(self.repo, self.repo.get_uri(), revision)
+        if diff is None:
+            return (0, 0)
+
+        env = os.environ.copy().update({'LC_ALL': 'C'})
+        pipe = Popen(self.diffstat, shell=False, stdin=PIPE, stdout=PIPE, close_fds=True, env=env)
+        out = pipe.communicate(diff)[0]
+
+        return self.__parse_diffstat(out)
+
+    def close(self):
+        if self.job_pool is not None:
+            self.job_pool.close()
+            self.job_pool = None
+
 
 class GitLineCounter(LineCounter):
     diffstat_pattern = re.compile("^ \d+ files? changed(, (\d+) insertions?\(\+\))?(, (\d+) deletions?\(\-\))?$")
@@ -155,12 +231,16 @@ class GitLineCounter(LineCounter):
         cmd = [self.git, 'log', '--all', '--topo-order', '--shortstat', '--pretty=oneline', 'origin']
         c = Command(cmd, uri)
         try:
-            c.run(parser_out_func=self.__parse_line)
+            c.run(parser_out_func=self.__parse_lines, batch=True)
         except CommandError, e:
             if e.error:
                 printerr("Error running git log command: %s", (e.error,))
             raise ExtensionRunError("Error running CommitsLOC extension: %s", str(e))
 
+    def __parse_lines(self, lines):
+        for line in lines:
+            self.__parse_line(line)
+
     def __parse_line(self, line):
         match = self.diffstat_pattern.match(line)
         if match:
@@ -201,6 +281,9 @@ def create_line_counter_for_repository(repo, uri):
 
 
 class CommitsLOC(Extension):
+    # Commits whose lines are counted at once
+    INTERVAL_SIZE = 100
+
     def __init__(self):
         self.db = None
 
@@ -289,9 +372,11 @@ class CommitsLOC(Extension):
         cursor.execute(statement("SELECT id, rev, composed_rev from scmlog where repository_id = ?",
                                  db.place_holder), (repo_id,))
         write_cursor = cnn.cursor()
-        rs = cursor.fetchmany()
+        rs = cursor.fetchmany(self.INTERVAL_SIZE)
         while rs:
             commit_list = []
+            counter.prefetch([revision for commit_id, revision, composed_rev in rs
+                              if commit_id not in commits])
 
             for commit_id, revision, composed_rev in rs:
                 if commit_id in commits:
@@ -307,10 +392,11 @@ class CommitsLOC(Extension):
 
             if commit_list:
                 commits_lines = [(commit.id, commit.commit_id, commit.added, commit.removed) for commit in commit_list]
-                write_cursor.executemany(statement(DBCommitLines.__insert__, self.db.place_holder), commits_lines)
+                self.db.insert_many(write_cursor, DBCommitLines.__insert__, commits_lines)
 
-            rs = cursor.fetchmany()
+            rs = cursor.fetchmany(self.INTERVAL_SIZE)
 
+        counter.close()
         cnn.commit()
         write_cursor.close()
         cursor.close()
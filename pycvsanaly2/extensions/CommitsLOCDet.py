@@ -33,9 +33,6 @@ Currently only works for git repositories.
 
 import re
 
-import sqlite3
-import _mysql_exceptions
-
 from pycvsanaly2.Database import (SqliteDatabase, MysqlDatabase, TableAlreadyExists)
 from pycvsanaly2.extensions import Extension, register_extension, ExtensionRunError
 from pycvsanaly2.utils import printerr, uri_to_filename
@@ -112,6 +109,7 @@ class DBTable:
 
         Raises exception if the table already exists
         """
+        import sqlite3
 
         try:
             cursor.execute(self._sql_create_table_sqlite)
@@ -124,6 +122,7 @@ class DBTable:
 
         Raises exception if the table already exists
         """
+        import _mysql_exceptions
 
         try:
             cursor.execute(self._sql_create_table_mysql)
@@ -185,7 +184,7 @@ class DBTable:
         It also empties the list of pending rows, after insertion."""
 
         if self.pending:
-            cursor.executemany(self._sql_row_insert, self.pending)
+            self.db.insert_many(cursor, self._sql_row_insert, self.pending)
             self.pending = []
 
 
@@ -300,13 +299,17 @@ class GitLineCounter(LineCounter):
                '--all', '--topo-order', '--numstat', '--pretty=oneline']
         c = Command(cmd, uri)
         try:
-            c.run(parser_out_func=self.__parse_line)
+            c.run(parser_out_func=self.__parse_lines, batch=True)
         except CommandError, e:
             if e.error:
                 printerr("Error running git log command: %s", (e.error,))
             raise ExtensionRunError("Error running " +
                                     "CommitsLOCDet extension: %s", str(e))
 
+    def __parse_lines(self, lines):
+        for line in lines:
+            self.__parse_line(line)
+
     def __parse_line(self, line):
         """Parse a line from the git log.
 
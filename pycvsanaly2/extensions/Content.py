@@ -18,15 +18,15 @@
 #       Chris Lewis <cflewis@soe.ucsc.edu>
 #       Zhongpeng Lin <linzhp@soe.ucsc.edu>
 
-from pycvsanaly2.extensions import Extension, register_extension, \
-    ExtensionRunError
+from pycvsanaly2.extensions import register_extension, \
+    ExtensionRunError, Watermark
 from pycvsanaly2.Database import SqliteDatabase, MysqlDatabase, statement
-from pycvsanaly2.utils import printdbg, printerr, uri_to_filename, to_unicode
-from pycvsanaly2.profile import profiler_start, profiler_stop
-from FileRevs import FileRevs
+from pycvsanaly2.utils import printerr, to_unicode
+from FileContents import fetch_file, get_repo_path
+from FileRevsStage import FileRevsExtension
 from repositoryhandler.backends import RepositoryCommandError
-from repositoryhandler.backends.watchers import CAT, SIZE
-from Jobs import JobPool, Job
+from repositoryhandler.backends.watchers import SIZE
+from Jobs import Job
 from io import BytesIO
 import os
 import traceback
@@ -44,38 +44,35 @@ class ContentJob(Job):
         self.file_size = None
 
     def run(self, repo, repo_uri):
+        path = get_repo_path(repo, repo_uri, self.path)
+        self.run_contents(repo, repo_uri, path, fetch_file(repo, repo_uri, path, self.rev))
+
+    def run_contents(self, repo, repo_uri, path, contents):
         self.repo = repo
         self.repo_uri = repo_uri
         self.repo_type = self.repo.get_type()
+        # Relative to the repository root
+        self.repo_path = path
 
-        if self.repo_type == 'cvs':
-            # CVS self.paths contain the module stuff
-            uri = self.repo.get_uri_for_self.path(self.repo_uri)
-            module = uri[len(self.repo.get_uri()):].strip('/')
+        self._file_contents = contents
 
-            if module != '.':
-                self.path = self.path[len(module):].strip('/')
-            else:
-                self.path = self.path.strip('/')
+        if self.repo_type == 'git':
+            # cat-file already tells the size of the blob
+            if self._file_contents is not None:
+                self.file_size = len(self._file_contents)
         else:
-            self.path = self.path.strip('/')
+            try:
+                self.file_size = self.listen_for_data(self.repo.size, SIZE)
+            except NotImplementedError:
+                self.file_size = None
 
-        suffix = ''
-        filename = os.path.basename(self.path)
-        ext_ptr = filename.rfind('.')
-        if ext_ptr != -1:
-            suffix = filename[ext_ptr:]
-            
-        self._file_contents = self.listen_for_data(self.repo.cat, CAT)
-        
-        try:
-            self.file_size = self.listen_for_data(self.repo.size, SIZE)
-        except NotImplementedError:
-            self.file_size = None
-        
         if self.file_size:
             self.file_size = int(self.file_size)
-            
+
+        # Don't keep the repository, jobs might be sent back
+        # from a worker process
+        self.repo = None
+
     def listen_for_data(self, repo_func, watcher):
         def write_line(data, io):
             io.write(data)
@@ -96,7 +93,7 @@ class ContentJob(Job):
         # Try downloading the file revision
         while not done and not failed:
             try:
-                repo_func(os.path.join(self.repo_uri, self.path), self.rev)
+                repo_func(os.path.join(self.repo_uri, self.repo_path), self.rev)
                 done = True
             except RepositoryCommandError, e:
                 if retries > 0:
@@ -108,12 +105,12 @@ class ContentJob(Job):
                     failed = True
                     printerr("Error obtaining %s@%s. " +
                              "Command %s returned %d(%s)",
-                             (self.path, self.rev, e.cmd,
+                             (self.repo_path, self.rev, e.cmd,
                              e.returncode, e.error))
             except:
                 failed = True
                 printerr("Error obtaining %s@%s.",
-                        (self.path, self.rev))
+                        (self.repo_path, self.rev))
                 traceback.print_exc()
                 
         self.repo.remove_watch(watcher, wid)
@@ -189,12 +186,23 @@ class ContentJob(Job):
     file_contents = property(_get_file_contents, _set_file_contents)
 
 
-class Content(Extension):
+class Content(FileRevsExtension):
     deps = ['FileTypes']
-    
-    MAX_THREADS = 10
-    
+    name = "Content"
+
+    # Contents inserted at once
+    MAX_CONTENTS = 10
+    batch = MAX_CONTENTS
+
+    def __init__(self):
+        self.db = None
+        self.rows = []
+
     def __prepare_table(self, connection, drop_table=False):
+        """Create the content table unless it already exists.
+           Return whether it was created"""
+        created = False
+
         # Drop the table's old data
         if drop_table:
             cursor = connection.cursor()
@@ -222,6 +230,7 @@ class Content(Extension):
                     loc INTEGER,
                     size INTEGER,
                     UNIQUE (commit_id, file_id))""")
+                created = True
                 cursor.execute("""create index commit_id_index 
                     on content(commit_id)""")
                 cursor.execute("""create index commit_id_index 
@@ -256,6 +265,7 @@ class Content(Extension):
                     index(commit_id),
                     index(file_id)
                     ) ENGINE=InnoDB CHARACTER SET=utf8""")
+                created = True
 
             except OperationalError as e:
                 if e.args[0] == 1050:
@@ -270,92 +280,21 @@ class Content(Extension):
 
         connection.commit()
 
-    def __process_finished_jobs(self, job_pool, connection, db):
-        if isinstance(self.db, SqliteDatabase):
-            from sqlite3 import IntegrityError
-        elif isinstance(self.db, MysqlDatabase):
-            from MySQLdb import IntegrityError
-        write_cursor = connection.cursor()
-        finished_job = job_pool.get_next_done(0)
-        processed_jobs = 0
-        # commit_id is the commit ID. For some reason, the 
-        # documentation advocates tablename_id as the reference,
-        # but in the source, these are referred to as commit IDs.
-        # Don't ask me why!
-        while finished_job is not None:
-            query = """
-                insert into content(commit_id, file_id, content, loc, size) 
-                    values(?,?,?,?,?)"""
-            insert_statement = statement(query, db.place_holder)
-            parameters = (finished_job.commit_id,
-                          finished_job.file_id,
-                          finished_job.file_contents,
-                          finished_job.file_number_of_lines,
-                          finished_job.file_size)
-            try:                    
-                write_cursor.execute(insert_statement, parameters)
-            except IntegrityError as e:
-                if isinstance(self.db, MysqlDatabase) and e.args[0] == 1062:
-                    # Ignore duplicate entry
-                    pass
-                else:
-                    printerr(
-                        'Error while inserting content for file %d @ commit %d'
-                        % (finished_job.file_id, finished_job.commit_id))
-                    raise
-
-            processed_jobs += 1
-            finished_job = job_pool.get_next_done(0)
-
-        connection.commit()
-        write_cursor.close()
-            
-        return processed_jobs
-
-    def run(self, repo, uri, db):
-        # Start the profiler, per every other extension
-        profiler_start("Running content extension")
+        return created
 
-        # Open a connection to the database and get cursors
+    def prepare(self, repo, db, cnn, repoid):
         self.db = db
-        connection = self.db.connect()
-        read_cursor = connection.cursor()
-        
-        # Try to get the repository and get its ID from the database
-        try:
-            path = uri_to_filename(uri)
-            if path is not None:
-                repo_uri = repo.get_uri_for_path(path)
-            else:
-                repo_uri = uri
-
-            read_cursor.execute(statement(
-                "SELECT id from repositories where uri = ?",
-                db.place_holder), (repo_uri,))
-            repo_id = read_cursor.fetchone()[0]
-        except NotImplementedError:
-            raise ExtensionRunError(
-                "Content extension is not supported for %s repos" %
-                (repo.get_type()))
-        except Exception, e:
-            raise ExtensionRunError(
-                "Error creating repository %s. Exception: %s" %
-                (repo.get_uri(), str(e)))
-            
+
         # Try to create a table for storing the content
         # TODO: Removed use case for choosing between all or just the HEAD,
         # should ideally put that back again. Just all for now is fine.
         try:
-            self.__prepare_table(connection)
+            created = self.__prepare_table(cnn)
         except Exception as e:
             raise ExtensionRunError("Couldn't prepare table because " +
                                     str(e))
 
-        queuesize = self.MAX_THREADS
-        printdbg("Setting queuesize to " + str(queuesize))
-
-        # This is where the threading stuff comes in, I expect
-        job_pool = JobPool(repo, path or repo.get_uri(), queuesize=queuesize)
+        read_cursor = cnn.cursor()
 
         # This filters files if they're not source files.
         # I'm pretty sure "unknown" is returning binary files too, but
@@ -366,68 +305,103 @@ class Content(Extension):
                 "ft.type in('code') and " + \
                 "f.repository_id = ?"
                 # "ft.type in('code', 'unknown') and " + \
-        read_cursor.execute(statement(query, db.place_holder), (repo_id,))
-        code_files = [item[0] for item in read_cursor.fetchall()]
+        read_cursor.execute(statement(query, db.place_holder), (repoid,))
+        self.code_files = set([item[0] for item in read_cursor.fetchall()])
+
+        # Only the commits newer than the ones processed by the
+        # previous run, some of them might be there if it failed
+        self.watermark = Watermark(db, cnn, "Content", repoid)
+        if created:
+            # The table might have been dropped since
+            self.watermark.reset(read_cursor)
         query = """select c.file_id, c.commit_id from content c, files f
-            where c.file_id=f.id and f.repository_id=?
+            where c.file_id=f.id and f.repository_id=? and c.commit_id > ?
         """
-        read_cursor.execute(statement(query, db.place_holder), (repo_id,))
-        existing_content = [(item[0], item[1])
-                            for item in read_cursor.fetchall()]
-
-        fr = FileRevs(db, connection, read_cursor, repo_id)
-
-        i = 0
-        # Loop through each file and its revision
-        for revision, commit_id, file_id, action_type, composed in fr:
-            if action_type == 'D':
-                continue
-#            loop_start = datetime.now()
-            if file_id not in code_files:
-                continue
-            if (file_id, commit_id) in existing_content:
-                continue
+        read_cursor.execute(statement(query, db.place_holder),
+                            (repoid, self.watermark.last or 0))
+        self.existing_content = set([(item[0], item[1])
+                                     for item in read_cursor.fetchall()])
+        read_cursor.close()
 
-            try:
-                relative_path = fr.get_path(repo, path or repo.get_uri())
-            except TypeError as e:
-                printerr("No path found for file %d at commit %d", 
-                         (file_id, commit_id))
-                continue
-            if composed:
-                rev = revision.split("|")[0]
-            else:
-                rev = revision
-
-            printdbg("Path for %d at %s -> %s", (file_id, rev, relative_path))
-
-            # Ignore SVN tags
-            if repo.get_type() == 'svn' and relative_path == 'tags':
-                printdbg("Skipping file %s", (relative_path,))
-                continue
-
-            job = ContentJob(commit_id, file_id, rev, relative_path)
-            job_pool.push(job)
-            i = i + 1
-            if i >= queuesize:
-                printdbg("Content queue is now at %d, flushing to database", 
-                         (i,))
-                
-                processed_jobs = self.__process_finished_jobs(job_pool, 
-                                                              connection, db)
-                i = i - processed_jobs
-                if processed_jobs < (queuesize / 5):
-                    job_pool.join()
+        return self.watermark.last
 
-        job_pool.join()
-        self.__process_finished_jobs(job_pool, connection, db)
+    def wants(self, commit_id, file_id, action_type):
+        if action_type == 'D':
+            return False
+        if self.watermark.last is not None and commit_id <= self.watermark.last:
+            return False
+        if file_id not in self.code_files:
+            return False
 
-        read_cursor.close()
-        connection.close()
+        return (file_id, commit_id) not in self.existing_content
+
+    def create_job(self, commit_id, file_id, path, rev):
+        return ContentJob(commit_id, file_id, rev, path)
+
+    def job_done(self, job):
+        self.rows.append((job.commit_id,
+                          job.file_id,
+                          job.file_contents,
+                          job.file_number_of_lines,
+                          job.file_size))
+
+    def job_failed(self, commit_id, file_id):
+        # The watermark stays before the revision
+        # so that the next run tries it again
+        self.watermark.hold(commit_id)
+
+    def ignores_path_errors(self):
+        return True
+
+    def flush(self, connection):
+        if not self.rows:
+            return
+
+        if isinstance(self.db, SqliteDatabase):
+            from sqlite3 import IntegrityError
+        elif isinstance(self.db, MysqlDatabase):
+            from MySQLdb import IntegrityError
+        write_cursor = connection.cursor()
+        # commit_id is the commit ID. For some reason, the 
+        # documentation advocates tablename_id as the reference,
+        # but in the source, these are referred to as commit IDs.
+        # Don't ask me why!
+        query = """
+            insert into content(commit_id, file_id, content, loc, size) 
+                values(?,?,?,?,?)"""
+        rows = self.rows
+        self.rows = []
+
+        try:
+            self.db.insert_many(write_cursor, query, rows)
+            rows = []
+        except IntegrityError as e:
+            if not isinstance(self.db, MysqlDatabase) or e.args[0] != 1062:
+                raise
+
+        # Some of the rows were already there, insert them
+        # one by one, ignoring the duplicated ones
+        insert_statement = statement(query, self.db.place_holder)
+        for parameters in rows:
+            try:                    
+                write_cursor.execute(insert_statement, parameters)
+            except IntegrityError as e:
+                if isinstance(self.db, MysqlDatabase) and e.args[0] == 1062:
+                    # Ignore duplicate entry
+                    pass
+                else:
+                    printerr(
+                        'Error while inserting content for file %d @ commit %d'
+                        % (parameters[1], parameters[0]))
+                    raise
+
+        write_cursor.close()
+
+    def finish(self, connection):
+        cursor = connection.cursor()
+        self.watermark.save(cursor)
+        cursor.close()
 
-        # This turns off the profiler and deletes it's timings
-        profiler_stop("Running content extension", delete=True)
-        
     def backout(self, repo, uri, db):
         update_statement = """delete from content where
                               commit_id in (select id from scmlog s
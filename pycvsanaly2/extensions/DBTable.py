@@ -19,8 +19,6 @@
 
 """Some common code for managing database tables"""
 
-import sqlite3
-import _mysql_exceptions
 from pycvsanaly2.Database import (SqliteDatabase, MysqlDatabase, TableAlreadyExists)
 
 
@@ -93,6 +91,7 @@ class DBTable:
 
         Raises exception if the table already exists
         """
+        import sqlite3
 
         try:
             cursor.execute(self._sql_create_table_sqlite)
@@ -105,6 +104,7 @@ class DBTable:
 
         Raises exception if the table already exists
         """
+        import _mysql_exceptions
 
         try:
             cursor.execute(self._sql_create_table_mysql)
@@ -166,5 +166,5 @@ class DBTable:
         It also empties the list of pending rows, after insertion."""
 
         if self.pending:
-            cursor.executemany(self._sql_row_insert, self.pending)
+            self.db.insert_many(cursor, self._sql_row_insert, self.pending)
             self.pending = []
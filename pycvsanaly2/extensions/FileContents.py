@@ -0,0 +1,287 @@
+# Copyright (C) 2014 LibreSoft
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Contents of the file revisions, used by the extensions jobs.
+
+Git repositories are read from a git cat-file --batch process kept
+for every repository object, instead of running a command for every
+file revision. Every JobPool worker has its own repository object,
+so it has its own process too.
+
+Contents are kept in a BlobCache shared by every extension, keyed by
+the git blob id or by the repository, path and revision otherwise.
+"""
+
+import os
+import threading
+import weakref
+from cStringIO import StringIO
+from subprocess import Popen, PIPE
+
+from repositoryhandler.backends import RepositoryCommandError
+from repositoryhandler.backends.watchers import CAT
+from pycvsanaly2.BlobCache import BlobCache
+from pycvsanaly2.Config import Config
+from pycvsanaly2.FindProgram import find_program
+from pycvsanaly2.utils import printdbg, printerr, cvsanaly_cache_dir
+
+
+class GitCatFile:
+    """git cat-file processes returning the contents and
+       the ids of the objects of the repository in path"""
+
+    def __init__(self, path):
+        self.path = path
+        self.processes = {}
+        self.lock = threading.Lock()
+
+    def __start(self, option):
+        git = find_program('git')
+        if git is None:
+            raise OSError("git is not installed")
+
+        printdbg("GitCatFile: starting git cat-file %s in %s", (option, self.path))
+        process = Popen([git, 'cat-file', option], cwd=self.path,
+                        stdin=PIPE, stdout=PIPE, close_fds=True)
+        self.processes[option] = process
+
+        return process
+
+    def __close(self, option):
+        process = self.processes.pop(option, None)
+        if process is None:
+            return
+
+        process.stdin.close()
+        process.stdout.close()
+        process.wait()
+
+    def __request(self, option, obj):
+        """Return the process and the (id, type, size) header of
+           obj, None instead of the header if it's missing or it
+           can't be read (e.g. <obj> ambiguous), those responses
+           are a single line"""
+        process = self.processes.get(option)
+        if process is None or process.poll() is not None:
+            process = self.__start(option)
+
+        try:
+            process.stdin.write(obj + '\n')
+            process.stdin.flush()
+
+            header = process.stdout.readline()
+            if not header:
+                raise IOError("git cat-file exited reading %s" % (obj))
+
+            fields = header.split()
+            if len(fields) != 3:
+                printdbg("GitCatFile: can't read %s: %s", (obj, header.strip()))
+                return process, None
+
+            sha, type, size = fields
+            return process, (sha, type, int(size))
+        except (IOError, ValueError):
+            # Start it again for the next object
+            self.__close(option)
+            raise
+
+    def get_id(self, obj):
+        """Return the id of the blob obj (a blob id or rev:path),
+           None if there isn't such a blob"""
+        if '\n' in obj:
+            return None
+
+        self.lock.acquire()
+        try:
+            process, header = self.__request('--batch-check', obj)
+        finally:
+            self.lock.release()
+
+        if header is None or header[1] != 'blob':
+            return None
+
+        return header[0]
+
+    def get(self, obj):
+        """Return the contents of the blob obj (a blob id or rev:path),
+           None if there isn't such a blob"""
+        if '\n' in obj:
+            return None
+
+        self.lock.acquire()
+        try:
+            process, header = self.__request('--batch', obj)
+            if header is None:
+                return None
+
+            sha, type, size = header
+            try:
+                contents = process.stdout.read(size)
+                process.stdout.read(1)
+            except IOError:
+                self.__close('--batch')
+                raise
+
+            if type != 'blob':
+                return None
+
+            return contents
+        finally:
+            self.lock.release()
+
+    def close(self):
+        for option in self.processes.keys():
+            self.__close(option)
+
+    def __del__(self):
+        try:
+            self.close()
+        except:
+            pass
+
+
+_cat_files = weakref.WeakKeyDictionary()
+
+
+def get_cat_file(repo, repo_uri):
+    try:
+        return _cat_files[repo]
+    except KeyError:
+        cat_file = _cat_files[repo] = GitCatFile(repo_uri)
+        return cat_file
+
+
+_blob_cache = None
+_blob_cache_lock = threading.Lock()
+
+
+def get_blob_cache():
+    """Return the cache of file contents shared by the extensions,
+       None if it's disabled"""
+    global _blob_cache
+
+    config = Config()
+    if not config.blob_cache_size:
+        return None
+
+    _blob_cache_lock.acquire()
+    try:
+        if _blob_cache is None:
+            path = os.path.join(cvsanaly_cache_dir(), 'blobs')
+            _blob_cache = BlobCache(path, config.blob_cache_size * 1024 * 1024)
+        return _blob_cache
+    finally:
+        _blob_cache_lock.release()
+
+
+def get_repo_path(repo, repo_uri, path):
+    """Return path relative to the root of the repository"""
+    if repo.get_type() == 'cvs':
+        # CVS paths contain the module stuff
+        uri = repo.get_uri_for_path(repo_uri)
+        module = uri[len(repo.get_uri()):].strip('/')
+
+        if module != '.':
+            return path[len(module):].strip('/')
+
+    return path.strip('/')
+
+
+def cache_contents(cache, key, contents, path, rev):
+    """Store the contents of path@rev in the blob cache. The
+       contents are already known, so errors are only printed"""
+    try:
+        cache.put(key, contents)
+    except (IOError, OSError), e:
+        printerr("Error storing %s@%s in the blob cache. Exception: %s",
+                 (path, rev, str(e)))
+
+
+def fetch_file(repo, repo_uri, path, rev):
+    """Return the contents of the file path, relative to the
+       repository root, at the revision rev. None is returned
+       and an error printed if it can't be obtained.
+
+       Contents are read from the blob cache if they are
+       already there, and stored in it otherwise."""
+    cache = get_blob_cache()
+
+    if repo.get_type() == 'git':
+        cat_file = get_cat_file(repo, repo_uri)
+        obj = "%s:%s" % (rev, path)
+        try:
+            if cache is not None:
+                # The same blob is in many revisions
+                # of the file and in renamed files
+                obj = key = cat_file.get_id(obj)
+                if key is None:
+                    printerr("Error obtaining %s@%s. It's not a file", (path, rev))
+                    return None
+
+                contents = cache.get(key)
+                if contents is not None:
+                    return contents
+
+            contents = cat_file.get(obj)
+        except (IOError, OSError, ValueError), e:
+            printerr("Error obtaining %s@%s. Exception: %s", (path, rev, str(e)))
+            return None
+
+        if contents is None:
+            printerr("Error obtaining %s@%s. It's not a file", (path, rev))
+        elif cache is not None:
+            cache_contents(cache, key, contents, path, rev)
+        return contents
+
+    if cache is not None:
+        key = "\0".join((repo.get_uri(), path, rev))
+        contents = cache.get(key)
+        if contents is not None:
+            return contents
+
+    def write_line(data, io):
+        io.write(data)
+
+    io = StringIO()
+    wid = repo.add_watch(CAT, write_line, io)
+
+    retries = 3
+    contents = None
+    while contents is None:
+        try:
+            repo.cat(os.path.join(repo_uri, path), rev)
+            contents = io.getvalue()
+        except RepositoryCommandError, e:
+            if retries > 0:
+                printerr("Command %s returned %d (%s), try again", (e.cmd, e.returncode, e.error))
+                retries -= 1
+                io.seek(0)
+                io.truncate()
+            else:
+                printerr("Error obtaining %s@%s. Command %s returned %d (%s)",
+                         (path, rev, e.cmd, e.returncode, e.error))
+                break
+        except Exception, e:
+            printerr("Error obtaining %s@%s. Exception: %s", (path, rev, str(e)))
+            break
+
+    repo.remove_watch(CAT, wid)
+    io.close()
+
+    if contents is not None and cache is not None:
+        cache_contents(cache, key, contents, path, rev)
+
+    return contents
@@ -20,6 +20,7 @@
 #       Santiago Dueñas <sduenas@libresoft.es>
 
 from pycvsanaly2.Database import statement, ICursor
+from pycvsanaly2.CommitGraph import load_ancestry_index
 
 if __name__ == '__main__':
     import sys
@@ -31,21 +32,29 @@ class FileRevs:
     INTERVAL_SIZE = 1000
     __query__ = '''select s.rev rev, s.id commit_id, af.file_id, af.action_type, s.composed_rev
 from scmlog s, action_files af where s.id = af.commit_id and s.repository_id = ? order by s.id'''
+    __since_query__ = '''select s.rev rev, s.id commit_id, af.file_id, af.action_type, s.composed_rev
+from scmlog s, action_files af where s.id = af.commit_id and s.repository_id = ? and s.id > ? order by s.id'''
     # This query selects the newest entry for those cases with two filepaths
     # for the same file. See https://github.com/MetricsGrimoire/CVSAnalY/issues/3 for more info.
-    __path_query__ = '''SELECT rev, file_path FROM file_links fl JOIN scmlog s
+    __path_query__ = '''SELECT rev, file_path, commit_id FROM file_links fl JOIN scmlog s
     ON fl.commit_id=s.id WHERE file_id = ? AND commit_id <= ? ORDER BY commit_id DESC, fl.id DESC'''
 
-    def __init__(self, db, cnn, cursor, repoid):
+    def __init__(self, db, cnn, cursor, repoid, since=None):
         self.db = db
         self.cnn = cnn
         self.repoid = repoid
 
+        # Only the revisions of the commits newer than since
         self.icursor = ICursor(cursor, self.INTERVAL_SIZE)
-        self.icursor.execute(statement(self.__query__, db.place_holder), (repoid,))
+        if since is None:
+            self.icursor.execute(statement(self.__query__, db.place_holder), (repoid,))
+        else:
+            self.icursor.execute(statement(self.__since_query__, db.place_holder), (repoid, since))
         self.rs = iter(self.icursor.fetchmany())
         self.prev_commit = -1
         self.current = None
+        # Ancestry of the commits, loaded the first time it's needed
+        self.graph = None
 
     def __iter__(self):
         return self
@@ -77,13 +86,27 @@ from scmlog s, action_files af where s.id = af.commit_id and s.repository_id = ?
             rev = revision.split("|")[0]
         else:
             rev = revision
+
+        if repo is not None and self.graph is None:
+            cursor = self.cnn.cursor()
+            self.graph = load_ancestry_index(self.db, cursor, self.repoid)
+            cursor.close()
+
         cursor = self.cnn.cursor()
-        cursor.execute(statement(self.__path_query__, self.db.place_holder),
-                       (file_id, commit_id))
+        self.db.execute(cursor, self.__path_query__, (file_id, commit_id))
         file_link = cursor.fetchone()
         relative_path = None
         if repo is None:
             relative_path = file_link[1]
+        elif self.graph.n_edges > 0:
+            # Ancestry from the commit graph, without
+            # running a command for every link
+            while file_link:
+                if self.graph.is_ancestor(file_link[2], commit_id):
+                    relative_path = file_link[1]
+                    break
+                else:
+                    file_link = cursor.fetchone()
         else:
             try:
                 while file_link:
@@ -0,0 +1,274 @@
+# Copyright (C) 2014 LibreSoft
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Walk of the file revisions shared by several extensions.
+
+Extensions processing every file revision (Content, Metrics, Blame)
+are FileRevsExtensions. The stage goes through the revisions once,
+finds the path of every revision wanted by any of them once and runs
+their jobs for the revision together, so that the file is retrieved
+once. Every extension still stores its results in its own table.
+"""
+
+from pycvsanaly2.extensions import Extension, ExtensionRunError
+from pycvsanaly2.Config import Config
+from pycvsanaly2.Database import statement
+from pycvsanaly2.profile import profiler_start, profiler_stop
+from pycvsanaly2.utils import printdbg, printerr, printout, uri_to_filename
+from FileRevs import FileRevs
+from FileContents import fetch_file, get_repo_path
+from Jobs import JobPool, Job
+
+
+class FileRevsExtension(Extension):
+    """Extension run by a FileRevsStage.
+
+    prepare() is called first, then wants() for every file revision
+    and create_job() for the wanted ones. Jobs defining run_contents()
+    get the path relative to the repository root and the contents of
+    the file instead of retrieving it. Every job
+    done is passed to job_done(), and the revisions whose job failed
+    to job_failed(). flush() is called to store the results from time
+    to time and finish() at the end.
+    """
+
+    # Name of the extension, used for the process_jobs option
+    name = None
+    # Results stored at once
+    batch = JobPool.BATCH
+    # ExtensionsManager runs the FileRevsExtensions together
+    file_revs = True
+
+    def prepare(self, repo, db, cnn, repoid):
+        """Create the output table. Return the id of the newest commit
+           whose revisions are not wanted, None to get all of them"""
+        raise NotImplementedError
+
+    def wants(self, commit_id, file_id, action_type):
+        raise NotImplementedError
+
+    def create_job(self, commit_id, file_id, path, rev):
+        raise NotImplementedError
+
+    def job_done(self, job):
+        raise NotImplementedError
+
+    def job_failed(self, commit_id, file_id):
+        """The revision of file_id at commit_id wasn't processed,
+           it should be tried again on the next run"""
+        pass
+
+    def ignores_path_errors(self):
+        """Whether revisions whose path can't be found are skipped,
+           instead of stopping the run"""
+        return False
+
+    def flush(self, cnn):
+        pass
+
+    def finish(self, cnn):
+        pass
+
+    def run(self, repo, uri, db):
+        FileRevsStage([self]).run(repo, uri, db)
+
+
+class FileRevJob(Job):
+    """Jobs of several extensions for the same file revision"""
+
+    def __init__(self, commit_id, file_id, path, rev, jobs):
+        self.commit_id = commit_id
+        self.file_id = file_id
+        self.path = path
+        self.rev = rev
+        # (index of the extension, job)
+        self.jobs = jobs
+        # Indexes of the extensions whose job failed
+        self.failed = []
+
+    def run(self, repo, repo_uri):
+        path = get_repo_path(repo, repo_uri, self.path)
+        fetched = False
+        contents = None
+        jobs = []
+        for i, job in self.jobs:
+            try:
+                if hasattr(job, 'run_contents'):
+                    if not fetched:
+                        contents = fetch_file(repo, repo_uri, path, self.rev)
+                        fetched = True
+                    job.run_contents(repo, repo_uri, path, contents)
+                else:
+                    job.run(repo, repo_uri)
+            except Exception, e:
+                # A failed job doesn't lose the others
+                printerr("Error running %s for %s@%s. Exception: %s",
+                         (job.__class__.__name__, self.path, self.rev, str(e)))
+                self.failed.append(i)
+                continue
+
+            jobs.append((i, job))
+
+        self.jobs = jobs
+
+
+class FileRevsStage:
+    """Runs the given FileRevsExtensions walking the file revisions once"""
+
+    def __init__(self, extensions):
+        self.extensions = extensions
+        self.name = "+".join([ext.name for ext in extensions])
+
+    def __process_finished_jobs(self, job_pool, cnn, unlocked=False):
+        if unlocked:
+            job = job_pool.get_next_done_unlocked()
+        else:
+            job = job_pool.get_next_done(0)
+
+        while job is not None:
+            del self.pending[(job.commit_id, job.file_id)]
+            for i, ext_job in job.jobs:
+                self.extensions[i].job_done(ext_job)
+            for i in job.failed:
+                self.extensions[i].job_failed(job.commit_id, job.file_id)
+
+            if unlocked:
+                job = job_pool.get_next_done_unlocked()
+            else:
+                job = job_pool.get_next_done(0)
+
+        profiler_start("Inserting results in db")
+        for ext in self.extensions:
+            ext.flush(cnn)
+        cnn.commit()
+        profiler_stop("Inserting results in db")
+
+    def run(self, repo, uri, db):
+        profiler_start("Running %s extension", (self.name,))
+
+        cnn = db.connect()
+        read_cursor = cnn.cursor()
+
+        try:
+            path = uri_to_filename(uri)
+            if path is not None:
+                repo_uri = repo.get_uri_for_path(path)
+            else:
+                repo_uri = uri
+
+            read_cursor.execute(statement("SELECT id from repositories where uri = ?", db.place_holder), (repo_uri,))
+            repoid = read_cursor.fetchone()[0]
+        except NotImplementedError:
+            raise ExtensionRunError("%s extension is not supported for %s repositories" %
+                                    (self.name, repo.get_type()))
+        except Exception, e:
+            raise ExtensionRunError("Error creating repository %s. Exception: %s" % (repo.get_uri(), str(e)))
+
+        # Revisions of the commits newer than the
+        # ones already processed by every extension
+        since = None
+        for i, ext in enumerate(self.extensions):
+            ext_since = ext.prepare(repo, db, cnn, repoid)
+            if i == 0 or ext_since is None:
+                since = ext_since
+            elif since is not None:
+                since = min(since, ext_since)
+
+        config = Config()
+        # The jobs of all the extensions run together, so they
+        # run on processes only if all of them are listed
+        processes = [ext.name for ext in self.extensions if ext.name in config.process_jobs]
+        if processes and len(processes) < len(self.extensions):
+            printout("%s run on threads, process_jobs doesn't list all of them", (self.name,))
+        job_pool = JobPool(repo, path or repo.get_uri(),
+                           batch=min([ext.batch for ext in self.extensions]),
+                           processes=len(processes) == len(self.extensions))
+
+        # Extensions of the revisions pushed, until their job is
+        # done. Jobs failing completely are never returned
+        self.pending = {}
+
+        fr = FileRevs(db, cnn, read_cursor, repoid, since)
+        current_commit = None
+        for revision, commit_id, file_id, action_type, composed in fr:
+            # A file might have several actions in the same
+            # commit, its revision is processed once
+            if commit_id != current_commit:
+                current_commit = commit_id
+                commit_files = set()
+            if file_id in commit_files:
+                continue
+            commit_files.add(file_id)
+
+            wanted = [i for i, ext in enumerate(self.extensions)
+                      if ext.wants(commit_id, file_id, action_type)]
+            if not wanted:
+                continue
+
+            try:
+                relative_path = fr.get_path(repo, path or repo.get_uri())
+            except (TypeError, AttributeError), e:
+                if [i for i in wanted if not self.extensions[i].ignores_path_errors()]:
+                    raise
+                printerr("Error getting path for file %d@%d: %s", (file_id, commit_id, str(e)))
+                relative_path = None
+
+            if relative_path is None:
+                printerr("No path found for file %d at commit %d", (file_id, commit_id))
+                for i in wanted:
+                    self.extensions[i].job_failed(commit_id, file_id)
+                continue
+
+            if composed:
+                rev = revision.split("|")[0]
+            else:
+                rev = revision
+
+            printdbg("Path for %d at %s -> %s", (file_id, rev, relative_path))
+
+            # Ignore SVN tags
+            if repo.get_type() == 'svn' and relative_path == 'tags':
+                printdbg("Skipping file %s", (relative_path,))
+                continue
+
+            jobs = [(i, self.extensions[i].create_job(commit_id, file_id, relative_path, rev))
+                    for i in wanted]
+            self.pending[(commit_id, file_id)] = wanted
+            job_pool.push(FileRevJob(commit_id, file_id, relative_path, rev, jobs))
+
+            if job_pool.results_ready():
+                self.__process_finished_jobs(job_pool, cnn)
+
+        job_pool.join()
+        self.__process_finished_jobs(job_pool, cnn, True)
+        job_pool.close()
+
+        for (commit_id, file_id), wanted in self.pending.items():
+            printerr("%s failed for file %d at commit %d", (self.name, file_id, commit_id))
+            for i in wanted:
+                self.extensions[i].job_failed(commit_id, file_id)
+
+        if config.profile:
+            job_pool.print_stats(self.name)
+
+        for ext in self.extensions:
+            ext.finish(cnn)
+        cnn.commit()
+
+        read_cursor.close()
+        cnn.close()
+
+        profiler_stop("Running %s extension", (self.name,), delete=True)
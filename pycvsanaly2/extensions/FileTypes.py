@@ -140,7 +140,7 @@ class FileTypes(Extension):
 
             if types:
                 file_types = [(type.id, type.file_id, type.type) for type in types]
-                write_cursor.executemany(statement(DBFileType.__insert__, self.db.place_holder), file_types)
+                self.db.insert_many(write_cursor, DBFileType.__insert__, file_types)
 
             rs = cursor.fetchmany()
 
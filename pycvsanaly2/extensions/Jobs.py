@@ -23,38 +23,230 @@ if __name__ == '__main__':
     sys.path.insert(0, "../")
 
 from pycvsanaly2.AsyncQueue import AsyncQueue, TimeOut
+from pycvsanaly2.utils import printdbg, printout, printerr
+from cPickle import dumps, loads
 import repositoryhandler.backends as rh
+import multiprocessing
+import os
 import threading
+import time
+import traceback
+
+
+def _job_process(cnn, repo_type, uri, repo_uri):
+    repo = rh.create_repository(repo_type, uri)
+    while True:
+        job = cnn.recv()
+        if job is None:
+            break
+
+        try:
+            job.run(repo, repo_uri)
+            data = dumps(job, -1)
+        except:
+            traceback.print_exc()
+            data = ''
+        cnn.send_bytes(data)
+
+    cnn.close()
+
+
+class JobProcess:
+    """Process running jobs with its own repository, so that
+       their Python code runs in parallel too. Jobs and their
+       results must be picklable"""
+
+    def __init__(self, repo, repo_uri):
+        self.cnn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_job_process,
+                                               args=(child, repo.get_type(), repo.get_uri(), repo_uri))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+
+    def run(self, job):
+        """Run job in the process, returning the job with its
+           results, or None if it failed"""
+        self.cnn.send(job)
+        data = self.cnn.recv_bytes()
+        if not data:
+            return None
+
+        return loads(data)
+
+    def stop(self):
+        self.cnn.send(None)
+        self.cnn.close()
+        self.process.join()
 
 
 class JobPool:
+    """Pool of threads running jobs, on processes when processes
+       is True.
+
+    The pool starts with poolsize workers and adds more, up to
+    max_poolsize, while jobs wait for a worker and the CPUs are not
+    busy. Jobs done wait for the caller to get them, at most batch
+    of them plus one per worker; workers stop when there are more,
+    so results_ready() should be checked after pushing jobs.
+    """
+
     POOL_SIZE = 5
+    BATCH = 100
 
-    def __init__(self, repo, repo_uri, jobs_done=True, poolsize=POOL_SIZE, queuesize=None):
+    # Jobs run between every decision about the size of the pool
+    ADAPT_JOBS = 20
+
+    def __init__(self, repo, repo_uri, jobs_done=True, poolsize=POOL_SIZE, queuesize=None,
+                 processes=False, max_poolsize=None, batch=BATCH):
+        self.repo = repo
+        self.repo_uri = repo_uri
         self.jobs_done = jobs_done
+        self.processes = processes
+        self.batch = batch
+
+        try:
+            self.cpus = multiprocessing.cpu_count()
+        except NotImplementedError:
+            self.cpus = 1
+        self.max_poolsize = max(poolsize, max_poolsize or 4 * self.cpus)
+        self.poolsize = 0
 
-        self.queue = AsyncQueue(queuesize or 0)
+        self.queue = AsyncQueue(queuesize or 2 * self.max_poolsize)
         if self.jobs_done:
-            self.done = AsyncQueue()
+            self.done = AsyncQueue(self.batch + self.max_poolsize)
+
+        # Statistics
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.n_jobs = 0
+        self.n_failed = 0
+        self.job_time = 0
+        self.max_job_time = 0
+        self.n_pushed = 0
+        self.depth = 0
+        self.max_depth = 0
+        self.waiting = 0
 
         for i in range(poolsize):
-            rep = rh.create_repository(repo.get_type(), repo.get_uri())
-            thread = threading.Thread(target=self._job_thread, args=(rep, repo_uri))
-            thread.setDaemon(True)
-            thread.start()
+            self.poolsize += 1
+            self.__add_worker()
+
+    def __add_worker(self):
+        """Start a worker, already counted in poolsize"""
+        if self.processes:
+            # Every thread waits for the jobs run by a process
+            process = JobProcess(self.repo, self.repo_uri)
+            thread = threading.Thread(target=self._process_thread, args=(process,))
+        else:
+            rep = rh.create_repository(self.repo.get_type(), self.repo.get_uri())
+            thread = threading.Thread(target=self._job_thread, args=(rep, self.repo_uri))
+        thread.setDaemon(True)
+        thread.start()
+
+    def __adapt(self):
+        """Whether to add a worker, called with the lock held. The
+           worker is counted here, but it's started once the lock is
+           released, since starting it may take a while"""
+        # Jobs were waiting for a worker most of the time, add
+        # another one unless the results are not being consumed
+        # or the CPUs are already busy
+        waiting = self.waiting / float(self.ADAPT_JOBS)
+        self.waiting = 0
+        if waiting < 1 or self.poolsize >= self.max_poolsize:
+            return False
+        if self.jobs_done and self.done.qsize() >= self.batch:
+            return False
+
+        try:
+            load = os.getloadavg()[0]
+        except (AttributeError, OSError):
+            load = 0
+        if load >= self.cpus:
+            return False
+
+        self.poolsize += 1
+        printdbg("JobPool: adding worker %d, %.1f jobs waiting, load %.2f",
+                 (self.poolsize, waiting, load))
+        return True
+
+    def __job_done(self, job, elapsed):
+        # Jobs are done once they can be got
+        if job is not None:
+            job.elapsed = elapsed
+            if self.jobs_done:
+                self.done.put(job)
+
+        add_worker = False
+        self.lock.acquire()
+        try:
+            self.n_jobs += 1
+            if job is None:
+                self.n_failed += 1
+            self.job_time += elapsed
+            self.max_job_time = max(self.max_job_time, elapsed)
+            self.waiting += self.queue.qsize()
+            if self.n_jobs % self.ADAPT_JOBS == 0:
+                add_worker = self.__adapt()
+        finally:
+            self.lock.release()
+
+        if add_worker:
+            try:
+                self.__add_worker()
+            except Exception, e:
+                printerr("JobPool: error adding a worker: %s", (str(e),))
+                self.lock.acquire()
+                self.poolsize -= 1
+                self.lock.release()
+
+        self.queue.done()
 
     def _job_thread(self, repo, repo_uri):
         while True:
             job = self.queue.get()
-            job.run(repo, repo_uri)
-            self.queue.done()
+            if job is None:
+                self.queue.done()
+                break
 
-            if self.jobs_done:
-                self.done.put(job)
+            start = time.time()
+            try:
+                job.run(repo, repo_uri)
+            except:
+                # Failed jobs are not returned, like in processes
+                traceback.print_exc()
+                job = None
+
+            self.__job_done(job, time.time() - start)
+
+    def _process_thread(self, process):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                process.stop()
+                self.queue.done()
+                break
+
+            start = time.time()
+            job = process.run(job)
+            self.__job_done(job, time.time() - start)
 
     def push(self, job):
+        if self.jobs_done:
+            self.done.set_maxsize(self.batch + self.max_poolsize)
         self.queue.put(job)
 
+        self.lock.acquire()
+        depth = self.queue.qsize()
+        self.n_pushed += 1
+        self.depth += depth
+        self.max_depth = max(self.max_depth, depth)
+        self.lock.release()
+
+    def results_ready(self):
+        """Whether there are batch jobs done waiting to be got"""
+        return self.jobs_done and self.done.qsize() >= self.batch
+
     def get_next_done(self, timeout=None):
         if not self.jobs_done:
             return None
@@ -76,8 +268,37 @@ class JobPool:
         return self.done.get_unlocked()
 
     def join(self):
+        # All the jobs done have to fit until they are got
+        if self.jobs_done:
+            self.done.set_maxsize(0)
+        self.queue.join()
+
+    def close(self):
+        """Stop the threads and processes once the jobs are done"""
+        self.join()
+        for i in range(self.poolsize):
+            self.queue.put(None)
         self.queue.join()
 
+    def get_stats(self):
+        elapsed = time.time() - self.start
+        return {'jobs': self.n_jobs,
+                'failed': self.n_failed,
+                'poolsize': self.poolsize,
+                'job_time': self.n_jobs and self.job_time / self.n_jobs,
+                'max_job_time': self.max_job_time,
+                'queue_depth': self.n_pushed and float(self.depth) / self.n_pushed,
+                'max_queue_depth': self.max_depth,
+                'throughput': elapsed and self.n_jobs / elapsed}
+
+    def print_stats(self, name):
+        stats = self.get_stats()
+        printout("%s: %d jobs (%d failed) on %d workers, %.1f jobs/s, " +
+                 "%.3f s per job (max %.3f s), queue depth %.1f (max %d)",
+                 (name, stats['jobs'], stats['failed'], stats['poolsize'], stats['throughput'],
+                  stats['job_time'], stats['max_job_time'], stats['queue_depth'],
+                  stats['max_queue_depth']))
+
 
 class Job:
     def run(self, repo, repo_uri):
@@ -22,7 +22,8 @@
 # This extension extracts words from commit messages, and does some
 # analysis on them
 
-from pycvsanaly2.extensions import Extension, register_extension
+from pycvsanaly2.Database import statement
+from pycvsanaly2.extensions import Extension, register_extension, Watermark
 from pycvsanaly2.utils import uri_to_filename
 from pycvsanaly2.extensions.DBTable import DBTable
 
@@ -98,11 +99,30 @@ class MessageWords(Extension):
 
         # First month is 0, last month is lastMonth
         lastMonth = (maxDate.year - minDate.year) * 12 + maxDate.month - minDate.month
-        for period in range(0, lastMonth):
+        firstMonth = 0
+
+        # Only the months with commits newer than the ones
+        # processed by the previous run are computed again
+        watermark = Watermark(db, cnn, "MessageWords", repo_id)
+        if watermark.last is not None:
+            cursor.execute(statement("SELECT MIN(date) FROM scmlog " +
+                                     "WHERE repository_id = ? AND id > ?",
+                                     db.place_holder), (repo_id, watermark.last))
+            newDate = cursor.fetchone()[0]
+            if newDate is None:
+                lastMonth = 0
+            else:
+                firstMonth = max((newDate.year - minDate.year) * 12 + newDate.month - minDate.month - 1, 0)
+                month = (minDate.month + firstMonth) % 12 + 1
+                year = minDate.year + (firstMonth + minDate.month) // 12
+                write_cursor.execute(statement("DELETE FROM words_freq WHERE date >= ?",
+                                               db.place_holder), ("%d-%02d-01" % (year, month),))
+
+        for period in range(firstMonth, lastMonth):
             wordsFreq = {}
             month = (minDate.month + period) % 12 + 1
             year = minDate.year + (period + minDate.month) // 12
-            date = str(year) + "-" + str(month) + "-01"
+            date = "%d-%02d-01" % (year, month)
             query = "SELECT log.message " + \
                     "FROM scmlog log " + \
                     "WHERE year(log.date) = %s " + \
@@ -122,6 +142,7 @@ class MessageWords(Extension):
                 theTableWords.add_pending_row((None, date,
                                                word, wordsFreq[word]))
             theTableWords.insert_rows(write_cursor)
+        watermark.save(write_cursor)
         cnn.commit()
         write_cursor.close()
         cursor.close()
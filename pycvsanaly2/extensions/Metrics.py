@@ -25,17 +25,16 @@
 #
 
 from pycvsanaly2.Database import (SqliteDatabase, MysqlDatabase, TableAlreadyExists, statement)
-from pycvsanaly2.extensions import Extension, register_extension, ExtensionRunError
+from pycvsanaly2.extensions import Extension, register_extension, ExtensionRunError, Watermark
 from pycvsanaly2.Config import Config
-from pycvsanaly2.utils import printdbg, printerr, printout, remove_directory, uri_to_filename
+from pycvsanaly2.utils import printdbg, printerr, printout, remove_directory
 from pycvsanaly2.FindProgram import find_program
 from pycvsanaly2.profile import profiler_start, profiler_stop
 from pycvsanaly2.Command import Command, CommandError, CommandRunningError
-from repositoryhandler.backends import RepositoryCommandError
-from repositoryhandler.backends.watchers import CAT
 from tempfile import mkdtemp, NamedTemporaryFile
-from FileRevs import FileRevs
-from Jobs import JobPool, Job
+from FileContents import fetch_file, get_repo_path
+from FileRevsStage import FileRevsExtension
+from Jobs import Job
 from xml.sax import handler as xmlhandler, make_parser
 from signal import SIGTERM
 import os
@@ -69,7 +68,12 @@ class Measures:
         }
 
     def __getattr__(self, name):
-        return self.__dict__[name]
+        # AttributeError is expected by pickle, used when
+        # jobs are sent back from worker processes
+        try:
+            return self.__dict__[name]
+        except KeyError:
+            raise AttributeError(name)
 
     def __setattr__(self, name, value):
         self.__dict__[name] = value
@@ -587,24 +591,12 @@ class MetricsJob(Job):
         profiler_stop("[MccabeComplexity] Measuring %s @ %s", (checkout_path, rev), True)
 
     def run(self, repo, repo_uri):
-        def write_file(line, fd):
-            fd.write(line)
+        path = get_repo_path(repo, repo_uri, self.path)
+        self.run_contents(repo, repo_uri, path, fetch_file(repo, repo_uri, path, self.rev))
 
+    def run_contents(self, repo, repo_uri, path, contents):
         self.measures = Measures()
 
-        repo_type = repo.get_type()
-        if repo_type == 'cvs':
-            # CVS paths contain the module stuff
-            uri = repo.get_uri_for_path(repo_uri)
-            module = uri[len(repo.get_uri()):].strip('/')
-
-            if module != '.':
-                path = self.path[len(module):].strip('/')
-            else:
-                path = self.path.strip('/')
-        else:
-            path = self.path.strip('/')
-
         suffix = ''
         filename = os.path.basename(self.path)
         ext_ptr = filename.rfind('.')
@@ -612,33 +604,9 @@ class MetricsJob(Job):
             suffix = filename[ext_ptr:]
 
         fd = NamedTemporaryFile('w', suffix=suffix)
-        wid = repo.add_watch(CAT, write_file, fd.file)
-
-        if repo_type == 'git':
-            retries = 0
-        else:
-            retries = 3
-
-        done = False
-        failed = False
-        while not done and not failed:
-            try:
-                repo.cat(os.path.join(repo_uri, path), self.rev)
-                done = True
-            except RepositoryCommandError, e:
-                if retries > 0:
-                    printerr("Command %s returned %d (%s), try again", (e.cmd, e.returncode, e.error))
-                    retries -= 1
-                    fd.file.seek(0)
-                elif retries == 0:
-                    failed = True
-                    printerr("Error obtaining %s@%s. Command %s returned %d (%s)",
-                             (self.path, self.rev, e.cmd, e.returncode, e.error))
-            except Exception, e:
-                failed = True
-                printerr("Error obtaining %s@%s. Exception: %s", (self.path, self.rev, str(e)))
-
-        repo.remove_watch(CAT, wid)
+        failed = contents is None
+        if not failed:
+            fd.file.write(contents)
         fd.file.close()
 
         if failed:
@@ -669,8 +637,9 @@ class MetricsJob(Job):
         return self.failed
 
 
-class Metrics(Extension):
+class Metrics(FileRevsExtension):
     deps = ['FileTypes']
+    name = "Metrics"
 
     # Insert query
     __insert__ = 'INSERT INTO metrics (id, file_id, commit_id, lang, sloc, loc, ncomment, ' + \
@@ -678,12 +647,13 @@ class Metrics(Extension):
                  'mccabe_median, halstead_length, halstead_vol, halstead_level, halstead_md) ' + \
                  'VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)'
     MAX_METRICS = 100
-    INTERVAL_SIZE = 1000
+    batch = MAX_METRICS
 
     def __init__(self):
         self.db = None
         self.config = Config()
         self.metrics = []
+        self.updates = []
 
     def __create_table(self, cnn):
         cursor = cnn.cursor()
@@ -757,11 +727,11 @@ class Metrics(Extension):
         cnn.commit()
         cursor.close()
 
-    def __get_metrics(self, cursor, repoid):
+    def __get_metrics(self, cursor, repoid, since=None):
         query = "select m.file_id, m.commit_id from metrics m, files f " + \
-                "where m.file_id = f.id and repository_id = ?"
-        cursor.execute(statement(query, self.db.place_holder), (repoid,))
-        return [(res[0], res[1]) for res in cursor.fetchall()]
+                "where m.file_id = f.id and repository_id = ? and m.commit_id > ?"
+        cursor.execute(statement(query, self.db.place_holder), (repoid, since or 0))
+        return set([(res[0], res[1]) for res in cursor.fetchall()])
 
     def __get_metrics_failed(self, cursor, repoid):
         query = "select m.file_id, m.commit_id from metrics m, files f " + \
@@ -775,81 +745,22 @@ class Metrics(Extension):
                 "halstead_level = -1 or halstead_md = -1)"
 
         cursor.execute(statement(query, self.db.place_holder), (repoid,))
-        return [(res[0], res[1]) for res in cursor.fetchall()]
-
-    def __insert_many(self, cursor):
-        if not self.metrics:
-            return
-
-        cursor.executemany(statement(self.__insert__, self.db.place_holder), self.metrics)
-        self.metrics = []
-
-    def __process_finished_jobs(self, job_pool, write_cursor, unlocked=False):
-        if unlocked:
-            job = job_pool.get_next_done_unlocked()
-        else:
-            job = job_pool.get_next_done()
-
-        while job is not None:
-            id_counter = job.get_id()
-            measures = job.get_measures()
-            file_id = job.get_file_id()
-            commit_id = job.get_commit_id()
-
-            if job.is_failed():
-                query = "update metrics set lang=?, sloc=?, loc=?, " + \
-                        "ncomment=?, lcomment=?, lblank=?, nfunctions=?, " + \
-                        "mccabe_max=?, mccabe_min=?, mccabe_sum=?, mccabe_mean=?, mccabe_median=?, " + \
-                        "halstead_length=?, halstead_vol=?, halstead_level=?, halstead_md=? " + \
-                        "where file_id = ? and commit_id = ?"
-
-                write_cursor.execute(statement(query, self.db.place_holder),
-                                     (measures.lang, measures.sloc, measures.loc,
-                                      measures.ncomment, measures.lcomment, measures.lblank, measures.nfunctions,
-                                      measures.mccabe_max, measures.mccabe_min, measures.mccabe_sum,
-                                      measures.mccabe_mean,
-                                      measures.mccabe_median, measures.halstead_length, measures.halstead_vol,
-                                      measures.halstead_level, measures.halstead_md, file_id, commit_id))
-            else:
-                self.metrics.append((id_counter, file_id, commit_id, measures.lang, measures.sloc, measures.loc,
-                                     measures.ncomment, measures.lcomment, measures.lblank, measures.nfunctions,
-                                     measures.mccabe_max, measures.mccabe_min, measures.mccabe_sum,
-                                     measures.mccabe_mean,
-                                     measures.mccabe_median, measures.halstead_length, measures.halstead_vol,
-                                     measures.halstead_level, measures.halstead_md))
-            if unlocked:
-                job = job_pool.get_next_done_unlocked()
-            else:
-                job = job_pool.get_next_done(0.5)
-
-    def run(self, repo, uri, db):
-        profiler_start("Running Metrics extension")
+        return set([(res[0], res[1]) for res in cursor.fetchall()])
 
+    def prepare(self, repo, db, cnn, repoid):
         self.db = db
 
-        cnn = self.db.connect()
-        read_cursor = cnn.cursor()
-        write_cursor = cnn.cursor()
+        self.id_counter = 1
+        self.existing = self.existing_failed = set()
 
-        id_counter = 1
-        metrics = metrics_failed = []
-
-        try:
-            path = uri_to_filename(uri)
-            if path is not None:
-                repo_uri = repo.get_uri_for_path(path)
-            else:
-                repo_uri = uri
-
-            read_cursor.execute(statement("SELECT id from repositories where uri = ?", db.place_holder), (repo_uri,))
-            repoid = read_cursor.fetchone()[0]
-        except NotImplementedError:
-            raise ExtensionRunError("Metrics extension is not supported for %s repositories" % (repo.get_type()))
-        except Exception, e:
-            raise ExtensionRunError("Error creating repository %s. Exception: %s" % (repo.get_uri(), str(e)))
+        self.watermark = watermark = Watermark(db, cnn, "Metrics", repoid)
 
         try:
             self.__create_table(cnn)
+            cursor = cnn.cursor()
+            watermark.reset(cursor)
+            cnn.commit()
+            cursor.close()
         except TableAlreadyExists:
             cursor = cnn.cursor()
             if not self.config.metrics_all:
@@ -859,22 +770,29 @@ class Metrics(Extension):
                         "where f.id = m.file_id and " + \
                         "f.repository_id = ?"
                 cursor.execute(statement(query, db.place_holder), (repoid,))
+                watermark.reset(cursor)
                 cnn.commit()
 
             cursor.execute(statement("SELECT max(id) from metrics", db.place_holder))
             id = cursor.fetchone()[0]
             if id is not None:
-                id_counter = id + 1
+                self.id_counter = id + 1
 
             cursor.close()
         except Exception, e:
             raise ExtensionRunError(str(e))
 
-        if id_counter > 1:
-            metrics = self.__get_metrics(read_cursor, repoid)
-            metrics_failed = self.__get_metrics_failed(read_cursor, repoid)
+        read_cursor = cnn.cursor()
 
-        job_pool = JobPool(repo, path or repo.get_uri(), queuesize=self.MAX_METRICS)
+        # Only the commits newer than the ones processed by the previous
+        # run, unless older metrics failed and have to be tried again
+        self.since = None
+        if self.id_counter > 1:
+            self.existing_failed = self.__get_metrics_failed(read_cursor, repoid)
+            if watermark.last is not None and \
+               not [m for m in self.existing_failed if m[1] <= watermark.last]:
+                self.since = watermark.last
+            self.existing = self.__get_metrics(read_cursor, repoid, self.since)
 
         # Get code files to discard all other files in case of metrics-all
         query = "select f.id from file_types ft, files f " + \
@@ -882,69 +800,76 @@ class Metrics(Extension):
                 "ft.type in ('code', 'unknown') and " + \
                 "f.repository_id = ?"
         read_cursor.execute(statement(query, db.place_holder), (repoid,))
-        code_files = [item[0] for item in read_cursor.fetchall()]
+        self.code_files = set([item[0] for item in read_cursor.fetchall()])
+        read_cursor.close()
 
-        n_metrics = 0
-        fr = FileRevs(db, cnn, read_cursor, repoid)
+        return self.since
 
-        for revision, commit_id, file_id, action_type, composed in fr:
-            if file_id not in code_files:
-                continue
+    def wants(self, commit_id, file_id, action_type):
+        if self.since is not None and commit_id <= self.since:
+            return False
+        if file_id not in self.code_files:
+            return False
 
-            failed = False
+        if (file_id, commit_id) in self.existing_failed:
+            printdbg("%d@%d is already in the database, but it failed, try again", (file_id, commit_id))
+        elif (file_id, commit_id) in self.existing:
+            printdbg("%d@%d is already in the database, skip it", (file_id, commit_id))
+            return False
 
-            if (file_id, commit_id) in metrics_failed:
-                printdbg("%d@%d is already in the database, but it failed, try again", (file_id, commit_id))
-                failed = True
-            elif (file_id, commit_id) in metrics:
-                printdbg("%d@%d is already in the database, skip it", (file_id, commit_id))
-                continue
+        return True
 
-            try:
-                relative_path = fr.get_path(repo, path or repo.get_uri())
-            except AttributeError, e:
-                if self.config.metrics_noerr:
-                    printerr("Error getting path for file %d@%d: %s", (file_id, commit_id, str(e)))
-                else:
-                    raise e
-
-            if composed:
-                rev = revision.split("|")[0]
-            else:
-                rev = revision
+    def create_job(self, commit_id, file_id, path, rev):
+        failed = (file_id, commit_id) in self.existing_failed
+        job = MetricsJob(self.id_counter, file_id, commit_id, path, rev, failed)
+        self.id_counter += 1
 
-            printdbg("Path for %d at %s -> %s", (file_id, rev, relative_path))
+        return job
 
-            if repo.get_type() == 'svn' and relative_path == 'tags':
-                printdbg("Skipping file %s", (relative_path,))
-                continue
+    def job_done(self, job):
+        measures = job.get_measures()
+        row = (measures.lang, measures.sloc, measures.loc,
+               measures.ncomment, measures.lcomment, measures.lblank, measures.nfunctions,
+               measures.mccabe_max, measures.mccabe_min, measures.mccabe_sum,
+               measures.mccabe_mean,
+               measures.mccabe_median, measures.halstead_length, measures.halstead_vol,
+               measures.halstead_level, measures.halstead_md)
 
-            job = MetricsJob(id_counter, file_id, commit_id, relative_path, rev, failed)
-            job_pool.push(job)
-            id_counter += 1
-            n_metrics += 1
+        if job.is_failed():
+            self.updates.append(row + (job.get_file_id(), job.get_commit_id()))
+        else:
+            self.metrics.append((job.get_id(), job.get_file_id(), job.get_commit_id()) + row)
 
-            if n_metrics >= self.MAX_METRICS:
-                self.__process_finished_jobs(job_pool, write_cursor)
-                profiler_start("Inserting results in db")
-                self.__insert_many(write_cursor)
-                cnn.commit()
-                profiler_stop("Inserting results in db")
-                n_metrics = 0
+    def job_failed(self, commit_id, file_id):
+        # The watermark stays before the revision
+        # so that the next run tries it again
+        self.watermark.hold(commit_id)
 
-        job_pool.join()
-        self.__process_finished_jobs(job_pool, write_cursor, True)
+    def ignores_path_errors(self):
+        return self.config.metrics_noerr
 
-        profiler_start("Inserting results in db")
-        self.__insert_many(write_cursor)
-        cnn.commit()
-        profiler_stop("Inserting results in db")
+    def flush(self, cnn):
+        write_cursor = cnn.cursor()
+
+        query = "update metrics set lang=?, sloc=?, loc=?, " + \
+                "ncomment=?, lcomment=?, lblank=?, nfunctions=?, " + \
+                "mccabe_max=?, mccabe_min=?, mccabe_sum=?, mccabe_mean=?, mccabe_median=?, " + \
+                "halstead_length=?, halstead_vol=?, halstead_level=?, halstead_md=? " + \
+                "where file_id = ? and commit_id = ?"
+        for args in self.updates:
+            write_cursor.execute(statement(query, self.db.place_holder), args)
+        self.updates = []
+
+        if self.metrics:
+            self.db.insert_many(write_cursor, self.__insert__, self.metrics)
+            self.metrics = []
 
-        read_cursor.close()
         write_cursor.close()
-        cnn.close()
 
-        profiler_stop("Running Metrics extension", delete=True)
+    def finish(self, cnn):
+        cursor = cnn.cursor()
+        self.watermark.save(cursor)
+        cursor.close()
 
 
 register_extension("Metrics", Metrics)
@@ -19,8 +19,10 @@
 
 from repositoryhandler.backends.watchers import DIFF
 from pycvsanaly2.Database import (SqliteDatabase, MysqlDatabase, TableAlreadyExists, statement, ICursor)
-from pycvsanaly2.extensions import Extension, register_extension, ExtensionRunError
+from pycvsanaly2.extensions import Extension, register_extension, ExtensionRunError, Watermark
 from pycvsanaly2.utils import printerr, uri_to_filename
+from pycvsanaly2.FindProgram import find_program
+from pycvsanaly2.Command import CommandRunner
 from cStringIO import StringIO
 
 
@@ -42,6 +44,8 @@ class DBPatch:
 
 class Patches(Extension):
     INTERVAL_SIZE = 100
+    # Commands run at the same time
+    MAX_COMMANDS = 16
 
     def __init__(self):
         self.db = None
@@ -88,7 +92,7 @@ class Patches(Extension):
         query = "SELECT p.commit_id from patches p, scmlog s " + \
                 "WHERE p.commit_id = s.id and repository_id = ?"
         cursor.execute(statement(query, self.db.place_holder), (repo_id,))
-        commits = [res[0] for res in cursor.fetchall()]
+        commits = set([res[0] for res in cursor.fetchall()])
 
         return commits
 
@@ -110,6 +114,30 @@ class Patches(Extension):
 
         return data
 
+    def get_patches_for_commits(self, revs):
+        """Return the patches of the revisions revs, running
+           the git commands at the same time"""
+        git = None
+        if self.repo.get_type() == 'git':
+            git = find_program('git')
+        if git is None:
+            return [self.get_patch_for_commit(rev) for rev in revs]
+
+        def show_done(out, err, ret, i):
+            if ret != 0:
+                printerr("Error running show command: %s", (err,))
+                out = None
+            patches[i] = out
+
+        patches = [None] * len(revs)
+        runner = CommandRunner(self.MAX_COMMANDS)
+        for i, rev in enumerate(revs):
+            runner.add([git, 'show', '--pretty=format:', rev], show_done, i,
+                       cwd=self.repo_uri, env={'PAGER': ''})
+        runner.run()
+
+        return patches
+
     def run(self, repo, uri, db):
         self.db = db
         self.repo = repo
@@ -129,28 +157,39 @@ class Patches(Extension):
         cursor.execute(statement("SELECT id from repositories where uri = ?", db.place_holder), (repo_uri,))
         repo_id = cursor.fetchone()[0]
 
-        # If table does not exist, the list of commits is empty,
+        # If table does not exist, the set of commits is empty,
         # otherwise it will be filled within the except block below
-        commits = []
+        commits = set()
+        watermark = Watermark(db, cnn, "Patches", repo_id)
 
         try:
             self.__create_table(cnn)
+            watermark.reset(cursor)
         except TableAlreadyExists:
             cursor.execute(statement("SELECT max(id) from patches", db.place_holder))
             id = cursor.fetchone()[0]
             if id is not None:
                 DBPatch.id_counter = id + 1
 
-            commits = self.__get_patches_for_repository(repo_id, cursor)
+            if watermark.last is None:
+                commits = self.__get_patches_for_repository(repo_id, cursor)
         except Exception, e:
             raise ExtensionRunError(str(e))
 
         write_cursor = cnn.cursor()
         icursor = ICursor(cursor, self.INTERVAL_SIZE)
-        icursor.execute(statement("SELECT id, rev, composed_rev from scmlog where repository_id = ?",
-                                  db.place_holder), (repo_id,))
+        if watermark.last is None:
+            icursor.execute(statement("SELECT id, rev, composed_rev from scmlog where repository_id = ?",
+                                      db.place_holder), (repo_id,))
+        else:
+            # Only the commits stored after the previous run
+            icursor.execute(statement("SELECT id, rev, composed_rev from scmlog " +
+                                      "where repository_id = ? and id > ?",
+                                      db.place_holder), (repo_id, watermark.last))
         rs = icursor.fetchmany()
         while rs:
+            commit_ids = []
+            revs = []
             for commit_id, revision, composed_rev in rs:
                 if commit_id in commits:
                     continue
@@ -160,12 +199,20 @@ class Patches(Extension):
                 else:
                     rev = revision
 
-                p = DBPatch(None, commit_id, self.get_patch_for_commit(rev))
-                write_cursor.execute(statement(DBPatch.__insert__, self.db.place_holder),
-                                     (p.id, p.commit_id, self.db.to_binary(p.patch)))
+                commit_ids.append(commit_id)
+                revs.append(rev)
+
+            patches = []
+            for commit_id, data in zip(commit_ids, self.get_patches_for_commits(revs)):
+                p = DBPatch(None, commit_id, data)
+                patches.append((p.id, p.commit_id, self.db.to_binary(p.patch)))
+
+            self.db.insert_many(write_cursor, DBPatch.__insert__, patches)
+            del patches
 
             rs = icursor.fetchmany()
 
+        watermark.save(write_cursor)
         cnn.commit()
         write_cursor.close()
         cursor.close()
@@ -17,7 +17,12 @@
 # Authors :
 #       Carlos Garcia Campos <carlosgc@gsyc.escet.urjc.es>
 
-__all__ = ['Extension', 'get_extension', 'register_extension']
+__all__ = ['Extension', 'get_extension', 'register_extension', 'list_extensions', 'Watermark']
+
+import os
+import re
+
+from pycvsanaly2.Database import statement
 
 
 class ExtensionUnknownError(Exception):
@@ -35,6 +40,66 @@ class Extension:
         raise NotImplementedError
 
 
+class Watermark:
+    """Last commit of a repository processed by an extension.
+
+    Commit ids grow as commits are stored, so an extension only needs
+    to look at the commits newer than last on later runs. last is None
+    when the extension didn't finish any run yet. Once the extension
+    finishes, save() records the newest commit there was when the
+    watermark was created.
+    """
+
+    __create__ = "CREATE TABLE IF NOT EXISTS extension_watermarks (" + \
+                 "extension varchar(64)," + \
+                 "repository_id integer," + \
+                 "commit_id integer," + \
+                 "primary key (extension, repository_id)" + \
+                 ")"
+    __select__ = "SELECT commit_id from extension_watermarks where extension = ? and repository_id = ?"
+    __delete__ = "DELETE from extension_watermarks where extension = ? and repository_id = ?"
+    __insert__ = "INSERT INTO extension_watermarks (extension, repository_id, commit_id) values (?, ?, ?)"
+
+    def __init__(self, db, cnn, extension, repository_id):
+        self.db = db
+        self.extension = extension
+        self.repository_id = repository_id
+
+        cursor = cnn.cursor()
+        cursor.execute(self.__create__)
+        cnn.commit()
+
+        cursor.execute(statement(self.__select__, db.place_holder), (extension, repository_id))
+        rs = cursor.fetchone()
+        self.last = rs and rs[0]
+
+        cursor.execute(statement("SELECT max(id) from scmlog where repository_id = ?", db.place_holder),
+                       (repository_id,))
+        self.head = cursor.fetchone()[0]
+        cursor.close()
+
+    def save(self, cursor):
+        """Record the commits as processed. It's saved when
+           the connection of cursor is committed"""
+        self.reset(cursor)
+        if self.head is not None:
+            cursor.execute(statement(self.__insert__, self.db.place_holder),
+                           (self.extension, self.repository_id, self.head))
+
+    def hold(self, commit_id):
+        """Don't record commit_id and the newer commits as
+           processed, so they are processed again"""
+        if self.head is not None:
+            self.head = min(self.head, commit_id - 1)
+
+    def reset(self, cursor):
+        """Forget the commits processed, so all
+           of them are processed again"""
+        cursor.execute(statement(self.__delete__, self.db.place_holder),
+                       (self.extension, self.repository_id))
+        self.last = None
+
+
 _extensions = {}
 
 
@@ -55,3 +120,23 @@ def get_extension(extension_name):
         raise ExtensionUnknownError("Extension %s unknown" % extension_name)
 
     return _extensions[extension_name]
+
+
+_register_re = re.compile(r"^register_extension\(\s*[\"'](\w+)[\"']", re.M)
+
+
+def list_extensions():
+    """Return the names of the extensions registered by the modules
+       in this directory. Modules are scanned instead of imported, so
+       the dependencies of the extensions are not loaded"""
+    names = []
+    dir = os.path.dirname(os.path.realpath(__file__))
+    for filename in os.listdir(dir):
+        if not filename.endswith(".py"):
+            continue
+
+        f = open(os.path.join(dir, filename), 'r')
+        names.extend(_register_re.findall(f.read()))
+        f.close()
+
+    return names
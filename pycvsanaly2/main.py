@@ -31,13 +31,10 @@ Main funcion of cvsanaly. Fun starts here!
 import os
 import getopt
 
-from repositoryhandler.backends import create_repository, create_repository_from_path, RepositoryUnknownError
-from ParserFactory import create_parser_from_logfile, create_parser_from_repository
 from Database import (create_database, TableAlreadyExists, AccessDenied, DatabaseNotFound,
-                      DatabaseDriverNotSupported, DBRepository, statement, initialize_ids,
-                      DatabaseException)
-from DBProxyContentHandler import DBProxyContentHandler
-from Log import LogReader, LogWriter
+                      DatabaseDriverNotSupported, DBRepository, statement, statements,
+                      initialize_ids, DatabaseException)
+from AnalysisIndexes import manage_analysis_indexes, ACTIONS
 from ExtensionsManager import ExtensionsManager, InvalidExtension, InvalidDependency
 from Config import Config, ErrorLoadingConfig
 from utils import printerr, printout, uri_to_filename
@@ -68,6 +65,10 @@ Options:
   -n, --no-parse                 Skip the parsing process. It only makes sense in conjunction with --extensions
       --files=file1,file2        Only analyze the history of these files or directories. Ignored when '-l' flag is set.
       --git-ref                  Parse only commit tree starting with this reference. (Git only)
+      --cache-size=N             Keep at most N items of every parser cache in memory, storing
+                                 the rest on disk. All of them are kept in memory by default
+      --rebuild-caches           Rebuild the parser caches from the database when they are
+                                 missing or out of date, instead of stopping
 
 Database:
 
@@ -76,6 +77,11 @@ Database:
   -p, --db-password              Database user password
   -d, --db-database              Database name (cvsanaly)
   -H, --db-hostname              Name of the host where database server is running (localhost)
+      --bulk-load                Import faster into a new database, without waiting for the disk
+                                 and creating indexes at the end (sqlite only)
+      --analysis-indexes=action  Create, verify or drop the indexes used to analyze the
+                                 stored log [create|verify|drop], showing how long
+                                 the documented queries take before and after
 
 Metrics Options:
 
@@ -86,6 +92,7 @@ Extensions:
 
   -e, --list-extensions          Show all available extensions
       --extensions=ext1,ext2     List of extensions to run
+      --extensions-jobs=N        Run up to N extensions at the same time (1), only with MySQL
 
 """
 
@@ -97,7 +104,9 @@ def main(argv):
     long_opts = ["help", "version", "debug", "quiet", "profile", "config-file=",
                  "repo-logfile=", "save-logfile=", "no-parse", "files=",
                  "db-user=", "db-password=", "db-hostname=", "db-database=", "db-driver=",
-                 "extensions=", "metrics-all", "metrics-noerr", "list-extensions", "git-ref=", "writable-path="]
+                 "extensions=", "metrics-all", "metrics-noerr", "list-extensions", "git-ref=", "writable-path=",
+                 "cache-size=", "rebuild-caches", "bulk-load", "analysis-indexes=",
+                 "extensions-jobs="]
 
     # Default options
     debug = None
@@ -115,9 +124,14 @@ def main(argv):
     save_logfile = None
     writable_path = None
     extensions = None
+    extensions_jobs = None
     metrics_all = None
     metrics_noerr = None
     gitref = None
+    cache_size = None
+    rebuild_caches = None
+    bulk_load = None
+    analysis_indexes = None
 
     try:
         opts, args = getopt.getopt(argv, short_opts, long_opts)
@@ -157,6 +171,13 @@ def main(argv):
             hostname = value
         elif opt in ("-d", "--db-database"):
             database = value
+        elif opt in ("--bulk-load", ):
+            bulk_load = True
+        elif opt in ("--analysis-indexes", ):
+            if value not in ACTIONS:
+                printerr("Invalid analysis indexes action %s", (value,))
+                return 1
+            analysis_indexes = value
         elif opt in ("--db-driver"):
             driver = value
         elif opt in ("-l", "--repo-logfile"):
@@ -167,12 +188,28 @@ def main(argv):
             writable_path = value
         elif opt in ("--extensions", ):
             extensions = value.split(',')
+        elif opt in ("--extensions-jobs", ):
+            try:
+                extensions_jobs = int(value)
+            except ValueError:
+                printerr("Invalid number of extension jobs %s", (value,))
+                return 1
         elif opt in ("--metrics-all", ):
             metrics_all = True
         elif opt in ("--metrics-noerr", ):
             metrics_noerr = True
         elif opt in ("--git-ref", ):
             gitref = value
+        elif opt in ("--cache-size", ):
+            try:
+                cache_size = int(value)
+                if cache_size <= 0:
+                    raise ValueError
+            except ValueError:
+                printerr("Invalid cache size %s", (value,))
+                return 1
+        elif opt in ("--rebuild-caches", ):
+            rebuild_caches = True
 
     if len(args) <= 0:
         uri = os.getcwd()
@@ -195,6 +232,8 @@ def main(argv):
         config.quiet = quiet
     if profile is not None:
         config.profile = profile
+    # Statements are counted while profiling
+    statements.enabled = config.profile
     if logfile is not None:
         config.repo_logfile = logfile
     if save_logfile is not None:
@@ -215,21 +254,48 @@ def main(argv):
         config.db_hostname = hostname
     if database is not None:
         config.db_database = database
+    if bulk_load is not None:
+        config.bulk_load = bulk_load
+    if analysis_indexes is not None:
+        config.analysis_indexes = analysis_indexes
     if extensions is not None:
         config.extensions.extend([item for item in extensions if item not in config.extensions])
+    if extensions_jobs is not None:
+        config.extensions_jobs = extensions_jobs
     if metrics_all is not None:
         config.metrics_all = metrics_all
     if metrics_noerr is not None:
         config.metrics_noerr = metrics_noerr
     config.gitref = gitref
+    if cache_size is not None:
+        config.cache_size = cache_size
+    if rebuild_caches is not None:
+        config.rebuild_caches = rebuild_caches
 
-    if not config.extensions and config.no_parse:
+    if config.bulk_load and config.db_driver != 'sqlite':
+        printerr("Bulk load is only supported by SQLite")
+        return 1
+
+    if config.db_driver == 'sqlite' and config.extensions_jobs > 1:
+        # SQLite has a single writer, and extensions keep their
+        # write transactions open while they run
+        printout("Extensions are run one at a time with SQLite")
+        config.extensions_jobs = 1
+
+    if not config.extensions and config.no_parse and config.analysis_indexes is None:
         # Do nothing!!!
         return 0
 
-    if config.debug:
-        import repositoryhandler.backends
+    # Repositories, parsers and the database content handler are
+    # only loaded when needed, so showing help or the list of
+    # extensions doesn't depend on them
+    import repositoryhandler.backends
+    from repositoryhandler.backends import create_repository, create_repository_from_path, RepositoryUnknownError
+    from ParserFactory import create_parser_from_logfile, create_parser_from_repository
+    from DBProxyContentHandler import DBProxyContentHandler
+    from Log import LogReader, LogWriter
 
+    if config.debug:
         repositoryhandler.backends.DEBUG = True
 
     if config.writable_path is not None:
@@ -292,7 +358,7 @@ def main(argv):
             # TODO: check parser type == logfile type
 
     try:
-        emg = ExtensionsManager(config.extensions)
+        emg = ExtensionsManager(config.extensions, config.extensions_jobs)
     except InvalidExtension, e:
         printerr("Invalid extension %s (%s)", (e.name, e.message,))
         return 1
@@ -325,6 +391,10 @@ def main(argv):
     cursor = cnn.cursor()
     try:
         db.create_tables(cursor)
+        if config.bulk_load and not config.no_parse:
+            # Only new databases are bulk loaded, indexes
+            # are created once the log is stored
+            db.begin_bulk_load(cursor)
         cnn.commit()
     except TableAlreadyExists:
         db_exists = True
@@ -373,10 +443,25 @@ def main(argv):
             writer = LogWriter(config.save_logfile)
 
         parser.set_content_handler(DBProxyContentHandler(db))
-        reader.start(new_line, (parser, writer))
-        parser.end()
-        writer and writer.close()
+        try:
+            reader.start(new_line, (parser, writer))
+            parser.end()
+            writer and writer.close()
+        finally:
+            if db.bulk_load:
+                cnn = db.connect()
+                db.end_bulk_load(cnn.cursor())
+                cnn.close()
+
+    if config.analysis_indexes is not None:
+        printout("Analysis indexes")
+        if not manage_analysis_indexes(db, uri, config.analysis_indexes):
+            printerr("Some analysis indexes are missing, run with --analysis-indexes=create")
 
     # Run extensions
     printout("Executing extensions")
     emg.run_extensions(repo, path or uri, db)
+
+    if config.profile:
+        printout("Statements run")
+        statements.print_stats()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2014 LibreSoft
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# To execute this test, run: "python -m unittest tests.blob_cache_test" in the
+# root of the project
+
+import sys
+import os
+import shutil
+import tempfile
+import time
+from pycvsanaly2.BlobCache import BlobCache
+
+requiredVersion = (2,7)
+currentVersion = sys.version_info
+
+if currentVersion >= requiredVersion:
+    import unittest
+else:
+    import unittest2 as unittest
+
+
+class BlobCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def __n_files(self):
+        return sum(len(filenames) for dirpath, dirnames, filenames in os.walk(self.path))
+
+    def testPutGet(self):
+        cache = BlobCache(self.path, 100)
+        self.assertEqual(None, cache.get('blob'))
+        cache.put('blob', 'contents')
+        self.assertEqual('contents', cache.get('blob'))
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+        # Blobs are found by other caches in the same directory
+        self.assertEqual('contents', BlobCache(self.path, 100).get('blob'))
+
+    def testSize(self):
+        cache = BlobCache(self.path, 100)
+        cache.put('blob0', 'a' * 10)
+        cache.put('blob1', 'b' * 20)
+        self.assertEqual(30, cache.size)
+
+        # Replaced blobs are not counted twice
+        cache.put('blob1', 'c' * 5)
+        self.assertEqual(15, cache.size)
+
+        # Blobs bigger than the cache are not stored
+        cache.put('blob2', 'd' * 101)
+        self.assertEqual(None, cache.get('blob2'))
+        self.assertEqual(15, cache.size)
+
+        # Blobs already in the directory are counted once
+        cache = BlobCache(self.path, 100)
+        cache.put('blob3', 'e' * 10)
+        self.assertEqual(25, cache.size)
+
+    def testEviction(self):
+        cache = BlobCache(self.path, 30)
+        for i in range(5):
+            cache.put('blob%d' % (i), str(i) * 10)
+            # Keep blob0 the most recently used one
+            time.sleep(0.01)
+            cache.get('blob0')
+
+        self.assertTrue(cache.size <= 30)
+        self.assertEqual('0' * 10, cache.get('blob0'))
+        self.assertEqual('4' * 10, cache.get('blob4'))
+        self.assertEqual(None, cache.get('blob1'))
+        self.assertEqual(cache.size / 10, self.__n_files())
+
+    def testTemporaryFiles(self):
+        # Blobs being written by other processes
+        # are neither counted nor removed
+        dirname = os.path.join(self.path, 'ab')
+        os.mkdir(dirname)
+        tmp = os.path.join(dirname, '.tmpblob')
+        open(tmp, 'w').write('x' * 50)
+
+        cache = BlobCache(self.path, 30)
+        cache.put('blob0', '0' * 20)
+        cache.put('blob1', '1' * 20)
+        self.assertEqual(20, cache.size)
+        self.assertTrue(os.path.exists(tmp))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2014 LibreSoft
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# To execute this test, run: "python -m unittest tests.cache_rebuild_test" in the
+# root of the project
+
+import sys
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from pycvsanaly2 import utils
+from pycvsanaly2.Config import Config
+from pycvsanaly2.Database import (create_database, initialize_ids,
+                                  DBRepository, statement)
+from pycvsanaly2.DBContentHandler import DBContentHandler, CacheFileMismatch
+from pycvsanaly2.Repository import Commit, Action, Person
+
+requiredVersion = (2,7)
+currentVersion = sys.version_info
+
+if currentVersion >= requiredVersion:
+    import unittest
+else:
+    import unittest2 as unittest
+
+
+# (branch, [(type, f1, f2)]) of every revision
+HISTORY = [
+    ('trunk', [('A', '/src', None), ('A', '/src/main.c', None),
+               ('A', '/src/util.c', None), ('A', '/README', None)]),
+    ('trunk', [('M', '/src/main.c', None), ('A', '/doc', None),
+               ('A', '/doc/index.txt', None)]),
+    ('trunk', [('C', '/src/copy.c', '/src/util.c'), ('M', '/README', None)]),
+    ('b1', [('M', '/src/main.c', None), ('A', '/src/b1.c', None)]),
+    ('trunk', [('D', '/doc', None), ('M', '/src/copy.c', None)]),
+    ('trunk', [('R', '/README', '/src/main.c'), ('A', '/NEWS', None)]),
+    ('b1', [('D', '/src/b1.c', None)]),
+    ('trunk', [('M', '/NEWS', None), ('A', '/doc', None),
+               ('A', '/doc/index.txt', None)]),
+]
+
+
+class CacheRebuildTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.config = Config()
+        self.config.cache_size = None
+        self.config.rebuild_caches = False
+        self.dir = tempfile.mkdtemp()
+        self.uri = 'file://' + self.dir
+        # Keep the cache files out of the user's cache directory
+        self.cache_dir = utils._dirs.get('cache')
+        utils.set_writable_path_from_config('cache', self.dir)
+        self.db = create_database('sqlite', os.path.join(self.dir, 'test.db'))
+
+        cnn = self.db.connect()
+        cursor = cnn.cursor()
+        self.db.create_tables(cursor)
+        initialize_ids(self.db, cursor)
+        rep = DBRepository(None, self.uri, 'test', 'svn')
+        cursor.execute(statement(DBRepository.__insert__, self.db.place_holder),
+                       (rep.id, rep.uri, rep.name, rep.type))
+        cnn.commit()
+        cnn.close()
+
+    def tearDown(self):
+        self.config.cache_size = None
+        self.config.rebuild_caches = False
+        if self.cache_dir is None:
+            del utils._dirs['cache']
+        else:
+            utils._dirs['cache'] = self.cache_dir
+        shutil.rmtree(self.dir)
+
+    def __remove_caches(self):
+        for path in self.cache_files:
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def __commits(self, email='carlos@example.com'):
+        person = Person()
+        person.name = 'carlos'
+        person.email = email
+
+        commits = []
+        for i, (branch, actions) in enumerate(HISTORY):
+            commit = Commit()
+            commit.revision = str(i + 1)
+            commit.committer = person
+            commit.date = datetime(2012, 1, 1) + timedelta(days=i)
+            commit.branch = branch
+            commit.actions = []
+            for type, f1, f2 in actions:
+                action = Action()
+                action.type = type
+                action.f1 = f1
+                action.f2 = f2
+                action.rev = f2 and str(i)
+                commit.actions.append(action)
+            commits.append(commit)
+
+        return commits
+
+    def __open(self):
+        ch = DBContentHandler(self.db)
+        ch.begin()
+        ch.repository(self.uri)
+        self.cache_files = (ch.cache_file, ch.store_file)
+
+        return ch
+
+    def __caches(self, ch):
+        return [dict(cache.items())
+                for cache in (ch.file_cache, ch.deletes_cache, ch.revision_cache)]
+
+    def __parse(self, email='carlos@example.com'):
+        ch = self.__open()
+        for commit in self.__commits(email):
+            ch.commit(commit)
+        ch.end()
+
+        ch = self.__open()
+        caches = self.__caches(ch)
+        ch.end()
+
+        return caches
+
+    def testMissingCacheFails(self):
+        self.__parse()
+        self.__remove_caches()
+
+        self.assertRaises(CacheFileMismatch, self.__open)
+
+    def testRebuildCaches(self):
+        caches = self.__parse()
+        self.__remove_caches()
+
+        self.config.rebuild_caches = True
+        ch = self.__open()
+        self.assertTrue(caches[0] and caches[1])
+        self.assertEqual(caches, self.__caches(ch))
+        ch.end()
+
+    def testRebuildCachesOnDisk(self):
+        self.config.cache_size = 2
+        caches = self.__parse()
+        self.__remove_caches()
+
+        self.config.rebuild_caches = True
+        ch = self.__open()
+        self.assertEqual(caches, self.__caches(ch))
+        ch.end()
+
+    def testRebuildWithoutActions(self):
+        caches = self.__parse()
+        self.__remove_caches()
+
+        cnn = self.db.connect()
+        cursor = cnn.cursor()
+        cursor.execute("DELETE FROM actions")
+        cnn.commit()
+        cnn.close()
+
+        self.config.rebuild_caches = True
+        ch = self.__open()
+        file_cache, deletes_cache, revision_cache = self.__caches(ch)
+        self.assertEqual({}, file_cache)
+        self.assertEqual(caches[2], revision_cache)
+        ch.end()
+
+    def __count(self, table):
+        cnn = self.db.connect()
+        cursor = cnn.cursor()
+        cursor.execute("SELECT count(*) from %s" % (table))
+        count = cursor.fetchone()[0]
+        cnn.close()
+
+        return count
+
+    def __commit_again(self, email, branch):
+        """Store a new commit after rebuilding the caches"""
+        self.__remove_caches()
+        self.config.rebuild_caches = True
+
+        commit = self.__commits(email)[-1]
+        commit.revision = str(len(HISTORY) + 1)
+        commit.branch = branch
+        action = Action()
+        action.type = 'A'
+        action.f1 = '/new.c'
+        action.f2 = action.rev = None
+        commit.actions = [action]
+        ch = self.__open()
+        ch.commit(commit)
+        ch.end()
+
+    def testRebuildKeepsPeople(self):
+        self.__parse(u'carlos@ex\xe1mple.com')
+        self.__commit_again(u'carlos@ex\xe1mple.com', u'b1')
+
+        self.assertEqual(1, self.__count("people"))
+        self.assertEqual(2, self.__count("branches"))
+
+    def testRebuildKeepsBranches(self):
+        ch = self.__open()
+        commit = self.__commits()[0]
+        commit.branch = u'ra\xf1a'
+        ch.commit(commit)
+        ch.end()
+        self.__commit_again('carlos@example.com', u'ra\xf1a')
+
+        self.assertEqual(1, self.__count("branches"))
+
+    def testCaseInsensitiveKeys(self):
+        # Like MySQL, whose collation ignores case
+        self.db.case_insensitive = True
+        self.__parse()
+        self.__commit_again('Carlos@Example.com', 'B1')
+
+        self.assertEqual(1, self.__count("people"))
+        self.assertEqual(2, self.__count("branches"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2014 LibreSoft
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# To execute this test, run: "python -m unittest tests.commit_graph_test" in the
+# root of the project
+
+import sys
+import random
+from pycvsanaly2.CommitGraph import CommitGraph, AncestryIndex
+
+requiredVersion = (2,7)
+currentVersion = sys.version_info
+
+if currentVersion >= requiredVersion:
+    import unittest
+else:
+    import unittest2 as unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def random_history(seed, n, window=50):
+    """Return the edges of a random history with branches and
+       merges, and the ancestors of every commit"""
+    rnd = random.Random(seed)
+    edges = []
+    ancestors = {0: set([0])}
+    for c in range(1, n):
+        ps = rnd.sample(range(max(0, c - window), c), min(c, rnd.choice([1, 1, 1, 2])))
+        ancestors[c] = set([c])
+        for p in ps:
+            edges.append((c, p))
+            ancestors[c] |= ancestors[p]
+
+    return edges, ancestors
+
+
+def longest_paths(n, edges):
+    gen = [0] * n
+    for c, p in sorted(edges):
+        gen[c] = max(gen[c], gen[p] + 1)
+
+    return gen
+
+
+class AncestryIndexTestCase(unittest.TestCase):
+
+    def testIsAncestor(self):
+        rnd = random.Random(1)
+        for seed in range(5):
+            edges, ancestors = random_history(seed, 300)
+            index = AncestryIndex(edges)
+            self.assertEqual(len(edges), index.n_edges)
+            for i in range(2000):
+                a, b = rnd.randrange(300), rnd.randrange(300)
+                self.assertEqual(a in ancestors[b], index.is_ancestor(a, b))
+
+    def testUnknownCommits(self):
+        index = AncestryIndex([(2, 1)])
+        self.assertTrue(index.is_ancestor(1, 2))
+        self.assertTrue(index.is_ancestor(3, 3))
+        self.assertFalse(index.is_ancestor(3, 2))
+        self.assertFalse(index.is_ancestor(1, 3))
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class CommitGraphTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.n = 500
+        self.edges, self.ancestors = random_history(0, self.n)
+        self.graph = CommitGraph(range(self.n), self.edges)
+
+    def testChains(self):
+        # A linear history is a single chain
+        graph = CommitGraph(range(100), [(c, c - 1) for c in range(1, 100)])
+        self.assertEqual([0] * 100, graph.head.tolist())
+        self.assertEqual(range(100), graph.offset.tolist())
+        self.assertEqual(range(99, -1, -1), graph.first_parents(99).tolist())
+        self.assertEqual([99, 98, 97], graph.first_parents(99, 3).tolist())
+
+        # Commits of a chain have a single parent with no other
+        # children, and they follow the head of their chain
+        graph = self.graph
+        for c in range(self.n):
+            h = graph.head[c]
+            if graph.offset[c] > 0:
+                parents = graph.parents(c).tolist()
+                self.assertEqual(1, len(parents))
+                self.assertEqual([c], graph.children(parents[0]).tolist())
+                self.assertEqual(h, graph.head[parents[0]])
+                self.assertEqual(graph.offset[c] - 1, graph.offset[parents[0]])
+
+    def testCycles(self):
+        self.assertRaises(ValueError, CommitGraph, range(3), [(1, 0), (2, 1), (1, 2)])
+
+    def testGenerations(self):
+        self.assertEqual(longest_paths(self.n, self.edges), self.graph.gen.tolist())
+
+    def testParentsOrder(self):
+        graph = CommitGraph(range(4), [(3, 2), (3, 1), (2, 0), (1, 0)])
+        self.assertEqual([2, 1], graph.parents(3).tolist())
+        self.assertEqual([3, 2, 0], graph.first_parents(3).tolist())
+
+        graph = CommitGraph(range(4), [(3, 2), (3, 1), (2, 0), (1, 0)],
+                            parents_ordered=False)
+        self.assertEqual([1, 2], graph.parents(3).tolist())
+
+    def testTopoOrder(self):
+        position = dict((c, i) for i, c in enumerate(self.graph.topo_order().tolist()))
+        for c, p in self.edges:
+            self.assertTrue(position[p] < position[c])
+
+    def testAncestors(self):
+        for c in range(0, self.n, 25):
+            self.assertEqual(self.ancestors[c], set(self.graph.ancestors(c).tolist()))
+            descendants = set(d for d in range(self.n) if c in self.ancestors[d])
+            self.assertEqual(descendants, set(self.graph.descendants(c).tolist()))
+
+    def testIsAncestor(self):
+        rnd = random.Random(1)
+        for i in range(5000):
+            a, b = rnd.randrange(self.n), rnd.randrange(self.n)
+            self.assertEqual(a in self.ancestors[b], self.graph.is_ancestor(a, b))
+
+    def testMergeBases(self):
+        rnd = random.Random(2)
+        for i in range(200):
+            a, b = rnd.randrange(self.n), rnd.randrange(self.n)
+            common = self.ancestors[a] & self.ancestors[b]
+            best = set(c for c in common
+                       if not any(c in self.ancestors[d] for d in common if d != c))
+            self.assertEqual(best, set(self.graph.merge_bases(a, b).tolist()))
+
+
+if __name__ == "__main__":
+    unittest.main()
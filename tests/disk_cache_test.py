@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2014 LibreSoft
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# To execute this test, run: "python -m unittest tests.disk_cache_test" in the
+# root of the project
+
+import sys
+import os
+import tempfile
+from pycvsanaly2.DiskCache import DiskCacheStore
+
+requiredVersion = (2,7)
+currentVersion = sys.version_info
+
+if currentVersion >= requiredVersion:
+    import unittest
+else:
+    import unittest2 as unittest
+
+
+class DiskCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp('.db', 'diskcache')
+        os.close(fd)
+        self.store = DiskCacheStore(self.path)
+
+    def tearDown(self):
+        if self.store.cnn is not None:
+            self.store.close()
+        os.remove(self.path)
+
+    def __fill(self, cache):
+        for i in range(5):
+            cache['3:///trunk/%d' % (i)] = (i, -1)
+        cache['3:///trunkx'] = (5, -1)
+
+    def testLRU(self):
+        cache = self.store.get_cache('test', 2)
+        self.__fill(cache)
+
+        # Items dropped from memory are read back from the table
+        self.assertEqual(2, len(cache.lru))
+        self.assertEqual((0, -1), cache['3:///trunk/0'])
+        self.assertEqual(6, len(cache))
+        self.assertEqual(2, len(cache.lru))
+
+        del cache['3:///trunk/0']
+        self.assertFalse('3:///trunk/0' in cache)
+        self.assertRaises(KeyError, cache.__delitem__, '3:///trunk/0')
+
+    def testKeysWithPrefix(self):
+        cache = self.store.get_cache('test', 2)
+        self.__fill(cache)
+
+        self.assertEqual(['3:///trunk/%d' % (i) for i in range(5)],
+                         sorted(cache.keys_with_prefix('3:///trunk/')))
+        self.assertEqual(6, len(cache.keys_with_prefix('')))
+
+    def testCommit(self):
+        cache = self.store.get_cache('test', 2)
+        self.__fill(cache)
+        self.store.set_object('object', {'a': 1})
+        self.store.commit()
+        self.store.close()
+
+        # Everything is loaded in memory when there's no limit
+        self.store = DiskCacheStore(self.path)
+        cache = self.store.get_cache('test', None, True)
+        self.assertTrue(cache.complete)
+        self.assertEqual(6, len(cache.lru))
+        self.assertEqual((5, -1), cache['3:///trunkx'])
+        self.assertEqual({'a': 1}, self.store.get_object('object'))
+        self.assertEqual(None, self.store.get_object('missing'))
+
+    def testRollback(self):
+        cache = self.store.get_cache('test', 2)
+        self.__fill(cache)
+        self.store.close()
+
+        # Changes are lost unless the store is committed
+        self.store = DiskCacheStore(self.path)
+        self.assertEqual(0, len(self.store.get_cache('test', 2)))
+
+
+if __name__ == "__main__":
+    unittest.main()